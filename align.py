@@ -0,0 +1,118 @@
+from lazy_modules import lazy_import
+
+# pandas and numpy are loaded at their first use (see lazy_modules.py)
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+"""
+Functions to align series with different time stamps to a common set of buckets, used by HomeMessagesDB.query_aligned().
+Everything works on sorted numpy arrays (searchsorted, bincount), without Python loops over the readings and without
+resampling in pandas. A series is aligned in one of two ways:
+- as-of: the value of the last reading at or before the start of the bucket (like pd.merge_asof with direction='backward');
+- aggregate: the count, mean, minimum or maximum of the readings in the bucket, combined from partial aggregates
+  of smaller buckets (such as the hourly rows of the 'sensor_rollups' table), so the readings themselves are not needed.
+utc_offsets() lists the UTC offsets of a time zone over a period, so that the database can group by local time
+(see HomeMessagesDB.local_time()).
+"""
+
+def asof(epochs, values, targets, tolerance=None):
+    """
+    The function returns, for every target time, the value of the last reading (epochs must be sorted) at or before it.
+    Targets without such a reading, or for which it is more than tolerance seconds older, get NaN.
+    """
+    epochs = np.asarray(epochs, dtype='int64')
+    values = np.asarray(values, dtype='float64')
+    targets = np.asarray(targets, dtype='int64')
+    out = np.full(targets.shape[0], np.nan)
+    if epochs.shape[0] == 0:
+        return out
+
+    positions = np.searchsorted(epochs, targets, side='right') - 1
+    found = positions >= 0
+    if tolerance is not None:
+        found &= targets - epochs[np.maximum(positions, 0)] <= tolerance
+    out[found] = values[positions[found]]
+    return out
+
+def bucket_positions(edges, epochs):
+    """
+    The function returns the index of the bucket (between the sorted edges) of every epoch, or -1 for the epochs outside the buckets.
+    """
+    positions = np.searchsorted(edges, np.asarray(epochs, dtype='int64'), side='right') - 1
+    positions[positions >= edges.shape[0] - 1] = -1
+    return positions
+
+def combine(edges, buckets, n, total, minimum, maximum, how='mean'):
+    """
+    The function combines partial aggregates (the number, sum, minimum and maximum of the readings per smaller bucket,
+    starting at 'buckets') into the buckets between the edges. how is 'count', 'mean', 'min' or 'max'.
+    The smaller buckets must not cross the edges. Buckets without readings get NaN (or 0 for 'count').
+    """
+    size = edges.shape[0] - 1
+    positions = bucket_positions(edges, buckets)
+    keep = positions >= 0
+    positions = positions[keep]
+
+    if how == 'count':
+        return np.bincount(positions, weights=np.asarray(n, dtype='float64')[keep], minlength=size)
+    if how == 'mean':
+        counts = np.bincount(positions, weights=np.asarray(n, dtype='float64')[keep], minlength=size)
+        totals = np.bincount(positions, weights=np.asarray(total, dtype='float64')[keep], minlength=size)
+        out = np.full(size, np.nan)
+        np.divide(totals, counts, out=out, where=counts > 0)
+        return out
+    if how in ('min', 'max'):
+        # fmin and fmax ignore the NaN that the buckets start with
+        out = np.full(size, np.nan)
+        ufunc, values = (np.fmin, minimum) if how == 'min' else (np.fmax, maximum)
+        ufunc.at(out, positions, np.asarray(values, dtype='float64')[keep])
+        return out
+    raise ValueError(f"Unknown aggregate: {how}. Use 'count', 'mean', 'min' or 'max'")
+
+def aggregate(edges, epochs, values, how='mean'):
+    """
+    The function aggregates single readings (e.g. the hourly weather) into the buckets between the edges, see combine().
+    Missing values are left out.
+    """
+    epochs = np.asarray(epochs, dtype='int64')
+    values = np.asarray(values, dtype='float64')
+    valid = ~np.isnan(values)
+    epochs, values = epochs[valid], values[valid]
+    return combine(edges, epochs, np.ones(epochs.shape[0]), values, values, values, how)
+
+def chunk_edges(edges, max_seconds):
+    """
+    The function splits the edges of consecutive buckets into chunks that span at most max_seconds (but at least one bucket),
+    and yields the edges of every chunk. Consecutive chunks share an edge.
+    """
+    first = 0
+    while first < edges.shape[0] - 1:
+        last = max(np.searchsorted(edges, edges[first] + max_seconds, side='right') - 1, first + 1)
+        yield edges[first:last + 1]
+        first = last
+
+def offsets_at(epochs, tz):
+    """
+    Helper function that returns the UTC offset (in seconds) of the time zone tz at every given Unix time
+    """
+    times = pd.to_datetime(np.asarray(epochs, dtype='int64'), unit='s', utc=True)
+    return np.asarray((times.tz_convert(tz).tz_localize(None) - times.tz_localize(None)).total_seconds(), dtype='int64')
+
+def utc_offsets(epoch_min, epoch_max, tz):
+    """
+    The function returns the UTC offsets (in seconds) of the time zone tz from epoch_min up to epoch_max, as two arrays: 
+    the Unix times from which the offsets apply (the first is epoch_min), and the offsets. The offsets are looked up 
+    once per day, and per hour only on the days on which the offset changes, so a period of years gives a few values per year.
+    """
+    epoch_min, epoch_max = int(epoch_min), int(epoch_max)
+    days = np.arange(epoch_min - epoch_min % 86400, epoch_max + 86400, 86400)
+    day_offsets = offsets_at(days, tz)
+    starts, offsets = [epoch_min], [int(offsets_at([epoch_min], tz)[0])]
+    for day in days[np.flatnonzero(np.diff(day_offsets))]:
+        hours = np.arange(day, day + 86400 + 1, 3600)
+        hour_offsets = offsets_at(hours, tz)
+        change = np.flatnonzero(hour_offsets != hour_offsets[0])[0]
+        if epoch_min < hours[change] <= epoch_max:
+            starts.append(int(hours[change]))
+            offsets.append(int(hour_offsets[change]))
+    return np.array(starts, dtype='int64'), np.array(offsets, dtype='int64')
@@ -0,0 +1,202 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import contextlib
+import click
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+import p1e
+import p1g
+import smartthings
+import meter
+import synthetic_data
+from ingest import deduplicate
+from home_messages_db import HomeMessagesDB
+
+"""
+Benchmark of the ingestion and query paths. Synthetic exports are generated with synthetic_data.py, and then:
+- every tool (p1e.py, p1g.py and smartthings.py) is run from the command line on a fresh SQLite database,
+  measuring the wall time and the peak memory (RSS) of the process;
+- the stages of every tool (parsing, cleaning, inserting, and inserting the same data again) are timed separately 
+  in this process, on another fresh database;
+- the query methods of HomeMessagesDB and the meter consumption engine are timed on the result;
+- the startup of the tools is timed: --help, and an ingest of files that were already ingested (best of --startup-runs runs).
+The results are printed as a table and can be written to a JSON file, that a later run can be compared with (--compare).
+"""
+
+# The directory of the tools, so that the benchmark can be run from any directory
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def run_cli(args):
+    """
+    The function runs a tool (a script in this directory) in a separate Python process, and returns the wall time 
+    in seconds and its peak RSS in MB. The errors of the tool go to a temporary file, so that a tool that writes 
+    a lot of warnings cannot block on a full pipe.
+    """
+    args = [os.path.join(SCRIPT_DIR, args[0]), *args[1:]]
+    with tempfile.TemporaryFile() as stderr_file:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, *args], stdout=subprocess.DEVNULL, stderr=stderr_file)
+        _, status, usage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+        # The process was reaped by wait4, so Popen must not wait for it again
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            stderr_file.seek(0)
+            raise RuntimeError(f"{' '.join(args)} failed:\n{stderr_file.read().decode(errors='replace')}")
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return seconds, peak_rss
+
+def timed(results, name, rows, func, *args, **kwargs):
+    """
+    The function calls func (silencing its output), adds its timing to the results, and returns its return value.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    if callable(rows):
+        rows = rows(out)
+    results.append({
+        'name': name, 'seconds': round(seconds, 4), 'rows': int(rows),
+        'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None, 'peak_rss_mb': None
+    })
+    return out
+
+def bench_stages(results, db, files):
+    """
+    The function times the stages of the three tools separately, inserting the data into db.
+    """
+    for name, module, insert, table in [('p1e', p1e, db.insert_p1e_data, 'electricity'), ('p1g', p1g, db.insert_p1g_data, 'gas')]:
+        parsed = timed(results, f'{name}.parse', lambda out: sum(rows_read for _, rows_read, _ in out),
+                       lambda: [module.TOOL.parse_file(file) for file in files[name]])
+        frames = [pd.DataFrame(columns) for columns, _, message in parsed if message is None]
+        data = timed(results, f'{name}.deduplicate', sum(frame.shape[0] for frame in frames),
+                     lambda: deduplicate(pd.concat(frames)))
+        timed(results, f'{name}.insert', data.shape[0], insert, data, table)
+        timed(results, f'{name}.insert_again', data.shape[0], insert, data, table)
+
+    parsed = timed(results, 'smartthings.parse', lambda out: sum(rows_read for _, rows_read, _ in out),
+                   lambda: [smartthings.parse_file(file) for file in files['smartthings']])
+    data = pd.concat((pd.DataFrame(columns) for columns, _, message in parsed if message is None), ignore_index=True).drop_duplicates()
+    timed(results, 'smartthings.insert', data.shape[0], db.insert_smartthings, data)
+    timed(results, 'smartthings.insert_again', data.shape[0], db.insert_smartthings, data)
+
+def bench_queries(results, db):
+    """
+    The function times the query methods of HomeMessagesDB, over all data and over the last week of data.
+    """
+    electricity = timed(results, 'query.electricity', len, db.query_electricity)
+    week_start = int(electricity['epoch'].max()) - 7 * 86400
+    timed(results, 'query.electricity.week', len, db.query_electricity, start=week_start)
+    timed(results, 'query.gas', len, db.query_gas)
+    timed(results, 'query.smartthings', len, db.query_smartthings)
+    timed(results, 'query.smartthings.week', len, db.query_smartthings, start=week_start)
+    timed(results, 'query.meter_rollups.hour', len, db.query_meter_rollups, series=['gas', 'T1', 'T2', 'T1T2'])
+    timed(results, 'query.sensor_rollups.hour', len, db.query_sensor_rollups)
+    timed(results, 'meter.consumption.hour', electricity.shape[0], meter.consumption, electricity, ['T1', 'T2'])
+
+def bench_startup(results, cli_db, files, runs=5):
+    """
+    The function times the startup of the tools from the command line, with home_messages.py and with the tools themselves:
+    the --help of the entry point and of a command, and a run on files that were all ingested before (into cli_db), 
+    which only has to open the database and check the manifest. The best time of the runs is kept, as the others 
+    mostly measure the noise of the machine.
+    """
+    for name, args in [
+        ('startup.help', ['home_messages.py', '--help']),
+        ('startup.p1e.help', ['home_messages.py', 'p1e', '--help']),
+        ('startup.p1e.ingested', ['home_messages.py', 'p1e', '-d', cli_db, *files['p1e']]),
+        ('startup.p1e.py.help', ['p1e.py', '--help']),
+        ('startup.p1e.py.ingested', ['p1e.py', '-d', cli_db, *files['p1e']]),
+    ]:
+        seconds, peak_rss = min(run_cli(args) for _ in range(runs))
+        results.append({'name': name, 'seconds': round(seconds, 4), 'rows': 0, 'rows_per_sec': None, 'peak_rss_mb': round(peak_rss, 1)})
+
+def print_results(results, previous=None):
+    """
+    The function prints the results as a table; with the results of a previous run, the ratio of the timings is added.
+    """
+    previous = {result['name']: result for result in (previous or [])}
+    click.echo(f"{'name':32} {'seconds':>10} {'rows':>10} {'rows/sec':>12} {'peak MB':>9}" + (f" {'vs prev':>8}" if previous else ''))
+    for result in results:
+        peak_rss = f"{result['peak_rss_mb']:9.1f}" if result['peak_rss_mb'] is not None else f"{'-':>9}"
+        line = f"{result['name']:32} {result['seconds']:10.3f} {result['rows']:10d} {result['rows_per_sec'] or 0:12.0f} {peak_rss}"
+        if result['name'] in previous and previous[result['name']]['seconds']:
+            line += f" {result['seconds'] / previous[result['name']]['seconds']:7.2f}x"
+        click.echo(line)
+
+@click.command()
+@click.option('--days', type=click.IntRange(min=1), default=14, show_default=True, help='Number of days of synthetic data.')
+@click.option('--start', default='2022-10-25', show_default=True, help='First day of the synthetic data (the default includes a DST transition).')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True, help='Passed on to the tools.')
+@click.option('--chunksize', type=click.IntRange(min=1), default=None, help='Passed on to the tools.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Write the results to this JSON file.')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), default=None, help='JSON file of a previous run to compare with.')
+@click.option('--keep', is_flag=True, help='Keep the generated files and databases.')
+@click.option('--startup-runs', type=click.IntRange(min=1), default=5, show_default=True,
+              help='Number of runs of every startup benchmark, of which the best is kept.')
+
+def bench(days, start, workers, chunksize, output, compare, keep, startup_runs):
+    """
+    The function generates the synthetic data, runs the benchmarks and reports the results.
+    """
+    directory = tempfile.mkdtemp(prefix='bench_ingest_')
+    results = []
+    try:
+        files = {}
+        files['p1e'] = timed(results, 'generate.p1e', days, synthetic_data.write_p1e, directory, start, days)
+        files['p1g'] = timed(results, 'generate.p1g', days, synthetic_data.write_p1g, directory, start, days)
+        files['smartthings'] = timed(results, 'generate.smartthings', days, synthetic_data.write_smartthings, directory, start, days)
+
+        # The tools, from the command line
+        cli_db = 'sqlite:///' + os.path.join(directory, 'cli.db')
+        options = ['--workers', str(workers)] + (['--chunksize', str(chunksize)] if chunksize else [])
+        for name in ['p1e', 'p1g', 'smartthings']:
+            seconds, peak_rss = run_cli([f'{name}.py', '-d', cli_db, *options, *files[name]])
+            rows = HomeMessagesDB(cli_db).count_rows({'p1e': 'electricity', 'p1g': 'gas'}.get(name, name))
+            results.append({'name': f'{name}.cli', 'seconds': round(seconds, 4), 'rows': rows,
+                            'rows_per_sec': round(rows / seconds, 1), 'peak_rss_mb': round(peak_rss, 1)})
+        bench_startup(results, cli_db, files, startup_runs)
+
+        # The stages of the tools and the queries, in this process
+        db = HomeMessagesDB('sqlite:///' + os.path.join(directory, 'stages.db'))
+        bench_stages(results, db, files)
+        bench_queries(results, db)
+
+    finally:
+        if keep:
+            click.echo(f"The generated files and databases are kept in {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'config': {'days': days, 'start': start, 'workers': workers, 'chunksize': chunksize, 'startup_runs': startup_runs},
+        'environment': {
+            'python': platform.python_version(), 'platform': platform.platform(), 'pandas': pd.__version__,
+            'numpy': np.__version__, 'sqlalchemy': sqlalchemy.__version__
+        },
+        'results': results,
+    }
+    previous = None
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        click.echo(f"Saved the results to {output}")
+
+# For calling from the command line interface
+if __name__ == '__main__':
+    bench()
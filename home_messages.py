@@ -0,0 +1,87 @@
+import click
+from households import household_url
+from lazy_modules import lazy_import
+
+# pandas and the database are loaded at their first use (see lazy_modules.py), so that --help starts fast
+pd = lazy_import('pandas')
+home_messages_db = lazy_import('home_messages_db')
+
+"""
+The single entry point of the tools: python home_messages.py <command> ..., e.g. python home_messages.py p1e -d sqlite:///home.db P1e-*.csv.gz.
+The commands are the tools p1e.py, p1g.py and smartthings.py (ingest), openweathermap.py (weather) and query.
+The module of a command is only imported when the command is run, and the tools load pandas, numpy and SQLAlchemy
+at their first use, so --help and runs without work start in a fraction of the time of importing these packages.
+The tables of a database are only checked when the models changed (see HomeMessagesDB.upgrade_schema()).
+To call it as home-messages, link or alias it, e.g. alias home-messages='python /path/to/home_messages.py'.
+"""
+
+# The commands that are imported when they are run: the module and the name of the command, and the help shown in the list
+LAZY_COMMANDS = {
+    'p1e': ('p1e', 'p1e', 'Ingest the P1 electricity exports (P1e-*.csv.gz).'),
+    'p1g': ('p1g', 'p1g', 'Ingest the P1 gas exports (P1g-*.csv.gz).'),
+    'smartthings': ('smartthings', 'smartthings', 'Ingest the SmartThings exports (*.tsv.gz).'),
+    'weather': ('openweathermap', 'store_weather', 'Retrieve and store the hourly weather of a period.'),
+}
+
+class LazyGroup(click.Group):
+    """
+    The class is a group of commands, some of which (LAZY_COMMANDS) are only imported when they are run or their help is shown.
+    """
+
+    def list_commands(self, ctx):
+        return sorted([*super().list_commands(ctx), *LAZY_COMMANDS])
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in LAZY_COMMANDS:
+            module, name, _ = LAZY_COMMANDS[cmd_name]
+            return getattr(__import__(module), name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        # The list of commands in --help uses the help of LAZY_COMMANDS, so that their modules are not imported
+        rows = []
+        for cmd_name in self.list_commands(ctx):
+            if cmd_name in LAZY_COMMANDS:
+                rows.append((cmd_name, LAZY_COMMANDS[cmd_name][2]))
+            else:
+                rows.append((cmd_name, super().get_command(ctx, cmd_name).get_short_help_str()))
+        with formatter.section('Commands'):
+            formatter.write_dl(rows)
+
+@click.group(cls=LazyGroup)
+def cli():
+    """
+    Tools to ingest and query the energy data of a home (or of several households, see --household).
+    """
+
+@cli.command()
+@click.argument('table', type=click.Choice(['electricity', 'gas', 'smartthings']))
+@click.option('-d', required=True, help='SQLAlchemy database URL, e.g. sqlite:///your_database.db')
+@click.option('--household', default=None,
+              help='Id of the household; -d is then a URL template with {household}, e.g. sqlite:///homes/{household}.db')
+@click.option('--start', default=None, help='First day (YYYY-MM-DD) of the readings.')
+@click.option('--end', default=None, help='Last day (YYYY-MM-DD) of the readings.')
+@click.option('--tz', default='Europe/Amsterdam', show_default=True, help='Time zone of the days.')
+@click.option('--count', is_flag=True, help='Only print the number of readings.')
+@click.option('-o', '--output', type=click.File('w'), default='-', help='Write the readings as CSV to this file.')
+def query(table, d, household, start, end, tz, count, output):
+    """
+    Print the readings of a table as CSV, or their number.
+    """
+    if household is not None:
+        try:
+            d = household_url(d, household)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--household')
+    db = home_messages_db.HomeMessagesDB(d, household=household)
+    # The epochs from midnight of the start day up to the last second of the end day
+    first = int(pd.Timestamp(start).tz_localize(tz).timestamp()) if start else None
+    last = int((pd.Timestamp(end) + pd.Timedelta(days=1)).tz_localize(tz).timestamp()) - 1 if end else None
+    if count:
+        # Mostly from the catalogue of the readings per month, so the table is not counted (see count_rows())
+        click.echo(db.count_rows(table, first, last))
+        return
+    getattr(db, f'query_{table}')(start=first, end=last).to_csv(output, index=False)
+
+if __name__ == '__main__':
+    cli()
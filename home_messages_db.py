@@ -1,11 +1,30 @@
-from sqlalchemy import create_engine, Column, Integer, Float, String
+from sqlalchemy import create_engine, Column, Integer, Float, String, ForeignKey, UniqueConstraint, Index, inspect
 from sqlalchemy.ext.declarative import declarative_base  
-from sqlalchemy.orm import sessionmaker                  
-from sqlalchemy.exc import IntegrityError                
-from sqlalchemy import and_
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
+from sqlalchemy import and_, text, func, literal, insert, case, select
 from sqlalchemy import or_
-import pandas as pd
-import numpy as np
+from sqlalchemy import event
+from contextlib import contextmanager
+from inspect import signature as call_signature
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+import hashlib
+import asyncio
+import functools
+import threading
+from instrumentation import Metrics
+import snapshots
+import meter
+import align
+from lazy_modules import lazy_import
+
+# pandas and numpy are loaded at their first use (see lazy_modules.py)
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
 
 """
 First, the structure of the database is defined in the classes below. 
@@ -31,193 +50,1890 @@ class Gas(Base):
     epoch = Column(Integer, primary_key=True)  
     usage = Column(Float)                      
 
-class SmartThings(Base):
+class Sensor(Base):
     """
-    Concept for the 'smartthings' table of the database
+    Concept for the 'sensors' table of the database. Every combination of a device and one of its attributes
+    gets a small integer id, so that the descriptive strings are stored only once instead of in every reading.
     """
-    __tablename__ = 'smartthings'  
-    id = Column(String, primary_key=True)
-    epoch = Column(Integer, nullable=False)                
+    __tablename__ = 'sensors'
+    sensor_id = Column(Integer, primary_key=True)
     loc = Column(String)
     level = Column(String)
     name = Column(String)
     capability = Column(String)                
     attribute = Column(String)                 
-    value = Column(String)                    
     unit = Column(String)                      
+    __table_args__ = (
+        UniqueConstraint('loc', 'level', 'name', 'capability', 'attribute', 'unit'),
+        Index('ix_sensors_name_attribute', 'name', 'attribute'),   # To find the sensors of a device quickly
+    )
+
+class SmartThings(Base):
+    """
+    Concept for the 'smartthings' table of the database. A reading is identified by the sensor that produced it 
+    and its epoch. The value is kept as reported, and also as a number when it is numeric.
+    """
+    __tablename__ = 'smartthings'  
+    sensor_id = Column(Integer, ForeignKey('sensors.sensor_id'), primary_key=True)
+    epoch = Column(Integer, primary_key=True)
+    value = Column(String)                    
+    value_num = Column(Float)                  # NULL for non-numeric values, such as 'on' or 'off'
+    # The primary key serves queries on a sensor and a time range; this index serves time ranges over all sensors
+    __table_args__ = (Index('ix_smartthings_epoch', 'epoch'),)
+
+# The columns that identify a sensor
+SENSOR_COLUMNS = ['loc', 'level', 'name', 'capability', 'attribute', 'unit']
+
+class IngestedFile(Base):
+    """
+    Concept for the 'ingested_files' table of the database, the manifest of the files 
+    that were loaded by the tools p1e.py, p1g.py and smartthings.py
+    """
+    __tablename__ = 'ingested_files'
+    source = Column(String, primary_key=True)  # The tool that ingested the file: 'p1e', 'p1g' or 'smartthings'
+    path = Column(String, primary_key=True)    # Absolute path of the file
+    size = Column(Integer)                     # Size in bytes
+    mtime = Column(Float)                      # Modification time, as reported by os.stat()
+    sha256 = Column(String)                    # Hash of the content of the file
+    rows_read = Column(Integer)                # Number of rows in the file
+    rows_clean = Column(Integer)               # Number of rows that were left after cleaning
+    epoch_min = Column(Integer)
+    epoch_max = Column(Integer)
+    ingested_at = Column(Integer)              # Unix time of the ingestion
+
+class TailedFile(Base):
+    """
+    Concept for the 'tailed_files' table of the database, that holds how far the growing (plain text) files 
+    in a watched directory were ingested by the --watch mode of the tools (see follow_directory() in ingest.py)
+    """
+    __tablename__ = 'tailed_files'
+    source = Column(String, primary_key=True)  # The tool that follows the file: 'p1e', 'p1g' or 'smartthings'
+    path = Column(String, primary_key=True)    # Absolute path of the file
+    offset = Column(Integer)                   # Number of bytes of the file that were ingested (always a whole number of lines)
+    header = Column(String)                    # The first line of the file, to recognize a file that was replaced
+    updated_at = Column(Integer)               # Unix time of the last ingested lines
+
+class MeterRollup(Base):
+    """
+    Concept for the 'meter_rollups' table of the database, that holds the consumption per hour and per day, 
+    derived from the cumulative meter readings. The series are 'gas', 'T1', 'T2' and 'T1T2' (the sum of T1 and T2).
+    The delta of a bucket is its last reading minus the last reading of the previous bucket that has readings,
+    like resample().last().diff() in pandas; it is NULL for the first bucket of a series.
+    """
+    __tablename__ = 'meter_rollups'
+    series = Column(String, primary_key=True)
+    resolution = Column(Integer, primary_key=True)  # Size of the buckets in seconds
+    bucket = Column(Integer, primary_key=True)      # Unix time of the start of the bucket (UTC)
+    last_epoch = Column(Integer)                    # Epoch of the last reading in the bucket
+    last_value = Column(Float)                      # Meter reading at last_epoch
+    delta = Column(Float)
+
+class SensorRollup(Base):
+    """
+    Concept for the 'sensor_rollups' table of the database, that holds the number, sum, minimum and maximum 
+    of the numeric readings of the temperature and humidity sensors per hour and per day
+    """
+    __tablename__ = 'sensor_rollups'
+    sensor_id = Column(Integer, ForeignKey('sensors.sensor_id'), primary_key=True)
+    resolution = Column(Integer, primary_key=True)  # Size of the buckets in seconds
+    bucket = Column(Integer, primary_key=True)      # Unix time of the start of the bucket (UTC)
+    n = Column(Integer)
+    total = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
+
+# The bucket sizes of the rollups, in seconds
+RESOLUTIONS = {'hour': 3600, 'day': 86400}
+# The attributes of the smartthings sensors that are rolled up
+ROLLUP_ATTRIBUTES = ['temperature', 'humidity']
+
+class SnapshotMonth(Base):
+    """
+    Concept for the 'snapshot_months' table of the database, that keeps track of the months of the tables that changed
+    since their Parquet snapshot was written (see HomeMessagesDB.export_snapshots())
+    """
+    __tablename__ = 'snapshot_months'
+    table_name = Column(String, primary_key=True)
+    month = Column(String, primary_key=True)  # 'YYYY-MM', in UTC
+    changed_at = Column(Float)                # Unix time of the last change of the month
+    exported_at = Column(Float)               # Unix time of the start of the last export of the month
+
+# The tables that are exported as monthly snapshots: the model, the time column and the order of the rows
+SNAPSHOT_TABLES = {
+    'electricity': (Electricity, 'epoch', ['epoch']),
+    'gas': (Gas, 'epoch', ['epoch']),
+    'smartthings': (SmartThings, 'epoch', ['sensor_id', 'epoch']),
+    'meter_rollups': (MeterRollup, 'bucket', ['series', 'resolution', 'bucket']),
+    'sensor_rollups': (SensorRollup, 'bucket', ['sensor_id', 'resolution', 'bucket']),
+}
+
+class TableMonth(Base):
+    """
+    Concept for the 'table_months' table of the database, the catalogue of the number of readings per month
+    of the 'electricity', 'gas' and 'smartthings' tables. It is kept up to date by the insertion functions and
+    by apply_retention(), so that count_rows() does not have to count the whole table.
+    """
+    __tablename__ = 'table_months'
+    table_name = Column(String, primary_key=True)
+    month = Column(String, primary_key=True)  # 'YYYY-MM', in UTC
+    rows = Column(Integer)
+
+class Retention(Base):
+    """
+    Concept for the 'retention' table of the database, that holds per readings table the epoch before which
+    the readings were removed by apply_retention(). Older data only remains in the rollups.
+    """
+    __tablename__ = 'retention'
+    table_name = Column(String, primary_key=True)
+    cutoff = Column(Integer)  # Unix time of the start of the oldest month whose readings are kept (UTC)
+
+class DataVersion(Base):
+    """
+    Concept for the 'data_versions' table of the database, that holds a counter per table and month, which is increased 
+    by every change of the month (in the same transaction), so that cached query results can be checked (see cached())
+    """
+    __tablename__ = 'data_versions'
+    table_name = Column(String, primary_key=True)
+    month = Column(String, primary_key=True)  # 'YYYY-MM', in UTC
+    version = Column(Integer)
+
+class Household(Base):
+    """
+    Concept for the 'household' table of the database, that holds the household whose data the database contains
+    (every household has its own database, see households.py), with its name and location.
+    """
+    __tablename__ = 'household'
+    household = Column(String, primary_key=True)  # The id of the household, as used in the database URL
+    name = Column(String)
+    lat = Column(Float)   # Location, e.g. for the weather
+    lon = Column(Float)
+    tz = Column(String)   # Time zone, e.g. 'Europe/Amsterdam'
+    created_at = Column(Float)  # Unix time at which the household was added
+
+# compare_entires() reads the keys of the stored readings in the ranges of the new epochs that have no gap longer than PROBE_GAP
+# seconds, with at most PROBE_RANGES ranges per query
+PROBE_GAP = 86400
+PROBE_RANGES = 200
+
+# The readings tables and their models
+READINGS_TABLES = {'electricity': Electricity, 'gas': Gas, 'smartthings': SmartThings}
+# The number of months (before the current month) of which apply_retention() keeps the readings by default
+RETENTION_MONTHS = {'electricity': 24, 'gas': 24, 'smartthings': 12}
+
+class Weather(Base):
+    """
+    Concept for the 'weather' table of the database, the hourly weather at a location as retrieved from 
+    the Open-Meteo archive by openweathermap.py
+    """
+    __tablename__ = 'weather'
+    lat = Column(Float, primary_key=True)     # Rounded to 4 decimals, see weather_location()
+    lon = Column(Float, primary_key=True)
+    epoch = Column(Integer, primary_key=True) # Unix time of the start of the hour
+    temperature = Column(Float)               # Temperature at 2 m, in °C
+    humidity = Column(Float)                  # Relative humidity at 2 m, in %
+
+class WeatherCoverage(Base):
+    """
+    Concept for the 'weather_coverage' table of the database, that holds the time ranges (start <= epoch < end) 
+    for which the weather at a location was retrieved. Ranges that overlap or touch are merged into one.
+    """
+    __tablename__ = 'weather_coverage'
+    lat = Column(Float, primary_key=True)
+    lon = Column(Float, primary_key=True)
+    start = Column(Integer, primary_key=True)
+    end = Column(Integer)
+
+# The series of query_aligned() by default: the name of the column, and the source, the series and how it is aligned
+ALIGNED_SERIES = {
+    'gas': ('meter', 'gas', 'sum'),
+    'electricity': ('meter', 'T1T2', 'sum'),
+    'garden_temperature': ('sensor', ('Garden air (sensor)', 'temperature'), 'mean'),
+    'garden_humidity': ('sensor', ('Garden air (sensor)', 'humidity'), 'mean'),
+    'weather_temperature': ('weather', 'temperature', 'asof'),
+    'weather_humidity': ('weather', 'humidity', 'asof'),
+}
+# The ways in which the series of every source can be aligned
+ALIGNED_HOW = {'meter': ('sum', 'asof'), 'sensor': ('mean', 'min', 'max', 'count'), 'weather': ('asof', 'mean', 'min', 'max')}
+
+# The groups of usage_profile(): the number of groups, and the group of a local time (Unix time shifted by the UTC offset).
+# 1 January 1970 was a Thursday, so day 0 is weekday 3 (Monday is 0).
+PROFILE_GROUPS = {
+    'hour': (24, lambda local: local // 3600 % 24),
+    'weekday': (7, lambda local: (local // 86400 + 3) % 7),
+}
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+class SchemaVersion(Base):
+    """
+    Concept for the 'schema_version' table of the database, that holds the version of the tables and indexes 
+    the database was last brought up to date with (see HomeMessagesDB.upgrade_schema())
+    """
+    __tablename__ = 'schema_version'
+    version = Column(String, primary_key=True)
+
+def schema_version(metadata):
+    """
+    The function returns the version of the tables, columns and indexes of the models: a short hash of their definitions, 
+    which changes whenever a model changes.
+    """
+    definition = [(table.name, [(col.name, str(col.type), col.primary_key) for col in table.columns],
+                   sorted((index.name, tuple(col.name for col in index.columns)) for index in table.indexes))
+                  for table in metadata.sorted_tables]
+    return hashlib.sha256(repr(definition).encode()).hexdigest()[:16]
+
+SCHEMA_VERSION = schema_version(Base.metadata)
+
+def operation(method):
+    """
+    Decorator of the public methods of HomeMessagesDB. Every call is one operation, with the session of the calling thread, 
+    that is closed afterwards so that its connection goes back to the pool. If the database is busy (e.g. a SQLite database 
+    that another process is writing to), the operation is rolled back and tried again after an increasing delay, 
+    up to self.retries times. Calls made within an operation (e.g. insert_p1e_data() calling count_rows()) are part of it.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self.local, 'depth', 0):
+            return method(self, *args, **kwargs)
+        self.local.depth = 1
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    return method(self, *args, **kwargs)
+                except OperationalError as e:
+                    self.session.rollback()
+                    if not HomeMessagesDB.is_busy(e) or attempt == self.retries:
+                        raise
+                    print(f"The database is busy, trying again ({attempt + 1}/{self.retries})...")
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        finally:
+            self.local.depth = 0
+            self.session.remove()
+    wrapper.operation = True
+    return wrapper
+
+def cached(*tables):
+    """
+    Decorator of the query methods of HomeMessagesDB whose results can be kept in self.cache (a QueryCache, see query_cache.py).
+    The key of a result is the database, the method and its arguments (with the defaults filled in). A cached result is only 
+    returned while the versions of the months of the given tables in the time range of the query (its start and end arguments) 
+    are unchanged, see data_versions(). The versions are read in the same transaction as the query itself.
+    """
+    def decorate(method):
+        parameters = call_signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.cache is None:
+                return method(self, *args, **kwargs)
+            bound = parameters.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = {name: value for name, value in bound.arguments.items() if name != 'self'}
+            key = (str(self.engine.url), method.__name__, repr(sorted(arguments.items())))
+            versions = self.data_versions(tables, arguments.get('start'), arguments.get('end'))
+            out_df = self.cache.get(key, versions)
+            if out_df is None:
+                out_df = method(self, *args, **kwargs)
+                self.cache.put(key, versions, out_df)
+            return out_df
+        return wrapper
+    return decorate
 
 class HomeMessagesDB:
 
     """
     The class contains methods to initialize the database at the provided address, ingest the data, and query it. 
+    The stages of the insertions (compare_entires, write, rollups) are timed with metrics, a Metrics object 
+    (see instrumentation.py); a new one is created if it is not given. With count_rows=True, the insertion
+    functions also print the number of rows in the table before and after the insertion (see count_rows()). 
+    With snapshot_dir, the query methods read from the Parquet snapshots in that directory when they are up to date
+    (see export_snapshots()). With cache (a QueryCache, see query_cache.py), the results of the query methods are cached,
+    and reused as long as the data they were read from did not change (see cached()).
+    The object can be shared by threads: every thread has its own session, and every call of a public method uses it 
+    for one operation (see operation()). The connections come from a pool of pool_size connections (plus max_overflow 
+    when they are all in use). A SQLite database is switched to write-ahead logging (unless wal=False), so that readers 
+    and a writer do not block each other, and a connection waits up to busy_timeout seconds for a lock. Operations that 
+    still find the database busy are tried again, up to retries times. For asyncio, see AsyncHomeMessagesDB.
+    With household, the database holds the data of that household (see set_household()), and opening the database 
+    of another household fails. For several households, see households.py.
+    The tables and indexes are only checked and created when the models changed since the database was last brought 
+    up to date (see upgrade_schema()), so opening a database takes a few milliseconds.
     """
 
-    def __init__(self, db_url):
-        self.engine = create_engine(db_url)                
-        Base.metadata.create_all(self.engine)              
+    def __init__(self, db_url, metrics=None, count_rows=False, snapshot_dir=None, pool_size=5, max_overflow=10, 
+                 busy_timeout=30, retries=5, wal=True, cache=None, household=None):
+        self.engine = self.make_engine(db_url, pool_size, max_overflow, busy_timeout, wal)
+        self.pool_size = pool_size + max_overflow
+        self.retries = retries
+        self.retry_delay = 0.1
+        self.local = threading.local()
+        self.snapshot_dir = snapshot_dir
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.report_counts = count_rows
         self.Session = sessionmaker(bind=self.engine)      
-        self.session = self.Session()                      
+        # Every thread gets its own session
+        self.session = scoped_session(self.Session)
+        # The tables are only checked when the models changed since the database was last brought up to date
+        if self.stored_schema_version() != SCHEMA_VERSION:
+            self.upgrade_schema()
+        if household is not None:
+            self.set_household(household)
+
+    def stored_schema_version(self):
+        """
+        Helper function that returns the version of the schema recorded in the database, or None (e.g. for a new database)
+        """
+        with self.engine.connect() as conn:
+            if not self.engine.dialect.has_table(conn, 'schema_version'):
+                return None
+            return conn.execute(select(SchemaVersion.version)).scalar()
+
+    def upgrade_schema(self):
+        """
+        Function to bring the tables and indexes of the database up to date with the models: the missing tables and 
+        indexes are created, and the data is moved or derived for the tables that were added to an existing database.
+        The version of the schema is recorded at the end, so that the next HomeMessagesDB objects skip these checks 
+        (an interrupted upgrade is repeated).
+        """
+        tables = inspect(self.engine).get_table_names()
+        new_rollups = 'meter_rollups' not in tables
+        new_catalogue = 'table_months' not in tables
+        # A 'smartthings' table with the old layout is moved aside, so that the new tables can be created
+        legacy = self.rename_legacy_smartthings()
+        Base.metadata.create_all(self.engine)              
+        # create_all() does not add new indexes to tables that already exist, so we make sure they are present
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+        if new_catalogue:
+            # The catalogue was just added to an existing database, so it is filled from the readings
+            self.rebuild_catalogue()
+        if legacy:
+            self.migrate_smartthings()
+        if new_rollups:
+            # The rollup tables were just added to an existing database, so they are filled from the readings
+            self.rebuild_rollups()
+        self.record_schema_version(SCHEMA_VERSION)
+
+    def record_schema_version(self, version):
+        """
+        Helper function that records the version of the schema in the database, or removes it (version None), 
+        so that the next HomeMessagesDB object checks the tables and indexes (see upgrade_schema())
+        """
+        with self.engine.begin() as conn:
+            conn.execute(SchemaVersion.__table__.delete())
+            if version is not None:
+                conn.execute(insert(SchemaVersion).values(version=version))
+
+    @staticmethod
+    def make_engine(db_url, pool_size=5, max_overflow=10, busy_timeout=30, wal=True):
+        """
+        The function creates the engine of the database, with a pool of connections that can be used by several threads
+        """
+        url = make_url(db_url)
+        if url.get_backend_name() != 'sqlite':
+            return create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
+        connect_args = {'timeout': busy_timeout, 'check_same_thread': False}
+        if url.database in (None, '', ':memory:'):
+            # An in-memory database exists only within its connection, so all threads share one
+            return create_engine(url, connect_args=connect_args, poolclass=StaticPool)
+        engine = create_engine(url, connect_args=connect_args, pool_size=pool_size, max_overflow=max_overflow)
+        if wal:
+            # The journal mode is stored in the database file, so this is needed only once
+            with engine.connect() as conn:
+                conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+        return engine
+
+    @staticmethod
+    def is_busy(error):
+        """
+        Helper function that tells whether an error means that the database was busy, so that trying again can succeed
+        """
+        message = str(error.orig).lower()
+        # SQLite locks, and the deadlock and serialization failures of PostgreSQL
+        return ('database is locked' in message or 'database is busy' in message
+                or getattr(error.orig, 'pgcode', None) in ('40001', '40P01'))
 
+    @operation
     def insert_p1e_data(self, input_df,table_name='electricity'):
         """
         The function inserts the data on the electricity consumption into the corresponding table of the database.
         First, it calls the compare_entires() function (described below) to prevent insertion of duplicate records.
-        It then inserts the records in a time-efficient manner.  
+        It then inserts the records in a time-efficient manner, and updates the rollups of the hours and days that received new records.  
+        It returns the number of inserted records, or None if the insertion failed. 
         """
         try: 
-            current_num_rows=self.count_rows(table_name)
-            print(f"Current number of electricity readings: {current_num_rows} are currently in the database table '{table_name}'.")
+            if self.report_counts:
+                current_num_rows=self.count_rows(table_name)
+                print(f"Current number of electricity readings: {current_num_rows} are currently in the database table '{table_name}'.")
             print('Number of candidate rows: ', input_df.shape[0])
-            new_info_df=self.compare_entires(input_df,table_name)
+            with self.metrics.stage('compare_entires', rows_in=input_df.shape[0], table=table_name) as event:
+                new_info_df=self.compare_entires(input_df,table_name)
+                event['rows_out']=new_info_df.shape[0]
 
             print('Completely new rows: ', new_info_df.shape[0])
-            self.session.bulk_insert_mappings(Electricity, new_info_df.to_dict('records'))
-            self.session.commit()      
+            with self.metrics.stage('write', rows_in=new_info_df.shape[0], table=table_name) as event:
+                self.bulk_insert(Electricity, new_info_df)
+                self.count_months(table_name, new_info_df['epoch'])
+                self.mark_changed(table_name, snapshots.month_keys(new_info_df['epoch']))
+                event['rows_out']=new_info_df.shape[0]
             print(f"Successfully inserted {new_info_df.shape[0]} new electricity readings into database.")
+            with self.metrics.stage('rollups', rows_in=new_info_df.shape[0], table=table_name):
+                self.update_meter_rollups(table_name, new_info_df['epoch'])
+                # The readings and their rollups are committed together
+                self.session.commit()
 
-            updated_num_rows=self.count_rows(table_name)
-            print(f"Updated number of electricity readings: {updated_num_rows} are currently in the database table '{table_name}'.")
+            if self.report_counts:
+                updated_num_rows=self.count_rows(table_name)
+                print(f"Updated number of electricity readings: {updated_num_rows} are currently in the database table '{table_name}'.")
+            return new_info_df.shape[0]
         
         except IntegrityError: # Helps to catch the cases with duplicates in keys, for instance
             print('Conflict!')
             self.session.rollback()  # Rollback to prevent that corrupted entries will be inserted
+            return None
 
+    @operation
     def insert_p1g_data(self, input_df,table_name='gas'):
         """
         The function is equivalent to insert_p1e_data() above, and inserts the data on gas usage
         into the corresponding database table.
         """
         try:
-            current_num_rows=self.count_rows(table_name)
-            print(f"Current number of gas readings: {current_num_rows} are currently in the database table '{table_name}'.")
+            if self.report_counts:
+                current_num_rows=self.count_rows(table_name)
+                print(f"Current number of gas readings: {current_num_rows} are currently in the database table '{table_name}'.")
             print('Number of candidate rows: ', input_df.shape[0])
-            new_info_df=self.compare_entires(input_df,table_name)
+            with self.metrics.stage('compare_entires', rows_in=input_df.shape[0], table=table_name) as event:
+                new_info_df=self.compare_entires(input_df,table_name)
+                event['rows_out']=new_info_df.shape[0]
 
             print('Completely new rows: ', new_info_df.shape[0])
-            self.session.bulk_insert_mappings(Gas, new_info_df.to_dict('records'))
-            self.session.commit()     
+            with self.metrics.stage('write', rows_in=new_info_df.shape[0], table=table_name) as event:
+                self.bulk_insert(Gas, new_info_df)
+                self.count_months(table_name, new_info_df['epoch'])
+                self.mark_changed(table_name, snapshots.month_keys(new_info_df['epoch']))
+                event['rows_out']=new_info_df.shape[0]
             print(f"Successfully inserted {new_info_df.shape[0]} new gas readings into database.")
+            with self.metrics.stage('rollups', rows_in=new_info_df.shape[0], table=table_name):
+                self.update_meter_rollups(table_name, new_info_df['epoch'])
+                # The readings and their rollups are committed together
+                self.session.commit()
 
-            updated_num_rows=self.count_rows(table_name)
-            print(f"Updated number of gas readings: {updated_num_rows} are currently in the database table '{table_name}'.")
+            if self.report_counts:
+                updated_num_rows=self.count_rows(table_name)
+                print(f"Updated number of gas readings: {updated_num_rows} are currently in the database table '{table_name}'.")
+            return new_info_df.shape[0]
         except IntegrityError:
             print('Conflict!')
             self.session.rollback()    
+            return None
 
+    @operation
     def insert_smartthings(self,input_df,table_name='smartthings'):
         """
         The function is equivalent to the two insertion functions above, and ingests 
         the data collected by the smart devivces into the corresponding database table. 
+        The input dataframe holds the 'epoch' and 'value' columns and the columns that describe the sensor 
+        ('loc', 'level', 'name', 'capability', 'attribute' and 'unit'); the latter are replaced by a sensor id first.
+        Per sensor and epoch, only the last reading is kept. 
         """
         try:
-            current_num_rows=self.count_rows(table_name)
-            print(f"Current number of smartthings readings: {current_num_rows} are currently in the database table '{table_name}'.")
+            if self.report_counts:
+                current_num_rows=self.count_rows(table_name)
+                print(f"Current number of smartthings readings: {current_num_rows} are currently in the database table '{table_name}'.")
             print('Number of candidate rows: ', input_df.shape[0])
-            new_info_df=self.compare_entires(input_df,table_name)
+            with self.metrics.stage('sensor_ids', rows_in=input_df.shape[0], table=table_name) as event:
+                readings_df=pd.DataFrame({
+                    'sensor_id': self.sensor_ids(input_df),
+                    'epoch': input_df['epoch'].to_numpy(),
+                    'value': input_df['value'].to_numpy(),
+                    'value_num': pd.to_numeric(input_df['value'], errors='coerce').to_numpy()
+                })
+                event['rows_out']=readings_df.shape[0]
+            with self.metrics.stage('dedup', rows_in=readings_df.shape[0], table=table_name) as event:
+                keys=self.reading_keys(readings_df['sensor_id'], readings_df['epoch'])
+                readings_df=readings_df[~pd.Series(keys).duplicated(keep='last').to_numpy()]
+                event['rows_out']=readings_df.shape[0]
+            with self.metrics.stage('compare_entires', rows_in=readings_df.shape[0], table=table_name) as event:
+                new_info_df=self.compare_entires(readings_df,table_name)
+                event['rows_out']=new_info_df.shape[0]
             print('Completely new rows: ', new_info_df.shape[0])
-            self.session.bulk_insert_mappings(SmartThings, new_info_df.to_dict('records'))
-            self.session.commit()     
+            with self.metrics.stage('write', rows_in=new_info_df.shape[0], table=table_name) as event:
+                self.bulk_insert(SmartThings, new_info_df)
+                self.count_months(table_name, new_info_df['epoch'])
+                self.mark_changed(table_name, snapshots.month_keys(new_info_df['epoch']))
+                event['rows_out']=new_info_df.shape[0]
             print(f"Successfully inserted {new_info_df.shape[0]} new smartthings readings into database.")
-            updated_num_rows=self.count_rows(table_name)
-            print(f"Updated number of smartthings readings: {updated_num_rows} are currently in the database table '{table_name}'.")
+            with self.metrics.stage('rollups', rows_in=new_info_df.shape[0], table=table_name):
+                self.update_sensor_rollups(new_info_df['sensor_id'].unique().tolist(), new_info_df['epoch'])
+                # The readings and their rollups are committed together
+                self.session.commit()
+            if self.report_counts:
+                updated_num_rows=self.count_rows(table_name)
+                print(f"Updated number of smartthings readings: {updated_num_rows} are currently in the database table '{table_name}'.")
+            return new_info_df.shape[0]
 
         except IntegrityError:
             print('Conflict!')
             self.session.rollback()  
-        
+            return None
 
-    def count_rows(self, table_name):
+    def bulk_insert(self, model, df, batch_size=50_000):
         """
-        The function enables to retrieve the current number of records in a database table  
+        The function writes the rows of a dataframe into the table of model, within the current transaction of the session
+        (so the caller commits, or rolls back). Instead of creating a dictionary per row and going through the ORM, 
+        the columns are converted to lists of Python values once, and handed to the database driver with executemany(), 
+        in batches of batch_size rows. Missing values are written as NULL.
         """
-        if table_name == 'electricity':
-          return self.session.query(Electricity).count()
-        elif table_name == 'gas':
-          return self.session.query(Gas).count()
-        elif table_name == 'smartthings':
-          return self.session.query(SmartThings).count()
+        if df.shape[0]==0:
+            return
+        dialect=self.engine.dialect
+        columns=list(df.columns)
+
+        # The placeholders of the driver (e.g. ? for sqlite3, %s for psycopg2)
+        paramstyle=dialect.paramstyle
+        if paramstyle=='qmark':
+            placeholders=['?']*len(columns)
+        elif paramstyle in ('format', 'pyformat'):
+            placeholders=['%s']*len(columns)
+        elif paramstyle=='numeric':
+            placeholders=[f':{i + 1}' for i in range(len(columns))]
+        elif paramstyle=='numeric_dollar':
+            placeholders=[f'${i + 1}' for i in range(len(columns))]
         else:
+            placeholders=[f':{col}' for col in columns]
+        sql=(f"INSERT INTO {dialect.identifier_preparer.format_table(model.__table__)} "
+             f"({', '.join(dialect.identifier_preparer.quote(col) for col in columns)}) VALUES ({', '.join(placeholders)})")
+
+        values=[]
+        for col in columns:
+            array=df[col].to_numpy()
+            missing=pd.isna(array)
+            if missing.any():
+                array=np.where(missing, None, array.astype(object))
+            # tolist() turns the numpy values into Python values
+            values.append(array.tolist())
+
+        connection=self.session.connection()
+        for start in range(0, df.shape[0], batch_size):
+            rows=list(zip(*(col_values[start:start + batch_size] for col_values in values)))
+            if paramstyle=='named':
+                rows=[dict(zip(columns, row)) for row in rows]
+            connection.exec_driver_sql(sql, rows)
+
+    @contextmanager
+    def load_mode(self, synchronous='NORMAL'):
+        """
+        Context manager to load a lot of data into a SQLite database faster. Within the block:
+        - the database uses write-ahead logging (WAL), and the connections use the given synchronous setting, 
+          so that not every commit waits for the disk (with NORMAL, a power loss can undo the last commits, 
+          but does not corrupt the database);
+        - the secondary indexes of the readings are dropped, and built once at the end.
+        Afterwards, the previous journal mode and the default synchronous setting are restored, and the indexes are
+        rebuilt, also if the block raised an error. If the process is killed within the block, the schema version 
+        is missing, so the next HomeMessagesDB rebuilds the indexes (see upgrade_schema()). For other databases, nothing changes.
+        """
+        if self.engine.dialect.name!='sqlite':
+            yield
+            return
+
+        self.session.commit()
+        self.session.close()
+        with self.engine.connect() as conn:
+            journal_mode=conn.exec_driver_sql('PRAGMA journal_mode').scalar()
+            conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+        deferred=[index for index in SmartThings.__table__.indexes if not index.unique]
+        # Without a schema version, the next HomeMessagesDB rebuilds the indexes if this process is killed before the end
+        self.record_schema_version(None)
+        for index in deferred:
+            index.drop(self.engine, checkfirst=True)
+
+        # The synchronous setting holds per connection, so the pool is emptied and the new connections get the setting
+        def relaxed(dbapi_connection, connection_record):
+            dbapi_connection.execute(f'PRAGMA synchronous={synchronous}')
+        self.engine.dispose()
+        event.listen(self.engine, 'connect', relaxed)
+
+        try:
+            yield
+            self.session.commit()
+        except BaseException:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.close()
+            event.remove(self.engine, 'connect', relaxed)
+            self.engine.dispose()
+            print("Building the indexes...")
+            for index in deferred:
+                index.create(self.engine, checkfirst=True)
+            self.record_schema_version(SCHEMA_VERSION)
+            if journal_mode.lower()!='wal':
+                with self.engine.connect() as conn:
+                    conn.exec_driver_sql(f'PRAGMA journal_mode={journal_mode}')
+
+    def sensor_ids(self, input_df):
+        """
+        The function returns the sensor id of every row of a dataframe with the columns that describe a sensor.
+        Sensors that are not yet present in the 'sensors' table are added to it. 
+        The rows are grouped by a 64-bit hash of these columns (see sensor_groups()), so that only one row
+        per distinct sensor has to be compared with the 'sensors' table.
+        """
+        codes, first_rows = self.sensor_groups(input_df)
+        # The columns are compared as objects, since a column without any values would be read as floats
+        sensors_df=input_df[SENSOR_COLUMNS].iloc[first_rows].astype(object)
+        current_df=pd.read_sql(self.session.query(Sensor).statement,self.session.connection()).astype({col: object for col in SENSOR_COLUMNS})
+
+        # Add the sensors that are new
+        merged=sensors_df.merge(current_df, on=SENSOR_COLUMNS, how='left')
+        new_sensors=merged.loc[merged['sensor_id'].isna(), SENSOR_COLUMNS].drop_duplicates()
+        if new_sensors.shape[0]!=0:
+            new_sensors=new_sensors.astype(object).where(new_sensors.notna(), None)
+            # Only flushed: the new sensors are committed together with the readings (or rolled back with them)
+            self.session.bulk_insert_mappings(Sensor, new_sensors.to_dict('records'))
+            self.session.flush()
+            current_df=pd.read_sql(self.session.query(Sensor).statement,self.session.connection()).astype({col: object for col in SENSOR_COLUMNS})
+            merged=sensors_df.merge(current_df, on=SENSOR_COLUMNS, how='left')
+
+        # Look up the id of every row, through the id of its group
+        return merged['sensor_id'].to_numpy(dtype='int64')[codes]
+
+    @staticmethod
+    def sensor_groups(input_df):
+        """
+        The function groups the rows of a dataframe by the columns that describe a sensor. It returns the group
+        of every row (as an integer code), and the position of the first row of every group.
+        Every column is turned into integer codes first (categorical columns already have them, others are factorized).
+        The codes of the columns are combined into one 64-bit key per row, which is exact as long as the product 
+        of the numbers of distinct values per column fits in 63 bits. Otherwise, the key is a 64-bit hash of the codes. 
+        Different sensors could then, in theory, get the same hash; this is checked with a second, independent hash, 
+        and if the rows with the same first hash do not all have the same second hash, the rows are grouped on 
+        the values of the columns themselves (which is slower, but exact).
+        """
+        codes_per_column=[]
+        sizes=[]
+        for col in SENSOR_COLUMNS:
+            values=input_df[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                col_codes, size=values.cat.codes.to_numpy(), len(values.cat.categories)
+            else:
+                col_codes, uniques=pd.factorize(values)
+                size=len(uniques)
+            # Missing values have the code -1, so every code is shifted by one
+            codes_per_column.append(col_codes.astype('int64')+1)
+            sizes.append(size+1)
+
+        if np.prod(sizes, dtype='float64') < 2**63:
+            keys=np.zeros(input_df.shape[0], dtype='int64')
+            for col_codes, size in zip(codes_per_column, sizes):
+                keys=keys*size+col_codes
+            codes, uniques=pd.factorize(keys)
+        else:
+            code_df=pd.DataFrame(dict(zip(SENSOR_COLUMNS, codes_per_column)))
+            hashes=pd.util.hash_pandas_object(code_df, index=False).to_numpy()
+            codes, uniques=pd.factorize(hashes)
+            # The collision check: the pairs of both hashes must have as many distinct values as the first hash alone
+            check=pd.util.hash_pandas_object(code_df, index=False, hash_key='energyusage-0001').to_numpy()
+            check_codes, check_uniques=pd.factorize(check)
+            if len(pd.unique(codes.astype('int64')*len(check_uniques)+check_codes))!=len(uniques):
+                codes=code_df.groupby(SENSOR_COLUMNS, sort=False).ngroup().to_numpy()
+                uniques=np.unique(codes)
+
+        # The position of the first row of every group
+        first_rows=np.full(len(uniques), -1, dtype='int64')
+        first_rows[codes[::-1]]=np.arange(len(codes)-1, -1, -1)
+        return codes, first_rows
+
+    @staticmethod
+    def reading_keys(sensor_ids, epochs):
+        """
+        The function packs the sensor id and epoch of every reading into a single int64 key: the sensor id 
+        in the upper 32 bits and the epoch in the lower 32 bits. This is exact (no collisions are possible), as long as 
+        the epochs are between 1970 and 2106, and makes comparing the readings as cheap as comparing integers.
+        """
+        sensor_ids=np.asarray(sensor_ids, dtype='int64')
+        epochs=np.asarray(epochs, dtype='int64')
+        if epochs.size and (epochs.min() < 0 or epochs.max() >= 2**32):
+            raise ValueError("Epochs must be between 1970 and 2106 to be packed into a reading key")
+        return (sensor_ids << 32) | epochs
+
+    @operation
+    def file_manifest(self, source):
+        """
+        Function to retrieve the manifest entries of the files that were ingested by one of the tools ('p1e', 'p1g' or 'smartthings'),
+        as a dictionary keyed by the absolute path of the file
+        """
+        out_query = self.session.query(IngestedFile).filter(IngestedFile.source == source)
+        return {entry.path: entry for entry in out_query}
+
+    @operation
+    def record_files(self, source, records):
+        """
+        Function to add (or update) the manifest entries of the files that were ingested by one of the tools.
+        Each record is a dictionary with the columns of the 'ingested_files' table, except for the source and the ingestion time.
+        """
+        ingested_at = int(time.time())
+        for record in records:
+            self.session.merge(IngestedFile(source=source, ingested_at=ingested_at, **record))
+        self.session.commit()
+
+    @operation
+    def touch_file(self, source, path, mtime):
+        """
+        Function to update the modification time of a manifest entry, for a file of which the content did not change
+        """
+        self.session.query(IngestedFile).filter(
+            and_(IngestedFile.source == source, IngestedFile.path == path)
+        ).update({IngestedFile.mtime: mtime})
+        self.session.commit()
+
+    @operation
+    def tail_entries(self, source):
+        """
+        Function to retrieve how far the growing files of a tool were ingested, as a dictionary of (offset, header) 
+        keyed by the absolute path of the file
+        """
+        out_query = self.session.query(TailedFile).filter(TailedFile.source == source)
+        return {entry.path: (entry.offset, entry.header) for entry in out_query}
+
+    @operation
+    def record_tail(self, source, path, offset, header):
+        """
+        Function to record that a growing file was ingested up to the byte offset
+        """
+        self.session.merge(TailedFile(source=source, path=path, offset=offset, header=header, updated_at=int(time.time())))
+        self.session.commit()
+
+    @operation
+    def count_rows(self, table_name, start=None, end=None):
+        """
+        The function enables to retrieve the current number of records in a database table, optionally only those
+        with start <= epoch <= end (Unix time; either can be left out).
+        The numbers per month in the 'table_months' catalogue are added up, so the cost does not grow with the table.
+        Only the readings of the (at most two) months that are partly in the range are counted in the table itself.
+        """
+        if table_name not in READINGS_TABLES:
           raise ValueError(f"Unknown table: {table_name}")  
+        if start is None and end is None:
+            rows = self.session.query(func.sum(TableMonth.rows)).filter(TableMonth.table_name == table_name).scalar()
+            return int(rows or 0)
+
+        model = READINGS_TABLES[table_name]
+        months_query = self.session.query(TableMonth.month, TableMonth.rows).filter(TableMonth.table_name == table_name)
+        if start is not None:
+            months_query = months_query.filter(TableMonth.month >= snapshots.month_keys([start])[0])
+        if end is not None:
+            months_query = months_query.filter(TableMonth.month <= snapshots.month_keys([end])[0])
+        rows = 0
+        for month, month_rows in months_query:
+            month_start, month_end = snapshots.month_bounds(month)
+            if (start is None or start <= month_start) and (end is None or end >= month_end - 1):
+                rows += month_rows
+            else:
+                # The month is only partly in the range, so its readings in the range are counted
+                rows += self.session.query(func.count()).select_from(model).filter(
+                    model.epoch >= max(month_start, start if start is not None else month_start),
+                    model.epoch <= min(month_end - 1, end if end is not None else month_end - 1)
+                ).scalar()
+        return int(rows)
+
+    def count_months(self, table_name, epochs):
+        """
+        The function adds the given (newly inserted) epochs of a readings table to the numbers per month in the 
+        'table_months' catalogue. It does not commit.
+        """
+        for month, n in snapshots.month_counts(epochs).items():
+            # Incremented by the database, so that concurrent writers do not overwrite each other's counts
+            updated = self.session.query(TableMonth).filter(
+                TableMonth.table_name == table_name, TableMonth.month == month
+            ).update({TableMonth.rows: TableMonth.rows + n}, synchronize_session=False)
+            if updated == 0:
+                self.session.add(TableMonth(table_name=table_name, month=month, rows=n))
+
+    @operation
+    def rebuild_catalogue(self):
+        """
+        Function to (re)count the readings per month of the readings tables into the 'table_months' catalogue,
+        e.g. for a database that was created before the catalogue existed, or after readings were written 
+        to the tables directly. Every month is counted with its own query on the epoch range.
+        """
+        for table_name, model in READINGS_TABLES.items():
+            self.session.query(TableMonth).filter(TableMonth.table_name == table_name).delete(synchronize_session=False)
+            epoch_min, epoch_max = self.session.query(func.min(model.epoch), func.max(model.epoch)).one()
+            if epoch_min is None:
+                continue
+            print(f"Counting the readings of the '{table_name}' table per month...")
+            for month in snapshots.month_range(epoch_min, epoch_max):
+                month_start, month_end = snapshots.month_bounds(month)
+                n = self.session.query(func.count()).select_from(model).filter(
+                    model.epoch >= month_start, model.epoch < month_end
+                ).scalar()
+                if n:
+                    self.session.add(TableMonth(table_name=table_name, month=month, rows=n))
+        self.session.commit()
 
 
     def compare_entires(self,input_df,table_name):
         """
         The function ensures that the database does not contain duplicate records.
-        It retrieves the current records of the database table of interest, and compares their identifiers  
-        (based on either the id or the epoch, depending on the table) to the identifiers of the data to be inserted 
-        in the same table. Only the new records are ingested in the database table.
+        Instead of reading the whole database table, it only retrieves the identifiers (the epoch, together with 
+        the sensor id for smartthings) of the records that fall within the epoch ranges of the data to be inserted
+        (split at the gaps longer than PROBE_GAP, see epoch_ranges()). These are compared to the identifiers of the input data, 
+        and only the new records are ingested in the database table. This way, the time and memory needed depend on 
+        the size of the input, and not on the size of the table or on the time between the oldest and newest input readings.
+        Readings from before the retention cutoff of the table (see apply_retention()) are left out as well, 
+        as those months are only kept in the rollups.
         """
-        # Read in the current records
+        if input_df.shape[0]==0:
+            return input_df
+
+        cutoff=self.retention_cutoff(table_name)
+        if cutoff is not None and int(input_df['epoch'].min())<cutoff:
+            input_df=input_df[input_df['epoch']>=cutoff]
+            if input_df.shape[0]==0:
+                return input_df
+
+        # Only look at the parts of the table covered by the input data: the ranges of its epochs without long gaps,
+        # so that a batch that mixes old and new readings does not read all readings in between
+        ranges=self.epoch_ranges(input_df['epoch'])
+
+        # Read in only the keys of the current records in those ranges
         if table_name == 'electricity':
-            all_entries=self.session.query(Electricity)
+            key_query, epoch=self.session.query(Electricity.epoch), Electricity.epoch
         elif table_name == 'gas':
-            all_entries=self.session.query(Gas)
+            key_query, epoch=self.session.query(Gas.epoch), Gas.epoch
         elif table_name == 'smartthings':
-            all_entries=self.session.query(SmartThings)
+            # The primary key index of (sensor_id, epoch) serves this query
+            key_query=self.session.query(SmartThings.sensor_id, SmartThings.epoch).filter(
+                SmartThings.sensor_id.in_(input_df['sensor_id'].unique().tolist())
+            )
+            epoch=SmartThings.epoch
+        else:
+            raise ValueError(f"Unknown table: {table_name}")
+
+        # The ranges are combined into queries of at most PROBE_RANGES ranges each
+        current_keys=pd.concat([
+            pd.read_sql(key_query.filter(or_(*[epoch.between(first, last) for first, last in ranges[i:i + PROBE_RANGES]])).statement,
+                        self.session.connection())
+            for i in range(0, len(ranges), PROBE_RANGES)
+        ], ignore_index=True)
 
-        current_df=pd.read_sql(all_entries.statement,self.session.bind) 
+        # If there are no records in that range, insert all records
+        if current_keys.shape[0]==0:
+            return input_df
 
         # For smartthings:
         if table_name=='smartthings':
-            if current_df.shape[0]!=0: # If the table is not empty:
-                # Get the unique records in both dataframes
-                unique_current=current_df['id'].unique() #There should be no duplicates; line left as a precaution.
-                unique_input=input_df['id'].unique()
-                # Retrieve the unique identifiers of the current data, and the data to be ingested
-                set_current = set(unique_current)
-                set_input = set(unique_input)
-                unique_to_add=list(set_input.difference(set_current))
-                # Only choose the new rows to be inserted
-                df_to_write=input_df[input_df.id.isin(unique_to_add)]
-            else:
-                df_to_write=input_df # If the table is empty, insert all records.
+            # Only choose the rows with a combination of sensor and epoch that is not yet present,
+            # comparing the combinations as packed integer keys
+            input_keys=self.reading_keys(input_df['sensor_id'], input_df['epoch'])
+            current_keys=self.reading_keys(current_keys['sensor_id'], current_keys['epoch'])
+            df_to_write=input_df[~pd.Series(input_keys).isin(current_keys).to_numpy()]
 
         # For gas and electricity:
-        elif (table_name=='electricity' or table_name=='gas'): 
-            # If there are records in the table:
-            if current_df.shape[0]!=0:
-                # Get the unique records in both dataframes
-                unique_current=current_df['epoch'].unique()
-                unique_input=input_df['epoch'].unique()
-                unique_to_add=np.setdiff1d(unique_input,unique_current)
-                # Filter the input dataframe to only include the unique epochs
-                df_to_write=input_df[input_df.epoch.isin(unique_to_add)]
-            else:
-                df_to_write=input_df
+        else:
+            # Filter the input dataframe to only include the new epochs
+            df_to_write=input_df[~input_df.epoch.isin(current_keys['epoch'].to_numpy())]
 
         return df_to_write
 
-    def query_smartthings(self):
+    @staticmethod
+    def epoch_ranges(epochs, max_gap=PROBE_GAP):
+        """
+        Helper function that splits the epochs into ranges (first, last) of the sorted epochs, at the gaps longer than max_gap seconds
+        """
+        epochs=np.unique(np.asarray(epochs, dtype='int64'))
+        breaks=np.flatnonzero(np.diff(epochs) > max_gap)
+        firsts=epochs[np.concatenate([[0], breaks + 1])]
+        lasts=epochs[np.concatenate([breaks, [epochs.shape[0] - 1]])]
+        return list(zip(firsts.tolist(), lasts.tolist()))
+
+    def update_meter_rollups(self, table_name, epochs):
+        """
+        The function updates the hourly and daily consumption in the 'meter_rollups' table for the buckets that contain
+        the given (newly inserted) epochs of the 'gas' or 'electricity' table. The last reading of each of those buckets is 
+        looked up by the database; the deltas are then recomputed for those buckets and for the first bucket after them,
+        whose delta depends on the last of them.
+        """
+        if len(epochs)==0:
+            return
+        if table_name == 'gas':
+            model, series = Gas, {'gas': Gas.usage}
+        elif table_name == 'electricity':
+            model, series = Electricity, {'T1': Electricity.T1, 'T2': Electricity.T2, 'T1T2': Electricity.T1 + Electricity.T2}
+        else:
+            raise ValueError(f"Unknown table: {table_name}")
+
+        for resolution in RESOLUTIONS.values():
+            first_bucket = int(np.min(epochs)) // resolution * resolution
+            last_bucket = int(np.max(epochs)) // resolution * resolution
+
+            # The last reading per bucket, in the range of the touched buckets
+            bucket = (model.epoch - model.epoch % resolution).label('bucket')
+            last_epochs = self.session.query(bucket, func.max(model.epoch).label('last_epoch')).filter(
+                model.epoch.between(first_bucket, last_bucket + resolution - 1)
+            ).group_by(bucket).subquery()
+            last_query = self.session.query(
+                last_epochs.c.bucket, last_epochs.c.last_epoch, *[column.label(name) for name, column in series.items()]
+            ).join(model, model.epoch == last_epochs.c.last_epoch)
+            last_df = pd.read_sql(last_query.statement, self.session.connection())
+            if last_df.shape[0] == 0:
+                # No readings in these buckets (e.g. a gap in the data), so there is nothing to update
+                continue
+            # A series without any values in these buckets would be read as objects
+            last_df = last_df.astype({name: 'float64' for name in series})
+
+            for name in series:
+                # The neighbouring buckets that are already present
+                previous = self.session.query(MeterRollup).filter(
+                    MeterRollup.series == name, MeterRollup.resolution == resolution, MeterRollup.bucket < first_bucket
+                ).order_by(MeterRollup.bucket.desc()).first()
+                following = self.session.query(MeterRollup).filter(
+                    MeterRollup.series == name, MeterRollup.resolution == resolution, MeterRollup.bucket > last_bucket
+                ).order_by(MeterRollup.bucket).first()
+
+                rollup_df = last_df[['bucket', 'last_epoch', name]].rename(columns={name: 'last_value'})
+                if following is not None:
+                    rollup_df = pd.concat([rollup_df, pd.DataFrame(
+                        {'bucket': [following.bucket], 'last_epoch': [following.last_epoch], 'last_value': [following.last_value]}
+                    )], ignore_index=True)
+                # The delta of the first bucket is relative to the previous bucket, if there is one
+                previous_value = np.nan if previous is None or previous.last_value is None else previous.last_value
+                rollup_df['last_value'] = rollup_df['last_value'].astype('float64')
+                rollup_df['delta'] = rollup_df['last_value'].diff()
+                rollup_df.loc[0, 'delta'] = rollup_df.loc[0, 'last_value'] - previous_value
+
+                # Replace the rollups of the touched buckets and of the following bucket
+                self.session.query(MeterRollup).filter(
+                    MeterRollup.series == name, MeterRollup.resolution == resolution,
+                    MeterRollup.bucket.between(first_bucket, last_bucket if following is None else following.bucket)
+                ).delete(synchronize_session=False)
+                rollup_df['series'] = name
+                rollup_df['resolution'] = resolution
+                self.bulk_insert(MeterRollup, rollup_df)
+                self.mark_changed('meter_rollups', snapshots.month_range(rollup_df['bucket'].min(), rollup_df['bucket'].max()))
+        self.session.commit()
+
+    def update_sensor_rollups(self, sensor_ids, epochs):
         """
-        Function to extract the temperature and humidity readings,
-        produced by the sensor located in the garden, that are present in the database
+        The function updates the hourly and daily statistics in the 'sensor_rollups' table of the temperature and humidity sensors
+        among the given sensors, for the buckets that contain the given (newly inserted) epochs. The statistics are
+        recomputed by the database from the readings of those buckets.
         """
-        out_query = self.session.query(SmartThings).filter(
-            and_(
-                SmartThings.name.like('Garden air (sensor)'),
-                or_(SmartThings.attribute.like('temperature'), SmartThings.attribute.like('humidity'))
+        if len(epochs)==0:
+            return
+        sensor_ids = [row.sensor_id for row in self.session.query(Sensor.sensor_id).filter(
+            Sensor.sensor_id.in_(sensor_ids), Sensor.attribute.in_(ROLLUP_ATTRIBUTES)
+        )]
+        if not sensor_ids:
+            return
+
+        for resolution in RESOLUTIONS.values():
+            first_bucket = int(np.min(epochs)) // resolution * resolution
+            last_bucket = int(np.max(epochs)) // resolution * resolution
+
+            self.session.query(SensorRollup).filter(
+                SensorRollup.sensor_id.in_(sensor_ids), SensorRollup.resolution == resolution,
+                SensorRollup.bucket.between(first_bucket, last_bucket)
+            ).delete(synchronize_session=False)
+
+            bucket = (SmartThings.epoch - SmartThings.epoch % resolution)
+            stats_query = self.session.query(
+                SmartThings.sensor_id, literal(resolution), bucket, func.count(SmartThings.value_num),
+                func.sum(SmartThings.value_num), func.min(SmartThings.value_num), func.max(SmartThings.value_num)
+            ).filter(
+                SmartThings.sensor_id.in_(sensor_ids),
+                SmartThings.epoch.between(first_bucket, last_bucket + resolution - 1),
+                SmartThings.value_num.isnot(None)
+            ).group_by(SmartThings.sensor_id, bucket)
+            self.session.execute(insert(SensorRollup).from_select(
+                ['sensor_id', 'resolution', 'bucket', 'n', 'total', 'min', 'max'], stats_query.statement
+            ))
+            self.mark_changed('sensor_rollups', snapshots.month_range(first_bucket, last_bucket))
+        self.session.commit()
+
+    @operation
+    def rebuild_rollups(self):
+        """
+        Function to (re)compute all rollups from the readings in the database, e.g. for a database that was created 
+        before the rollup tables existed. The work is done per month that has readings (see the 'table_months' catalogue), 
+        to keep the memory use bounded.
+        """
+        for table_name in ['gas', 'electricity']:
+            months = self.catalogue_months(table_name)
+            if not months:
+                continue
+            print(f"Computing the rollups of the '{table_name}' table...")
+            self.session.query(MeterRollup).filter(
+                MeterRollup.series.in_(['gas'] if table_name == 'gas' else ['T1', 'T2', 'T1T2'])
+            ).delete(synchronize_session=False)
+            for month in months:
+                month_start, month_end = snapshots.month_bounds(month)
+                self.update_meter_rollups(table_name, [month_start, month_end - 1])
+
+        sensor_ids = [row.sensor_id for row in self.session.query(Sensor.sensor_id)]
+        months = self.catalogue_months('smartthings')
+        if months:
+            print("Computing the rollups of the 'smartthings' table...")
+            for month in months:
+                month_start, month_end = snapshots.month_bounds(month)
+                self.update_sensor_rollups(sensor_ids, [month_start, month_end - 1])
+
+    def catalogue_months(self, table_name):
+        """
+        Helper function that returns the months ('YYYY-MM') of a readings table that have readings, from the 'table_months' catalogue
+        """
+        return [row.month for row in self.session.query(TableMonth.month).filter(
+            TableMonth.table_name == table_name, TableMonth.rows > 0
+        ).order_by(TableMonth.month)]
+
+    @operation
+    def apply_retention(self, months=None, now=None):
+        """
+        Function to downsample the old readings: the readings of the months before the last 'months' months 
+        (a dictionary per readings table, by default RETENTION_MONTHS; the current month is not counted) are removed 
+        from the database, and only their hourly and daily rollups are kept. Before a month is removed, its rollups 
+        are brought up to date from its readings. The months are removed one at a time, oldest first, each in its 
+        own transaction, so that the database is consistent when the function is interrupted.
+        Afterwards, the readings of the removed months are no longer accepted by the insertion functions, and 
+        query_gas() and query_electricity() return the last reading of every hour for them (from the hourly rollups). 
+        For smartthings, only the rollups of the temperature and humidity remain (see query_sensor_rollups()).
+        This way, the size of the readings tables (and with it the cost of ingesting and querying) does not keep growing. 
+        It returns the number of removed readings per table.
+        """
+        months = RETENTION_MONTHS if months is None else months
+        current = np.datetime64(int(time.time() if now is None else now), 's').astype('datetime64[M]')
+        removed = {}
+        for table_name, keep in months.items():
+            if table_name not in READINGS_TABLES:
+                raise ValueError(f"Unknown table: {table_name}")
+            model = READINGS_TABLES[table_name]
+            cutoff_month = str(current - int(keep))
+            cutoff = snapshots.month_bounds(cutoff_month)[0]
+            old_months = [row.month for row in self.session.query(TableMonth.month).filter(
+                TableMonth.table_name == table_name, TableMonth.month < cutoff_month
+            ).order_by(TableMonth.month)]
+
+            removed[table_name] = 0
+            for month in old_months:
+                month_start, month_end = snapshots.month_bounds(month)
+                # The rollups of the month are made complete before its readings are removed
+                if table_name == 'smartthings':
+                    sensor_ids = [row.sensor_id for row in self.session.query(Sensor.sensor_id)]
+                    self.update_sensor_rollups(sensor_ids, [month_start, month_end - 1])
+                else:
+                    self.update_meter_rollups(table_name, [month_start, month_end - 1])
+                removed[table_name] += self.session.query(model).filter(
+                    model.epoch >= month_start, model.epoch < month_end
+                ).delete(synchronize_session=False)
+                self.session.query(TableMonth).filter(
+                    TableMonth.table_name == table_name, TableMonth.month == month
+                ).delete(synchronize_session=False)
+                self.mark_changed(table_name, [month])
+                self.set_retention_cutoff(table_name, month_end)
+                self.session.commit()
+            # Also the readings that arrive later for the months before the cutoff are not accepted
+            self.set_retention_cutoff(table_name, cutoff)
+            self.session.commit()
+            print(f"Removed {removed[table_name]} '{table_name}' readings from before {cutoff_month} ({len(old_months)} month(s)).")
+
+        if self.engine.dialect.name == 'sqlite' and sum(removed.values()):
+            # Give the space of the removed readings back to the file system
+            with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('VACUUM'))
+        return removed
+
+    def set_retention_cutoff(self, table_name, cutoff):
+        """
+        Helper function that moves the retention cutoff of a table forward to cutoff (Unix time). It does not commit.
+        """
+        current = self.retention_cutoff(table_name)
+        if current is None or cutoff > current:
+            self.session.merge(Retention(table_name=table_name, cutoff=int(cutoff)))
+
+    def retention_cutoff(self, table_name):
+        """
+        Helper function that returns the epoch before which the readings of a table were removed by apply_retention(), or None
+        """
+        return self.session.query(Retention.cutoff).filter(Retention.table_name == table_name).scalar()
+
+    @operation
+    def set_household(self, household, name=None, lat=None, lon=None, tz=None):
+        """
+        The function records the household whose data the database holds, and updates the given details of it.
+        A database holds the data of one household, so it raises a ValueError if it already belongs to another household.
+        """
+        current = self.session.query(Household).first()
+        if current is not None and current.household != household:
+            raise ValueError(f"The database holds the data of household '{current.household}', not of '{household}'.")
+        if current is None:
+            current = Household(household=household, created_at=time.time())
+            self.session.add(current)
+        for field, value in (('name', name), ('lat', lat), ('lon', lon), ('tz', tz)):
+            if value is not None:
+                setattr(current, field, value)
+        self.session.commit()
+
+    @operation
+    def household_info(self):
+        """
+        The function returns the household of the database and its details as a dictionary, or None if it was not recorded.
+        """
+        current = self.session.query(Household).first()
+        if current is None:
+            return None
+        return {column.name: getattr(current, column.name) for column in Household.__table__.columns}
+
+    def rename_legacy_smartthings(self):
+        """
+        Function to detect a 'smartthings' table with the old layout, in which every reading was a row of strings 
+        identified by a long composite string id. Such a table is renamed to 'smartthings_legacy', so that the new tables
+        can be created and the readings can be moved with migrate_smartthings(). It returns True if there is a legacy table 
+        to migrate, which is also the case when an earlier migration was interrupted.
+        """
+        inspector=inspect(self.engine)
+        tables=inspector.get_table_names()
+        if 'smartthings' in tables and 'id' in [col['name'] for col in inspector.get_columns('smartthings')]:
+            with self.engine.begin() as conn:
+                # The epoch index of the old table would clash with the names of the new indexes
+                conn.execute(text('DROP INDEX IF EXISTS ix_smartthings_epoch'))
+                conn.execute(text('ALTER TABLE smartthings RENAME TO smartthings_legacy'))
+            return True
+        return 'smartthings_legacy' in tables
+
+    @operation
+    def migrate_smartthings(self, batch_size=500_000):
+        """
+        Function to move the readings from the 'smartthings_legacy' table to the new layout. The rows are read in batches 
+        (ordered by the old id, so that no cursor stays open while writing), and go through insert_smartthings(), 
+        which assigns the sensor ids and skips the readings that were already migrated. The legacy table is dropped at the end.
+        """
+        print("Migrating the smartthings readings to the new table layout...")
+        batch_query=text(
+            'SELECT id, epoch, loc, level, name, capability, attribute, value, unit FROM smartthings_legacy '
+            'WHERE id > :last_id ORDER BY id LIMIT :batch_size'
+        )
+        last_id=''
+        while True:
+            batch=pd.read_sql(batch_query,self.session.connection(),params={'last_id': last_id, 'batch_size': batch_size})
+            if batch.shape[0]==0:
+                break
+            if self.insert_smartthings(batch) is None:
+                raise RuntimeError("Migration of the smartthings readings failed; the old readings are kept in 'smartthings_legacy'.")
+            last_id=batch['id'].iloc[-1]
+
+        with self.engine.begin() as conn:
+            conn.execute(text('DROP TABLE smartthings_legacy'))
+        if self.engine.dialect.name=='sqlite':
+            # Give the space of the old table back to the file system
+            with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('VACUUM'))
+        print("Migration of the smartthings readings completed.")
+
+    def mark_changed(self, table_name, months):
+        """
+        The function records that the given months ('YYYY-MM') of a table changed, so that their snapshots 
+        are rewritten by the next export_snapshots(), and increases their versions in the 'data_versions' table, 
+        so that the cached query results that cover them are no longer used. It does not commit.
+        """
+        now = time.time()
+        for month in months:
+            self.session.merge(SnapshotMonth(table_name=table_name, month=month, changed_at=now))
+            # Increased by the database, so that concurrent writers do not overwrite each other's versions
+            updated = self.session.query(DataVersion).filter(
+                DataVersion.table_name == table_name, DataVersion.month == month
+            ).update({DataVersion.version: DataVersion.version + 1}, synchronize_session=False)
+            if updated == 0:
+                self.session.add(DataVersion(table_name=table_name, month=month, version=1))
+
+    def data_versions(self, tables, start=None, end=None):
+        """
+        The function returns the versions of the months of the given tables that overlap start <= epoch <= end (Unix time),
+        as a tuple of (table, month, version) tuples. It changes whenever one of these months changes, or a month is added.
+        """
+        versions_query = self.session.query(DataVersion.table_name, DataVersion.month, DataVersion.version).filter(
+            DataVersion.table_name.in_(tables)
+        )
+        if start is not None:
+            versions_query = versions_query.filter(DataVersion.month >= snapshots.month_keys([start])[0])
+        if end is not None:
+            versions_query = versions_query.filter(DataVersion.month <= snapshots.month_keys([end])[0])
+        return tuple(tuple(row) for row in versions_query.order_by(DataVersion.table_name, DataVersion.month))
+
+    @operation
+    def export_snapshots(self, directory=None, full=False):
+        """
+        The function writes the tables of SNAPSHOT_TABLES as monthly Parquet files (and the 'sensors' table as one file)
+        into the directory (by default the snapshot_dir of the class), see snapshots.py. Only the months that changed 
+        since the last export are written, unless full=True or the table was never exported before. 
+        The months are read from the database one at a time, to keep the memory use bounded.
+        It returns the number of months written per table.
+        """
+        directory = directory or self.snapshot_dir
+        if directory is None:
+            raise ValueError("No directory for the snapshots was given")
+        written = {}
+        for table_name, (model, time_column, order) in SNAPSHOT_TABLES.items():
+            started_at = time.time()
+            exported = self.session.query(SnapshotMonth).filter(
+                SnapshotMonth.table_name == table_name, SnapshotMonth.exported_at.isnot(None)
+            ).count()
+            if full or exported == 0 or not os.path.isdir(os.path.join(directory, table_name)):
+                column = getattr(model, time_column)
+                time_min, time_max = self.session.query(func.min(column), func.max(column)).one()
+                months = [] if time_min is None else snapshots.month_range(time_min, time_max)
+            else:
+                months = [row.month for row in self.session.query(SnapshotMonth.month).filter(
+                    SnapshotMonth.table_name == table_name,
+                    or_(SnapshotMonth.exported_at.is_(None), SnapshotMonth.changed_at > SnapshotMonth.exported_at)
+                )]
+
+            for month in months:
+                month_start, month_end = snapshots.month_bounds(month)
+                column = getattr(model, time_column)
+                month_query = self.session.query(model.__table__).filter(
+                    column >= month_start, column < month_end
+                ).order_by(*[getattr(model, col) for col in order])
+                snapshots.write_partition(
+                    snapshots.partition_path(directory, table_name, month), pd.read_sql(month_query.statement, self.session.connection())
+                )
+                self.session.merge(SnapshotMonth(table_name=table_name, month=month, exported_at=started_at))
+            self.session.commit()
+            written[table_name] = len(months)
+
+        sensors_df = pd.read_sql(self.session.query(Sensor.__table__).order_by(Sensor.sensor_id).statement, self.session.connection())
+        snapshots.write_partition(snapshots.partition_path(directory, 'sensors'), sensors_df)
+        print(f"Exported the snapshots to {directory}: " + ', '.join(f"{n} month(s) of '{name}'" for name, n in written.items()))
+        return written
+
+    def use_snapshot(self, table_name, from_snapshot=None):
+        """
+        Helper function that decides whether a query method reads the table from the snapshots: always with from_snapshot=True,
+        never with from_snapshot=False, and by default (None) if there is a snapshot_dir and the snapshot of the table 
+        is up to date (no month changed since it was exported).
+        """
+        if from_snapshot is not None:
+            if from_snapshot and self.snapshot_dir is None:
+                raise ValueError("The class was created without a snapshot_dir")
+            return from_snapshot
+        if self.snapshot_dir is None or not os.path.isdir(os.path.join(self.snapshot_dir, table_name)):
+            return False
+        stale = self.session.query(SnapshotMonth.month).filter(
+            SnapshotMonth.table_name == table_name,
+            or_(SnapshotMonth.exported_at.is_(None), SnapshotMonth.changed_at > SnapshotMonth.exported_at)
+        ).first()
+        return stale is None
+
+    def snapshot_frame(self, table_name, columns, start=None, end=None, filters=None):
+        """
+        Helper function that reads the given columns of a table from its snapshot, optionally only the rows with 
+        start <= time <= end and that pass the filters (see snapshots.read_partitions())
+        """
+        time_column = SNAPSHOT_TABLES[table_name][1] if table_name in SNAPSHOT_TABLES else None
+        out_df = snapshots.read_partitions(self.snapshot_dir, table_name, columns, start, end, time_column, filters)
+        if out_df is None:
+            return pd.DataFrame(columns=columns)
+        return out_df[columns]
+
+    @operation
+    @cached('smartthings')
+    def query_smartthings(self, start=None, end=None, name='Garden air (sensor)', attribute=('temperature', 'humidity'), columns=None, from_snapshot=None):
+        """
+        Function to extract smartthings readings from the database. By default, the temperature and humidity readings
+        produced by the sensor located in the garden are returned. All filters are applied by the database:
+        - start, end: only readings with start <= epoch <= end (Unix time; either can be left out)
+        - name, attribute: a device name and attribute, or a list of them (None to not filter on it)
+        - columns: the columns to return (by default: epoch, loc, level, name, capability, attribute, value, value_num and unit)
+        The sensors that match are looked up first, so that the readings are retrieved through the (sensor_id, epoch) primary key.
+        - from_snapshot: read the readings from the Parquet snapshot instead of the database (see use_snapshot())
+        """
+        available = {
+            'sensor_id': SmartThings.sensor_id, 'epoch': SmartThings.epoch, 'loc': Sensor.loc, 'level': Sensor.level,
+            'name': Sensor.name, 'capability': Sensor.capability, 'attribute': Sensor.attribute,
+            'value': SmartThings.value, 'value_num': SmartThings.value_num, 'unit': Sensor.unit
+        }
+        if columns is None:
+            columns = ['epoch', 'loc', 'level', 'name', 'capability', 'attribute', 'value', 'value_num', 'unit']
+
+        # Find the sensors of interest
+        sensor_filters = []
+        if name is not None:
+            sensor_filters.append(Sensor.name.in_([name] if isinstance(name, str) else list(name)))
+        if attribute is not None:
+            sensor_filters.append(Sensor.attribute.in_([attribute] if isinstance(attribute, str) else list(attribute)))
+        sensor_ids = [row.sensor_id for row in self.session.query(Sensor.sensor_id).filter(*sensor_filters)]
+
+        if self.use_snapshot('smartthings', from_snapshot):
+            self.select_columns(available, columns)
+            reading_columns = ['sensor_id', 'epoch'] + [col for col in columns if col in ('value', 'value_num')]
+            out_df = self.snapshot_frame('smartthings', reading_columns, start, end, [('sensor_id', 'in', sensor_ids)])
+            out_df = out_df.sort_values(['sensor_id', 'epoch'], kind='stable', ignore_index=True)
+            sensor_columns = [col for col in columns if col in SENSOR_COLUMNS]
+            if sensor_columns:
+                sensors_df = self.snapshot_frame('sensors', ['sensor_id'] + sensor_columns)
+                out_df = out_df.merge(sensors_df, on='sensor_id', how='left')
+            return out_df[columns]
+
+        filters = [SmartThings.sensor_id.in_(sensor_ids)] + self.epoch_filters(SmartThings.epoch, start, end)
+        out_query = self.session.query(*self.select_columns(available, columns)).select_from(SmartThings)
+        if any(available[col].class_ is Sensor for col in columns):
+            out_query = out_query.join(Sensor, SmartThings.sensor_id == Sensor.sensor_id)
+        out_query = out_query.filter(*filters).order_by(SmartThings.sensor_id, SmartThings.epoch)
+        out_df=pd.read_sql(out_query.statement, self.session.connection())
+
+        return out_df
+
+    @operation
+    @cached('gas')
+    def query_gas(self, start=None, end=None, columns=None, from_snapshot=None, downsampled=True):
+        """
+        Function to extract the gas readings that are present in the database, optionally only those with 
+        start <= epoch <= end (Unix time), and only the given columns (by default: epoch and usage).
+        With from_snapshot, the readings are read from the Parquet snapshot instead (see use_snapshot()).
+        With downsampled, the months whose readings were removed by apply_retention() are represented 
+        by the last reading of every hour (see downsampled_readings()).
+        """
+        available = {'epoch': Gas.epoch, 'usage': Gas.usage}
+        if self.use_snapshot('gas', from_snapshot):
+            self.select_columns(available, columns or list(available))
+            out_df = self.snapshot_frame('gas', columns or list(available), start, end)
+        else:
+            out_query = self.session.query(*self.select_columns(available, columns or list(available)))
+            out_query = out_query.filter(*self.epoch_filters(Gas.epoch, start, end)).order_by(Gas.epoch)
+            out_df=pd.read_sql(out_query.statement, self.session.connection())
+
+        if downsampled:
+            old_df = self.downsampled_readings('gas', start, end, from_snapshot)
+            if old_df is not None:
+                old_df = old_df.rename(columns={'gas': 'usage'})
+                out_df = pd.concat([old_df[list(out_df.columns)], out_df], ignore_index=True)
+
+        return out_df
+
+    @operation
+    @cached('electricity')
+    def query_electricity(self, start=None, end=None, columns=None, from_snapshot=None, downsampled=True):
+        """
+        Function to extract the electricity readings that are present in the database, optionally only those with 
+        start <= epoch <= end (Unix time), and only the given columns (by default: epoch, T1 and T2).
+        With from_snapshot, the readings are read from the Parquet snapshot instead (see use_snapshot()).
+        With downsampled, the months whose readings were removed by apply_retention() are represented 
+        by the last reading of every hour (see downsampled_readings()).
+        """
+        available = {'epoch': Electricity.epoch, 'T1': Electricity.T1, 'T2': Electricity.T2}
+        if self.use_snapshot('electricity', from_snapshot):
+            self.select_columns(available, columns or list(available))
+            out_df = self.snapshot_frame('electricity', columns or list(available), start, end)
+        else:
+            out_query = self.session.query(*self.select_columns(available, columns or list(available)))
+            out_query = out_query.filter(*self.epoch_filters(Electricity.epoch, start, end)).order_by(Electricity.epoch)
+            out_df=pd.read_sql(out_query.statement, self.session.connection())
+
+        if downsampled:
+            old_df = self.downsampled_readings('electricity', start, end, from_snapshot)
+            if old_df is not None:
+                out_df = pd.concat([old_df[list(out_df.columns)], out_df], ignore_index=True)
+
+        return out_df
+
+    def downsampled_readings(self, table_name, start=None, end=None, from_snapshot=None):
+        """
+        Helper function that returns what is left of the 'gas' or 'electricity' readings from before the retention cutoff 
+        of the table (see apply_retention()), optionally only with start <= epoch <= end: the last reading of every hour, 
+        from the hourly rollups. The dataframe has the columns epoch and 'gas', or epoch, 'T1' and 'T2'.
+        It returns None if no readings were removed from the table, or if the time range starts after the cutoff.
+        With from_snapshot, the rollups are read from the Parquet snapshot instead (see use_snapshot()).
+        """
+        cutoff = self.retention_cutoff(table_name)
+        if cutoff is None or (start is not None and int(start) >= cutoff):
+            return None
+        end = cutoff - 1 if end is None else min(int(end), cutoff - 1)
+        series = ['gas'] if table_name == 'gas' else ['T1', 'T2']
+        resolution = RESOLUTIONS['hour']
+
+        if self.use_snapshot('meter_rollups', from_snapshot):
+            # The snapshot is filtered on the buckets, which start at most an hour before their last reading
+            rollup_df = self.snapshot_frame('meter_rollups', ['series', 'last_epoch', 'last_value'],
+                                            None if start is None else int(start) - resolution + 1, end, [
+                ('series', 'in', series), ('resolution', '==', resolution)
+            ])
+        else:
+            rollup_query = self.session.query(MeterRollup.series, MeterRollup.last_epoch, MeterRollup.last_value).filter(
+                MeterRollup.series.in_(series), MeterRollup.resolution == resolution,
+                *self.epoch_filters(MeterRollup.last_epoch, start, end)
             )
+            rollup_df = pd.read_sql(rollup_query.statement, self.session.connection())
+        rollup_df = rollup_df[rollup_df['last_epoch'].between(-np.inf if start is None else int(start), end)]
+
+        # T1 and T2 of an hour come from the same reading, so they share the epoch
+        out_df = rollup_df.pivot(index='last_epoch', columns='series', values='last_value').reindex(columns=series)
+        out_df.columns.name = None
+        out_df = out_df.reset_index().rename(columns={'last_epoch': 'epoch'})
+        return out_df.astype({'epoch': 'int64', **{name: 'float64' for name in series}})
+
+    @staticmethod
+    def epoch_filters(epoch_column, start=None, end=None):
+        """
+        Helper function that turns the optional start and end of a time range into filters on an epoch column
+        """
+        filters = []
+        if start is not None:
+            filters.append(epoch_column >= int(start))
+        if end is not None:
+            filters.append(epoch_column <= int(end))
+        return filters
+
+    @staticmethod
+    def select_columns(available, columns):
+        """
+        Helper function that looks up the requested columns in a dictionary of the columns that a query method offers
+        """
+        unknown = [col for col in columns if col not in available]
+        if unknown:
+            raise ValueError(f"Unknown column(s): {unknown}. Available columns: {list(available)}")
+        return [available[col].label(col) for col in columns]
+
+    @operation
+    @cached('meter_rollups')
+    def query_meter_rollups(self, series=('gas', 'T1T2'), resolution='hour', start=None, end=None, from_snapshot=None):
+        """
+        Function to extract the hourly or daily consumption from the 'meter_rollups' table, for the given series 
+        ('gas', 'T1', 'T2' and/or 'T1T2') and optionally only for the buckets with start <= bucket <= end (Unix time).
+        It returns a dataframe with the start of the bucket and one column with the consumption per series.
+        With from_snapshot, the rollups are read from the Parquet snapshot instead (see use_snapshot()).
+        """
+        series = [series] if isinstance(series, str) else list(series)
+        if self.use_snapshot('meter_rollups', from_snapshot):
+            out_df = self.snapshot_frame('meter_rollups', ['bucket', 'series', 'delta'], start, end, [
+                ('series', 'in', series), ('resolution', '==', RESOLUTIONS[resolution])
+            ])
+            out_df = out_df.pivot(index='bucket', columns='series', values='delta').reindex(columns=series)
+            out_df.columns.name = None
+            return out_df.reset_index()
+
+        out_query = self.session.query(MeterRollup.bucket, MeterRollup.series, MeterRollup.delta).filter(
+            MeterRollup.series.in_(series), MeterRollup.resolution == RESOLUTIONS[resolution],
+            *self.epoch_filters(MeterRollup.bucket, start, end)
         )
-        out_df=pd.read_sql(out_query.statement,self.session.bind) 
+        out_df = pd.read_sql(out_query.statement, self.session.connection())
+        out_df = out_df.pivot(index='bucket', columns='series', values='delta').reindex(columns=series)
+        out_df.columns.name = None
+
+        return out_df.reset_index()
+
+    @operation
+    @cached('sensor_rollups')
+    def query_sensor_rollups(self, name='Garden air (sensor)', attribute=('temperature', 'humidity'), resolution='hour', start=None, end=None,
+                             from_snapshot=None):
+        """
+        Function to extract the hourly or daily minimum, mean and maximum of the temperature and humidity readings
+        from the 'sensor_rollups' table, for the given device name(s) and attribute(s), and optionally only for 
+        the buckets with start <= bucket <= end (Unix time).
+        With from_snapshot, the rollups are read from the Parquet snapshot instead (see use_snapshot()).
+        """
+        sensor_filters = []
+        if name is not None:
+            sensor_filters.append(Sensor.name.in_([name] if isinstance(name, str) else list(name)))
+        if attribute is not None:
+            sensor_filters.append(Sensor.attribute.in_([attribute] if isinstance(attribute, str) else list(attribute)))
+
+        if self.use_snapshot('sensor_rollups', from_snapshot):
+            sensor_ids = [row.sensor_id for row in self.session.query(Sensor.sensor_id).filter(*sensor_filters)]
+            out_df = self.snapshot_frame('sensor_rollups', ['sensor_id', 'bucket', 'n', 'total', 'min', 'max'], start, end, [
+                ('sensor_id', 'in', sensor_ids), ('resolution', '==', RESOLUTIONS[resolution])
+            ])
+            out_df = out_df.merge(self.snapshot_frame('sensors', ['sensor_id', 'name', 'attribute']), on='sensor_id')
+            out_df['mean'] = out_df['total'] / out_df['n']
+            out_df = out_df.sort_values(['name', 'attribute', 'bucket'], kind='stable', ignore_index=True)
+            return out_df[['bucket', 'name', 'attribute', 'n', 'min', 'mean', 'max']]
+        out_query = self.session.query(
+            SensorRollup.bucket, Sensor.name, Sensor.attribute, SensorRollup.n, SensorRollup.min,
+            (SensorRollup.total / SensorRollup.n).label('mean'), SensorRollup.max
+        ).join(Sensor, SensorRollup.sensor_id == Sensor.sensor_id).filter(
+            SensorRollup.resolution == RESOLUTIONS[resolution], *sensor_filters,
+            *self.epoch_filters(SensorRollup.bucket, start, end)
+        ).order_by(Sensor.name, Sensor.attribute, SensorRollup.bucket)
+        out_df = pd.read_sql(out_query.statement, self.session.connection())
+
+        return out_df
+
+    @staticmethod
+    def weather_location(lat, lon):
+        """
+        Helper function that rounds a location to 4 decimals (about 10 m), so that the same place is always stored under the same key
+        """
+        return round(float(lat), 4), round(float(lon), 4)
+
+    @operation
+    def weather_gaps(self, lat, lon, start, end):
+        """
+        Function to find the parts of the time range start <= epoch < end (Unix time) for which the weather 
+        at a location was not retrieved yet. It returns a list of (start, end) tuples, in the order of time.
+        """
+        lat, lon = self.weather_location(lat, lon)
+        covered = self.session.query(WeatherCoverage).filter(
+            WeatherCoverage.lat == lat, WeatherCoverage.lon == lon,
+            WeatherCoverage.start < end, WeatherCoverage.end > start
+        ).order_by(WeatherCoverage.start)
+
+        gaps = []
+        cursor = start
+        for entry in covered:
+            if entry.start > cursor:
+                gaps.append((cursor, entry.start))
+            cursor = max(cursor, entry.end)
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    @operation
+    def insert_weather(self, lat, lon, weather_df, start, end):
+        """
+        Function to store the hourly weather (a dataframe with the columns epoch, temperature and humidity) at a location,
+        that was retrieved for the time range start <= epoch < end, and to record that range as covered.
+        The rows that were stored before for this range are replaced.
+        """
+        lat, lon = self.weather_location(lat, lon)
+        try:
+            self.session.query(Weather).filter(
+                Weather.lat == lat, Weather.lon == lon, Weather.epoch >= start, Weather.epoch < end
+            ).delete(synchronize_session=False)
+            self.bulk_insert(Weather, weather_df[['epoch', 'temperature', 'humidity']].assign(lat=lat, lon=lon))
+
+            # The new range is merged with the covered ranges that it overlaps or touches
+            touching = self.session.query(WeatherCoverage).filter(
+                WeatherCoverage.lat == lat, WeatherCoverage.lon == lon,
+                WeatherCoverage.start <= end, WeatherCoverage.end >= start
+            ).all()
+            merged_start = min([start] + [entry.start for entry in touching])
+            merged_end = max([end] + [entry.end for entry in touching])
+            for entry in touching:
+                self.session.delete(entry)
+            self.session.flush()
+            self.session.add(WeatherCoverage(lat=lat, lon=lon, start=merged_start, end=merged_end))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    @operation
+    def query_weather(self, lat, lon, start=None, end=None):
+        """
+        Function to extract the stored hourly weather at a location, optionally only for start <= epoch <= end (Unix time)
+        """
+        lat, lon = self.weather_location(lat, lon)
+        out_query = self.session.query(Weather.epoch, Weather.temperature, Weather.humidity).filter(
+            Weather.lat == lat, Weather.lon == lon, *self.epoch_filters(Weather.epoch, start, end)
+        ).order_by(Weather.epoch)
+        out_df = pd.read_sql(out_query.statement, self.session.connection())
 
         return out_df
 
-    def query_gas(self):
+    @operation
+    def query_aligned(self, start, end, freq='1h', tz='UTC', series=None, lat=52.23, lon=4.45, tolerance=3600, chunk_days=31):
         """
-        Function to extract all gas readings, that are present in the database
+        Function to extract energy, sensor and weather series aligned to the same buckets of size freq, aligned to the 
+        local time of tz (see meter.bucket_edges()), that cover start <= epoch <= end (Unix time).
+        series is a dictionary of the output columns and their (source, series, how), by default ALIGNED_SERIES:
+        - ('meter', 'gas' / 'T1' / 'T2' / 'T1T2', 'sum'): the consumption in the bucket, see meter.consumption(),
+          or with 'asof': the meter reading at the start of the bucket;
+        - ('sensor', (name, attribute), 'mean' / 'min' / 'max' / 'count'): the statistics of the readings in the bucket, 
+          combined from the hourly sensor rollups when the buckets consist of whole hours, and else grouped by the database;
+        - ('weather', 'temperature' / 'humidity', 'asof' / 'mean' / 'min' / 'max'): the stored weather at lat, lon 
+          (see openweathermap.weather(); nothing is retrieved here).
+        As-of values come from the last reading at most tolerance seconds before the start of the bucket.
+        The buckets are computed in chunks of chunk_days, so that only the readings of one chunk are in memory at a time.
+        It returns a dataframe indexed by the (time zone aware) start of the bucket, with the bucket start in Unix time ('bucket') 
+        and a column per series.
         """
-        out_query = self.session.query(Gas)
-        out_df=pd.read_sql(out_query.statement,self.session.bind) 
+        series = ALIGNED_SERIES if series is None else series
+        for column, (source, what, how) in series.items():
+            if source not in ALIGNED_HOW:
+                raise ValueError(f"Unknown source of '{column}': {source}. Available sources: {list(ALIGNED_HOW)}")
+            if how not in ALIGNED_HOW[source]:
+                raise ValueError(f"'{column}' cannot be aligned with '{how}'. Use one of: {list(ALIGNED_HOW[source])}")
+
+        frames = []
+        # The edges reach past end, so that the bucket of end is included
+        for edges in align.chunk_edges(meter.bucket_edges(start, int(end) + 1, freq, tz), chunk_days * 86400):
+            out = {'bucket': edges[:-1]}
+            for column, (source, what, how) in series.items():
+                if source == 'meter':
+                    out[column] = self.aligned_meter(edges, what, how, freq, tz, tolerance)
+                elif source == 'sensor':
+                    out[column] = self.aligned_sensor(edges, what, how)
+                else:
+                    out[column] = self.aligned_weather(edges, what, how, lat, lon, tolerance)
+            frames.append(pd.DataFrame(out))
+
+        out_df = pd.concat(frames, ignore_index=True)
+        out_df.index = pd.DatetimeIndex(pd.to_datetime(out_df['bucket'], unit='s', utc=True).dt.tz_convert(tz), name='time')
 
         return out_df
-    def query_electricity(self):
+
+    def aligned_meter(self, edges, what, how, freq, tz, tolerance):
+        """
+        Helper function of query_aligned() for a meter series in the buckets between the edges
+        """
+        if what == 'gas':
+            model, columns = Gas, {'gas': Gas.usage}
+        elif what in ('T1', 'T2', 'T1T2'):
+            model, columns = Electricity, {name: getattr(Electricity, name) for name in ('T1', 'T2') if name in what}
+        else:
+            raise ValueError(f"Unknown meter series: {what}. Use 'gas', 'T1', 'T2' or 'T1T2'")
+
+        # The readings in the chunk, and the ones right before and after it, so that the consumption 
+        # at the edges can be interpolated and the as-of value of the first bucket is known
+        table_name = 'gas' if what == 'gas' else 'electricity'
+        before = self.session.query(func.max(model.epoch)).filter(model.epoch < int(edges[0])).scalar()
+        after = self.session.query(func.min(model.epoch)).filter(model.epoch > int(edges[-1])).scalar()
+        if self.retention_cutoff(table_name) is not None:
+            # Before the retention cutoff, the hourly last readings of the rollups stand in for the removed readings
+            last_epochs = self.session.query(MeterRollup.last_epoch).filter(
+                MeterRollup.series == ('gas' if what == 'gas' else 'T1'), MeterRollup.resolution == RESOLUTIONS['hour']
+            )
+            if before is None:
+                before = last_epochs.filter(MeterRollup.last_epoch < int(edges[0])).with_entities(func.max(MeterRollup.last_epoch)).scalar()
+            if after is None:
+                after = last_epochs.filter(MeterRollup.last_epoch > int(edges[-1])).with_entities(func.min(MeterRollup.last_epoch)).scalar()
+        first, last = int(edges[0]) if before is None else before, int(edges[-1]) if after is None else after
+        readings_query = self.session.query(model.epoch, *[column.label(name) for name, column in columns.items()]).filter(
+            model.epoch.between(first, last)
+        ).order_by(model.epoch)
+        readings = pd.read_sql(readings_query.statement, self.session.connection())
+        old_readings = self.downsampled_readings(table_name, first, last, from_snapshot=False)
+        if old_readings is not None:
+            readings = pd.concat([old_readings[['epoch', *columns]], readings], ignore_index=True)
+
+        if how == 'asof':
+            values = readings[list(columns)].sum(axis=1, min_count=len(columns))
+            return align.asof(readings['epoch'].to_numpy(), values.to_numpy(), edges[:-1], tolerance)
+        if readings.shape[0] == 0:
+            return np.full(edges.shape[0] - 1, np.nan)
+        # Each counter gets its own consumption (with its own resets), T1T2 is their sum
+        consumption = meter.consumption(readings, list(columns), freq, tz)
+        values = consumption.set_index('bucket')[list(columns)].sum(axis=1, min_count=len(columns))
+        return values.reindex(edges[:-1]).to_numpy(dtype='float64')
+
+    def aligned_sensor(self, edges, what, how):
         """
-        Function to extract all electricity readings, that are present in the database
+        Helper function of query_aligned() for the readings of a sensor (name, attribute) in the buckets between the edges
         """
-        out_query = self.session.query(Electricity)
-        out_df=pd.read_sql(out_query.statement,self.session.bind) 
+        name, attribute = what
+        sensor_ids = [row.sensor_id for row in self.session.query(Sensor.sensor_id).filter(
+            Sensor.name == name, Sensor.attribute == attribute
+        )]
+        if attribute in ROLLUP_ATTRIBUTES and not np.any(edges % RESOLUTIONS['hour']):
+            # The buckets consist of whole hours, so the hourly rollups can be combined
+            partial_query = self.session.query(
+                SensorRollup.bucket, SensorRollup.n, SensorRollup.total, SensorRollup.min, SensorRollup.max
+            ).filter(
+                SensorRollup.sensor_id.in_(sensor_ids), SensorRollup.resolution == RESOLUTIONS['hour'],
+                SensorRollup.bucket >= int(edges[0]), SensorRollup.bucket < int(edges[-1])
+            )
+        else:
+            # The database groups the readings by the largest bucket size that fits all edges
+            size = int(np.gcd.reduce(edges))
+            bucket = (SmartThings.epoch - SmartThings.epoch % size).label('bucket')
+            partial_query = self.session.query(
+                bucket, func.count(SmartThings.value_num).label('n'), func.sum(SmartThings.value_num).label('total'),
+                func.min(SmartThings.value_num).label('min'), func.max(SmartThings.value_num).label('max')
+            ).filter(
+                SmartThings.sensor_id.in_(sensor_ids), SmartThings.value_num.isnot(None),
+                SmartThings.epoch >= int(edges[0]), SmartThings.epoch < int(edges[-1])
+            ).group_by(SmartThings.sensor_id, bucket)
+        partial = pd.read_sql(partial_query.statement, self.session.connection())
+
+        return align.combine(edges, partial['bucket'].to_numpy(), partial['n'].to_numpy(), partial['total'].to_numpy(),
+                             partial['min'].to_numpy(), partial['max'].to_numpy(), how)
+
+    def aligned_weather(self, edges, what, how, lat, lon, tolerance):
+        """
+        Helper function of query_aligned() for the stored hourly weather in the buckets between the edges
+        """
+        if what not in ('temperature', 'humidity'):
+            raise ValueError(f"Unknown weather series: {what}. Use 'temperature' or 'humidity'")
+        weather_df = self.query_weather(lat, lon, int(edges[0]) - tolerance, int(edges[-1]) - 1)
+        if how == 'asof':
+            return align.asof(weather_df['epoch'].to_numpy(), weather_df[what].to_numpy(), edges[:-1], tolerance)
+        return align.aggregate(edges, weather_df['epoch'].to_numpy(), weather_df[what].to_numpy(), how)
+
+    def local_time(self, epoch_column, start, end, tz='UTC'):
+        """
+        Helper function that returns an SQL expression for the local time of tz of an epoch column (the Unix time shifted 
+        by the UTC offset), valid for start <= epoch <= end. The offsets are passed to the database as a CASE over the 
+        moments at which they change (see align.utc_offsets()), so the database can group by local hours and days.
+        """
+        starts, offsets = align.utc_offsets(start, end, tz)
+        if offsets.shape[0] == 1:
+            return epoch_column + int(offsets[0])
+        return epoch_column + case(
+            *[(epoch_column < int(change), int(offset)) for change, offset in zip(starts[1:], offsets[:-1])], else_=int(offsets[-1])
+        )
+
+    def rollup_range(self, series, start=None, end=None):
+        """
+        Helper function that completes a time range with the first and the last bucket of the hourly meter rollups of the series.
+        The start and end are None if there are no rollups.
+        """
+        if start is None or end is None:
+            first, last = self.session.query(func.min(MeterRollup.bucket), func.max(MeterRollup.bucket)).filter(
+                MeterRollup.series.in_(series), MeterRollup.resolution == RESOLUTIONS['hour']
+            ).one()
+            start = first if start is None else start
+            end = last if end is None else end
+        return start, end
+
+    def hourly_usage_filters(self, series, start, end):
+        """
+        Helper function that returns the filters on the hourly meter rollups of the series with start <= bucket <= end 
+        that have a consumption; negative consumption (a reset of the meter) is left out
+        """
+        return [MeterRollup.series.in_(series), MeterRollup.resolution == RESOLUTIONS['hour'],
+                MeterRollup.bucket.between(int(start), int(end)), MeterRollup.delta >= 0]
+
+    @operation
+    @cached('meter_rollups')
+    def usage_profile(self, by='hour', series=('gas', 'T1T2'), start=None, end=None, tz='UTC'):
+        """
+        Function to compute the average hourly consumption per hour of the day (by='hour', 0 to 23) or per day of the week
+        (by='weekday', 0 is Monday) in the local time of tz, from the hourly consumption in the 'meter_rollups' table of
+        the given series, optionally only for the hours with start <= bucket <= end (Unix time). The sums and counts per 
+        group are computed by the database, so only a few rows are read whatever the size of the table.
+        It returns a dataframe with a row per group, and per series the average consumption and the number of hours
+        it is based on ('<series>_n'), so that the profiles of several databases can be combined.
+        """
+        if by not in PROFILE_GROUPS:
+            raise ValueError(f"Unknown profile: {by}. Use one of: {list(PROFILE_GROUPS)}")
+        series = [series] if isinstance(series, str) else list(series)
+        n_groups, group_of = PROFILE_GROUPS[by]
+
+        start, end = self.rollup_range(series, start, end)
+        stats_df = pd.DataFrame(columns=['series', 'group', 'n', 'total'])
+        if start is not None:
+            group = group_of(self.local_time(MeterRollup.bucket, start, end, tz)).label('group')
+            stats_query = self.session.query(
+                MeterRollup.series, group, func.count(MeterRollup.delta).label('n'), func.sum(MeterRollup.delta).label('total')
+            ).filter(*self.hourly_usage_filters(series, start, end)).group_by(MeterRollup.series, group)
+            stats_df = pd.read_sql(stats_query.statement, self.session.connection())
+
+        out_df = pd.DataFrame({by: np.arange(n_groups)})
+        if by == 'weekday':
+            out_df['day_name'] = WEEKDAY_NAMES
+        for name in series:
+            part = stats_df[stats_df['series'] == name].set_index('group')
+            n = part['n'].reindex(out_df[by]).astype('float64').fillna(0).to_numpy(dtype='int64')
+            total = part['total'].reindex(out_df[by]).to_numpy(dtype='float64')
+            out_df[name] = np.where(n > 0, total / np.maximum(n, 1), np.nan)
+            out_df[f'{name}_n'] = n
 
         return out_df
 
+    @operation
+    @cached('meter_rollups')
+    def daily_usage(self, series=('gas', 'T1T2'), start=None, end=None, tz='UTC'):
+        """
+        Function to compute the consumption per day, in the local time of tz, of the given series: the sum of the hourly 
+        consumption in the 'meter_rollups' table, computed by the database, optionally only for the hours with 
+        start <= bucket <= end (Unix time). Negative consumption (a reset of the meter) is left out.
+        It returns a dataframe with the (local) date and a column per series; days without data of a series get NaN.
+        """
+        series = [series] if isinstance(series, str) else list(series)
+        start, end = self.rollup_range(series, start, end)
+        if start is None:
+            return pd.DataFrame(columns=['date', *series])
+
+        day = (self.local_time(MeterRollup.bucket, start, end, tz) // 86400).label('day')
+        daily_query = self.session.query(MeterRollup.series, day, func.sum(MeterRollup.delta).label('total')).filter(
+            *self.hourly_usage_filters(series, start, end)
+        ).group_by(MeterRollup.series, day)
+        daily_df = pd.read_sql(daily_query.statement, self.session.connection())
+        out_df = daily_df.pivot(index='day', columns='series', values='total').reindex(columns=series).sort_index()
+        out_df.columns.name = None
+        out_df.insert(0, 'date', pd.to_datetime(out_df.index.to_numpy(dtype='int64') * 86400, unit='s'))
+
+        return out_df.reset_index(drop=True)
+
+    @operation
+    @cached('meter_rollups')
+    def regression_stats(self, x='gas', y='T1T2', start=None, end=None, tz='UTC'):
+        """
+        Function to compute the statistics of a simple linear regression of the daily consumption of series y on that 
+        of series x (by default electricity on gas), per local day of tz, within the database: the number of days with 
+        consumption of both ('n'), the sums of x and y ('sum_x', 'sum_y'), of their squares ('sum_xx', 'sum_yy') and of 
+        their product ('sum_xy'), optionally only for the hours with start <= bucket <= end (Unix time). 
+        It returns a dataframe with one row, with these sums and the fit derived from them (see regression()). 
+        The sums of several databases can be added up and passed to regression() to fit them together.
+        """
+        start, end = self.rollup_range([x, y], start, end)
+        sums = ['n', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy']
+        if start is None:
+            return self.regression(pd.DataFrame([[0] + [0.0] * 5], columns=sums))
+
+        day = (self.local_time(MeterRollup.bucket, start, end, tz) // 86400).label('day')
+        daily = select(
+            day,
+            func.sum(case((MeterRollup.series == x, MeterRollup.delta))).label('x'),
+            func.sum(case((MeterRollup.series == y, MeterRollup.delta))).label('y')
+        ).where(*self.hourly_usage_filters([x, y], start, end)).group_by(day).subquery()
+        stats_query = select(
+            func.count().label('n'), func.sum(daily.c.x).label('sum_x'), func.sum(daily.c.y).label('sum_y'),
+            func.sum(daily.c.x * daily.c.x).label('sum_xx'), func.sum(daily.c.y * daily.c.y).label('sum_yy'),
+            func.sum(daily.c.x * daily.c.y).label('sum_xy')
+        ).where(daily.c.x.isnot(None), daily.c.y.isnot(None))
+        stats_df = pd.read_sql(stats_query, self.session.connection())
+
+        # Without any days, the sums are NULL
+        return self.regression(stats_df.astype('float64').fillna(0).astype({'n': 'int64'}))
 
+    @staticmethod
+    def regression(stats_df):
+        """
+        The function adds the ordinary least squares fit y = intercept + slope * x to a dataframe with the sums of 
+        regression_stats(): the slope, the intercept, the coefficient of determination ('r_squared') and the standard 
+        errors of the slope and the intercept. The fit is NaN when there are too few (distinct) values.
+        """
+        out_df = stats_df.copy()
+        n = out_df['n'].to_numpy(dtype='float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sxx = out_df['sum_xx'] - out_df['sum_x'] ** 2 / n
+            syy = out_df['sum_yy'] - out_df['sum_y'] ** 2 / n
+            sxy = out_df['sum_xy'] - out_df['sum_x'] * out_df['sum_y'] / n
+            out_df['slope'] = sxy / sxx
+            out_df['intercept'] = (out_df['sum_y'] - out_df['slope'] * out_df['sum_x']) / n
+            out_df['r_squared'] = sxy ** 2 / (sxx * syy)
+            # The variance of the residuals, with n - 2 degrees of freedom
+            variance = (syy - out_df['slope'] * sxy) / (n - 2)
+            out_df['stderr_slope'] = np.sqrt(variance / sxx)
+            out_df['stderr_intercept'] = np.sqrt(variance * (1 / n + (out_df['sum_x'] / n) ** 2 / sxx))
+        return out_df.replace([np.inf, -np.inf], np.nan)
+
+class AsyncHomeMessagesDB:
+    """
+    The class offers the methods of HomeMessagesDB to asyncio code, e.g. a web service: every public method
+    (the insertions and queries, see operation()) can be awaited, like: df = await db.query_gas(start, end).
+    The calls run in a pool of threads that is as large as the connection pool, so that many queries can be served at
+    the same time, also while an ingest is writing. The arguments are passed on to HomeMessagesDB.
+    """
 
+    def __init__(self, db_url, **kwargs):
+        self.db = HomeMessagesDB(db_url, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=self.db.pool_size, thread_name_prefix='home_messages_db')
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not getattr(method, 'operation', False):
+            raise AttributeError(f"'{name}' is not available in AsyncHomeMessagesDB")
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+        return call
+
+    def close(self):
+        """
+        The function waits for the running calls, and closes the connections
+        """
+        self.executor.shutdown()
+        self.db.engine.dispose()
@@ -0,0 +1,181 @@
+import os
+import re
+import glob
+import threading
+import concurrent.futures
+from lazy_modules import lazy_import
+
+# pandas and the database are loaded at their first use (see lazy_modules.py)
+pd = lazy_import('pandas')
+home_messages_db = lazy_import('home_messages_db')
+
+"""
+Support for the data of several households. Every household has its own database (its shard), whose URL follows
+from a template with the placeholder {household}, e.g. sqlite:///homes/{household}.db or
+postgresql://host/energy_{household}. The tools write to the database of one household with --household, and
+a Portfolio queries the databases of all households in parallel and merges the results.
+Because the households do not share a database, their ingests do not wait for each other's locks, and a query over
+the portfolio is spread over the databases, so the throughput grows with the number of households (and databases).
+Every database records the household it belongs to (the 'household' table), so data of one household cannot
+end up in the database of another by a mistake in the URL.
+"""
+
+PLACEHOLDER = '{household}'
+# Household ids are used in file names and URLs, so they are kept simple
+HOUSEHOLD_ID = re.compile(r'[A-Za-z0-9_-]+')
+
+def household_url(template, household):
+    """
+    The function returns the database URL of a household, by filling in the household id in the template.
+    """
+    if not HOUSEHOLD_ID.fullmatch(household):
+        raise ValueError(f"Invalid household id: {household!r}. Use letters, digits, '_' and '-'")
+    if PLACEHOLDER not in template:
+        raise ValueError(f"The database URL must contain {PLACEHOLDER} to hold the data of several households, e.g. sqlite:///homes/{PLACEHOLDER}.db")
+    return template.replace(PLACEHOLDER, household)
+
+def household_dir(directory, household):
+    """
+    The function returns the directory of a household within a directory (e.g. of the Parquet snapshots), or None.
+    """
+    return None if directory is None else os.path.join(directory, household)
+
+def discover_households(template):
+    """
+    The function returns the ids of the households that have a database, for a template of SQLite URLs,
+    by looking for the database files. For other databases, the households have to be given.
+    """
+    if not template.startswith('sqlite:///') or PLACEHOLDER not in template:
+        raise ValueError("Households can only be found for SQLite URLs with {household}; give the households instead")
+    path = template[len('sqlite:///'):]
+    before, after = path.split(PLACEHOLDER, 1)
+    pattern = re.compile(re.escape(before) + '(' + HOUSEHOLD_ID.pattern + ')' + re.escape(after))
+    households = []
+    for file in glob.glob(glob.escape(before) + '*' + glob.escape(after)):
+        match = pattern.fullmatch(file)
+        if match:
+            households.append(match.group(1))
+    return sorted(households)
+
+# The databases opened by a worker process of a Portfolio, by URL
+WORKER_DBS = {}
+
+def household_call(template, household, method, args, kwargs, db_kwargs):
+    """
+    The function calls a method of the database of a household in a worker process, and returns the result.
+    The databases stay open in the worker for the next calls.
+    """
+    url = household_url(template, household)
+    if url not in WORKER_DBS:
+        WORKER_DBS[url] = home_messages_db.HomeMessagesDB(url, household=household, **db_kwargs)
+    return getattr(WORKER_DBS[url], method)(*args, **kwargs)
+
+class Portfolio:
+    """
+    The class gives access to the databases of several households, following the URL template (see household_url()).
+    The households are given, or found from the database files (see discover_households()).
+    A method is called on all databases at once by a pool of workers threads, or with processes=True of worker processes,
+    which helps when the merging of the results (in pandas) is the bottleneck rather than the databases. The databases are
+    opened with db_kwargs (e.g. snapshot_dir or cache). With processes=True, every worker process keeps its own cache
+    in memory (see QueryCache), so a cache with a directory is needed to share the results. Use close() to stop the worker processes.
+    """
+
+    def __init__(self, template, households=None, workers=None, processes=False, **db_kwargs):
+        self.template = template
+        self.households = list(households) if households is not None else discover_households(template)
+        for household in self.households:
+            household_url(template, household)
+        self.workers = workers or min(32, max(1, len(self.households)))
+        self.processes = processes
+        self.db_kwargs = db_kwargs
+        self.dbs = {}
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def db(self, household):
+        """
+        The function returns the HomeMessagesDB of a household, which is opened on first use.
+        """
+        with self.lock:
+            if household not in self.dbs:
+                self.dbs[household] = home_messages_db.HomeMessagesDB(household_url(self.template, household), household=household, **self.db_kwargs)
+            return self.dbs[household]
+
+    def map(self, method, *args, **kwargs):
+        """
+        The function calls the method (by name, e.g. 'query_gas') with the given arguments on the database of every household
+        in parallel, and returns the results in a dictionary by household.
+        """
+        if self.pool is None:
+            # concurrent.futures loads the process pool (and multiprocessing) only when it is used
+            self.pool = (concurrent.futures.ProcessPoolExecutor(self.workers) if self.processes
+                         else concurrent.futures.ThreadPoolExecutor(self.workers))
+        if self.processes:
+            futures = {household: self.pool.submit(household_call, self.template, household, method, args, kwargs, self.db_kwargs)
+                       for household in self.households}
+        else:
+            futures = {household: self.pool.submit(lambda household: getattr(self.db(household), method)(*args, **kwargs), household)
+                       for household in self.households}
+        return {household: future.result() for household, future in futures.items()}
+
+    def query(self, method, *args, **kwargs):
+        """
+        The function calls a query method (e.g. 'query_electricity' or 'daily_usage') on the database of every household,
+        and returns the results as one dataframe, with the household in the first column.
+        """
+        frames = [df.assign(household=household)[['household', *df.columns]]
+                  for household, df in self.map(method, *args, **kwargs).items()]
+        if not frames:
+            return pd.DataFrame(columns=['household'])
+        return pd.concat(frames, ignore_index=True)
+
+    def count_rows(self, table_name, start=None, end=None):
+        """
+        The function returns the number of records in a table over all households, optionally only those with start <= epoch <= end.
+        """
+        return sum(self.map('count_rows', table_name, start, end).values())
+
+    def usage_profile(self, by='hour', series=('gas', 'T1T2'), start=None, end=None, tz='UTC'):
+        """
+        The function computes the average hourly consumption per hour of the day or per day of the week over all households
+        (see HomeMessagesDB.usage_profile()). The averages of the households are combined using the number of hours
+        they are based on, so the result is the same as for one database with all readings.
+        """
+        series = [series] if isinstance(series, str) else list(series)
+        profiles = list(self.map('usage_profile', by, series, start, end, tz).values())
+        if not profiles:
+            return None
+        out_df = profiles[0].drop(columns=[col for name in series for col in (name, f'{name}_n')])
+        for name in series:
+            n = sum(profile[f'{name}_n'] for profile in profiles)
+            total = sum(profile[name].fillna(0) * profile[f'{name}_n'] for profile in profiles)
+            out_df[name] = (total / n).where(n > 0)
+            out_df[f'{name}_n'] = n
+        return out_df
+
+    def regression_stats(self, x='gas', y='T1T2', start=None, end=None, tz='UTC'):
+        """
+        The function computes the regression of the daily consumption of series y on that of series x over the days
+        of all households (see HomeMessagesDB.regression_stats()), by adding up the sums of the households.
+        It returns a dataframe with a row for the portfolio (household 'all') and a row per household.
+        """
+        stats = self.map('regression_stats', x, y, start, end, tz)
+        sums = ['n', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy']
+        per_household = pd.concat([df.assign(household=household) for household, df in stats.items()], ignore_index=True)
+        total = per_household[sums].sum().to_frame().T.astype({'n': 'int64'}).assign(household='all')
+        out_df = pd.concat([home_messages_db.HomeMessagesDB.regression(total), per_household], ignore_index=True)
+        return out_df[['household', *[col for col in out_df.columns if col != 'household']]]
+
+    def info(self):
+        """
+        The function returns the metadata of the households (see HomeMessagesDB.household_info()) as a dataframe.
+        """
+        return pd.DataFrame([info for info in self.map('household_info').values()])
+
+    def close(self):
+        """
+        The function stops the workers.
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
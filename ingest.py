@@ -0,0 +1,691 @@
+import os
+import io
+import sys
+import csv
+import gzip
+import time
+import fnmatch
+import hashlib
+import functools
+import contextlib
+from collections import deque
+import concurrent.futures
+import click
+from instrumentation import Metrics, json_lines
+from households import household_url, household_dir
+from lazy_modules import lazy_import
+
+# pandas, numpy and the database are loaded at their first use (see lazy_modules.py)
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+home_messages_db = lazy_import('home_messages_db')
+
+"""
+Helper functions that are shared by the tools p1e.py, p1g.py and smartthings.py, and the steps of the ingest
+of the P1 exports (see P1Tool), which only differ between p1e.py and p1g.py in their columns.
+"""
+
+def progress_output(metrics_file):
+    """
+    The function returns a context manager that sends the progress messages of a tool (its prints) to the standard error
+    while the lines of JSON of --metrics go to the standard output (--metrics -), so that the output can be parsed as JSON lines.
+    Otherwise, the messages stay on the standard output.
+    """
+    if metrics_file is not None and getattr(metrics_file, 'name', None) == '<stdout>':
+        return contextlib.redirect_stdout(sys.stderr)
+    return contextlib.nullcontext()
+
+def parallel_map(func, items, workers=1, metrics=None):
+    """
+    Generator that applies func to every item and yields the results in the order of the items.
+    If more than one worker is requested, the calls are spread over a pool of processes. At most 
+    two items per worker are in flight at the same time, so that the results that are waiting 
+    to be consumed do not pile up in memory.
+    If metrics (a Metrics object) is given, func is called with it as the keyword argument 'metrics'; 
+    in a worker process, the stages are collected there and emitted in the main process once the result arrives.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item) if metrics is None else func(item, metrics=metrics)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+
+        def collect():
+            result = pending.popleft().result()
+            if metrics is None:
+                return result
+            result, events = result
+            metrics.record(events)
+            return result
+
+        for item in items:
+            if metrics is None:
+                pending.append(pool.submit(func, item))
+            else:
+                pending.append(pool.submit(measured_call, func, item))
+            if len(pending) >= 2 * workers:
+                yield collect()
+        # Collect the results of the remaining items
+        while pending:
+            yield collect()
+
+def measured_call(func, item):
+    """
+    The function calls func on the item in a worker process, with a Metrics object that keeps its events, 
+    and returns the result together with these events.
+    """
+    metrics = Metrics(keep_events=True)
+    return func(item, metrics=metrics), metrics.events
+
+# The integer value of a missing timestamp (NaT)
+NAT = -2**63
+
+# The formats of the timestamps in the P1 exports, tried in this order by detect_time_format()
+TIME_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%dT%H:%M:%S',
+    '%d-%m-%Y %H:%M:%S',
+    '%d-%m-%Y %H:%M',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M',
+]
+
+def detect_time_format(times, sample_size=1000):
+    """
+    The function returns the first format of TIME_FORMATS that parses all timestamps in a sample of the
+    (text) series times, or None if there is no such format.
+    """
+    sample = times.head(sample_size).dropna().astype(str)
+    for fmt in TIME_FORMATS:
+        # Invalid entries (like 'not a time') are ignored, as long as most of the sample parses
+        parsed = pd.to_datetime(sample, format=fmt, errors='coerce')
+        if parsed.notna().mean() >= 0.9:
+            return fmt
+    return None
+
+def parse_times(times, fmt=None):
+    """
+    The function parses the (text) series times with the explicit format fmt (detected if it is not given),
+    and returns the naive timestamps as int64 seconds together with a boolean array that marks the valid ones.
+    Entries that do not match the format are parsed with format inference, which is slow, but only done for those entries.
+    Timestamps that were already parsed by the reader (see read_columns()) are used as they are.
+    """
+    if pd.api.types.is_datetime64_dtype(times):
+        naive = times.to_numpy(dtype='datetime64[s]')
+        return naive.astype('int64'), ~np.isnat(naive)
+    fmt = fmt or detect_time_format(times)
+    parsed = pd.to_datetime(times, format=fmt or 'mixed', errors='coerce')
+    if fmt is not None and parsed.isna().any():
+        failed = parsed.isna() & times.notna()
+        parsed[failed] = pd.to_datetime(times[failed].astype(str), format='mixed', errors='coerce')
+    naive = parsed.to_numpy(dtype='datetime64[s]')
+    return naive.astype('int64'), ~np.isnat(naive)
+
+def local_to_epoch(times, counter, tz='Europe/Amsterdam', fmt=None):
+    """
+    The function converts the naive local timestamps of a meter (a text series) to Unix time values.
+    It returns the epochs as an int64 array, and a boolean array that marks the valid ones.
+
+    When the clocks go back, the wall clock times of one hour occur twice, and the timestamps do not tell which 
+    of the two is meant. Since the cumulative counter of the meter (e.g. T1 + T2) never decreases, it gives the 
+    order of the readings: per day, the readings in the repeated hour are ordered by the counter (and then by 
+    their position), and they belong to the summer time until the wall clock time goes back for the first time. 
+    If the hour is only present once, it is the winter time if the data contains readings of that day after the hour, 
+    but none before it (as in a chunk that starts within the second pass), and the summer time otherwise. 
+    Timestamps that do not exist (when the clocks go forward) are marked as invalid.
+    """
+    naive, valid = parse_times(times, fmt)
+    local = pd.DatetimeIndex(naive.astype('datetime64[s]'))
+    epochs = local.tz_localize(tz, ambiguous='NaT', nonexistent='NaT').as_unit('s').asi8.copy()
+
+    # Only the timestamps that could not be localized can be ambiguous: they get a different offset depending on the DST flag
+    missing = np.flatnonzero(valid & (epochs == NAT))
+    if missing.shape[0]:
+        summer = local[missing].tz_localize(tz, ambiguous=np.ones(missing.shape[0], dtype=bool), nonexistent='NaT').as_unit('s').asi8
+        winter = local[missing].tz_localize(tz, ambiguous=np.zeros(missing.shape[0], dtype=bool), nonexistent='NaT').as_unit('s').asi8
+        is_ambiguous = summer != winter
+        ambiguous = missing[is_ambiguous]
+
+        # Order the ambiguous readings by the counter (with missing values carried forward) and their position
+        counter = pd.Series(np.asarray(counter, dtype='float64')).ffill().fillna(-np.inf).to_numpy()
+        order = ambiguous[np.lexsort((ambiguous, counter[ambiguous]))]
+        localized = valid & (epochs != NAT)
+        dst = np.empty(naive.shape[0], dtype=bool)
+        for day in np.unique(naive[order] // 86400):
+            positions = order[naive[order] // 86400 == day]
+            wall = naive[positions]
+            # Everything after the first step back of the wall clock time is winter time
+            steps = np.concatenate([[0], np.cumsum(np.diff(wall) < 0)])
+            if steps[-1] == 0:
+                # Only one pass of the hour (e.g. a chunk that starts or ends within it): it is the second one 
+                # if there are readings of the day after the hour, but none before it
+                same_day = naive[localized & (naive // 86400 == day)]
+                steps[:] = (same_day < wall.min()).sum() == 0 and (same_day > wall.max()).sum() > 0
+            dst[positions] = steps == 0
+        epochs[ambiguous] = np.where(dst[ambiguous], summer[is_ambiguous], winter[is_ambiguous])
+
+    return epochs, valid & (epochs != NAT)
+
+def read_header(file, sep=','):
+    """
+    The function returns the column names in the first line of a (gzipped) text file, without reading the rest of it.
+    A text buffer is rewound afterwards, so that it can be read again.
+    """
+    if isinstance(file, str):
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt', encoding='utf-8', errors='replace') as f:
+            line = f.readline()
+    else:
+        line = file.readline()
+        file.seek(0)
+    return next(csv.reader([line], delimiter=sep), [])
+
+def read_columns(file, columns, time_column, chunksize=None, sep=','):
+    """
+    Generator that reads only the given columns of a (gzipped) CSV file or text buffer (the names as in its header): 
+    time_column as text and the other columns as float64 (values that are not numbers become NaN). The meter counters 
+    need the precision of float64. If a chunksize is given, the file is read in pieces of that many rows, otherwise 
+    the whole file is returned as one dataframe. A whole file is read with the CSV reader of pyarrow when it is installed 
+    (see read_arrow()), which also parses the timestamps; otherwise, and if that fails, pandas is used.
+    """
+    if chunksize is None and isinstance(file, str):
+        try:
+            yield read_arrow(file, columns, time_column, sep)
+            return
+        except (ImportError, ValueError):
+            # pyarrow is not installed, or the file has lines or values it cannot convert
+            pass
+
+    numeric = [col for col in columns if col != time_column]
+    reader = pd.read_csv(file, sep=sep, usecols=columns, dtype={time_column: str}, encoding_errors='replace', chunksize=chunksize)
+    for df in ([reader] if chunksize is None else reader):
+        df = df[columns]
+        for col in numeric:
+            if df[col].dtype != 'float64':
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        yield df
+
+def read_arrow(file, columns, time_column, sep=','):
+    """
+    The function reads the given columns of a (gzipped) CSV file with the CSV reader of pyarrow, into a dataframe.
+    The timestamps of time_column are parsed by pyarrow with the format found by detect_time_format(), so the result
+    holds naive timestamps instead of text; the few that do not match the format are parsed like in parse_times(), 
+    and invalid ones become NaT. It raises a ValueError if a value of the other columns is not a number.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+
+    types = {col: pa.string() if col == time_column else pa.float64() for col in columns}
+    table = pa_csv.read_csv(file, parse_options=pa_csv.ParseOptions(delimiter=sep),
+                            convert_options=pa_csv.ConvertOptions(include_columns=columns, column_types=types))
+    out = {col: table.column(col).to_numpy() for col in columns if col != time_column}
+
+    times = table.column(time_column)
+    fmt = detect_time_format(times.slice(0, 1000).to_pandas())
+    if fmt is None:
+        # No known format, so the text is parsed with format inference later on
+        out[time_column] = times.to_pandas()
+    else:
+        parsed = pc.strptime(times, format=fmt, unit='s', error_is_null=True)
+        naive = parsed.to_numpy(zero_copy_only=False).astype('datetime64[s]')
+        failed = np.flatnonzero(pc.and_(pc.is_null(parsed), pc.is_valid(times)).to_numpy(zero_copy_only=False))
+        if failed.shape[0]:
+            retried = pd.to_datetime(times.take(failed).to_pandas(), format='mixed', errors='coerce')
+            naive[failed] = retried.to_numpy(dtype='datetime64[s]')
+        out[time_column] = naive
+    return pd.DataFrame(out)[columns]
+
+def file_hash(file, blocksize=1 << 20):
+    """
+    The function computes the SHA-256 hash of the content of a file, reading it in blocks.
+    """
+    sha = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def new_files(db, source, files, force=False):
+    """
+    The function compares the files to the manifest of ingested files in the database, and returns the files 
+    that still have to be ingested by the tool 'source'. The manifest is retrieved with a single query; 
+    a file with the same size and modification time as recorded is skipped based on a stat call only. 
+    If only the modification time changed, the hash of the content decides. With force=True, all files are returned.
+    """
+    if force:
+        return list(files)
+
+    manifest = db.file_manifest(source)
+    to_ingest = []
+    for file in files:
+        path = os.path.abspath(file)
+        stat = os.stat(file)
+        entry = manifest.get(path)
+        if entry is not None and entry.size == stat.st_size:
+            if entry.mtime == stat.st_mtime:
+                continue
+            if entry.sha256 == file_hash(file):
+                # Same content, so remember the new modification time to skip the hashing next time
+                db.touch_file(source, path, stat.st_mtime)
+                continue
+        to_ingest.append(file)
+
+    return to_ingest
+
+def file_record(file, rows_read, rows_clean, epochs=()):
+    """
+    The function creates the manifest entry of an ingested file, that can be passed to HomeMessagesDB.record_files().
+    The epoch range of the file is taken from the epochs of its cleaned rows.
+    """
+    epochs = np.asarray(epochs)
+    stat = os.stat(file)
+    return {
+        'path': os.path.abspath(file),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': file_hash(file),
+        'rows_read': int(rows_read),
+        'rows_clean': int(rows_clean),
+        'epoch_min': int(epochs.min()) if epochs.size else None,
+        'epoch_max': int(epochs.max()) if epochs.size else None,
+    }
+
+def ambiguous_times(times, tz='Europe/Amsterdam', fmt=None):
+    """
+    The function returns a boolean array that marks the naive local timestamps (a text series) that occur twice,
+    in the hour when the clocks go back.
+    """
+    naive, valid = parse_times(times, fmt)
+    localized = pd.DatetimeIndex(np.where(valid, naive, 0).astype('datetime64[s]')).tz_localize(
+        tz, ambiguous='NaT', nonexistent='shift_forward'
+    )
+    return valid & localized.isna()
+
+def trailing_count(mask):
+    """
+    The function returns the number of True values at the end of a boolean array.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    false_positions = np.flatnonzero(~mask)
+    return mask.shape[0] if false_positions.shape[0] == 0 else mask.shape[0] - 1 - int(false_positions[-1])
+
+def follow_directory(db, source, directory, pattern, ingest_file, ingest_lines, interval=2.0, batch_bytes=1 << 22,
+                     on_loaded=None, polls=None):
+    """
+    The function implements the --watch mode of the tools: it looks for files matching pattern (e.g. 'P1e*') in the 
+    directory every interval seconds, and ingests what is new, until it is interrupted (or after polls polls):
+    - a compressed file (.gz) is ingested as a whole with ingest_file(db, path) once its size and modification time 
+      did not change between two polls, unless it is in the manifest of ingested files already (see new_files());
+    - of a plain text file, the complete lines that were appended since the last poll are passed to 
+      ingest_lines(db, buffer), as a text buffer that starts with the header line, in batches of at most about 
+      batch_bytes. It returns how many rows at the end of the batch it held back (they are passed again with 
+      the next batch), or None if the batch could not be inserted (it is tried again at the next poll).
+      The offsets are kept in the 'tailed_files' table, so a restart continues where it stopped. A file that 
+      shrank or got another header was replaced, and is read from the start again.
+    Every batch is committed on its own, with its rollups, so the data is queryable right away. 
+    on_loaded() is called after every poll that loaded data, e.g. to refresh the snapshots.
+    """
+    tails = db.tail_entries(source)
+    seen = {}      # The size and modification time of the compressed files at the previous poll
+    finished = {}  # The size and modification time of the compressed files that were dealt with
+    poll = 0
+    print(f"Watching {directory} for '{pattern}' files (press Ctrl+C to stop)...")
+    try:
+        while polls is None or poll < polls:
+            if poll:
+                time.sleep(interval)
+            poll += 1
+            loaded = False
+            for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+                if not entry.is_file() or not fnmatch.fnmatchcase(entry.name.lower(), pattern.lower()):
+                    continue
+                path = os.path.abspath(entry.path)
+                stat = entry.stat()
+
+                if entry.name.endswith('.gz'):
+                    state = (stat.st_size, stat.st_mtime)
+                    if finished.get(path) == state:
+                        continue
+                    if seen.get(path) != state:
+                        # New or still being written; it is ingested once it stays the same for a poll
+                        seen[path] = state
+                        continue
+                    if new_files(db, source, [path]):
+                        ingest_file(db, path)
+                        loaded = True
+                    finished[path] = state
+                    continue
+
+                offset, header = tails.get(path, (0, None))
+                while True:
+                    with open(path, 'rb') as f:
+                        first = f.readline()
+                        if not first.endswith(b'\n'):
+                            break  # The header is not complete yet
+                        if stat.st_size < offset or (header is not None and first.decode('utf-8', errors='replace') != header):
+                            offset = 0
+                        offset = max(offset, len(first))
+                        f.seek(offset)
+                        data = f.read(batch_bytes)
+                        if data and b'\n' not in data and len(data) == batch_bytes:
+                            # A line that is longer than a batch
+                            data += f.readline()
+                    data = data[:data.rfind(b'\n') + 1]
+                    if not data:
+                        break
+
+                    held = ingest_lines(db, io.StringIO((first + data).decode('utf-8', errors='replace')))
+                    if held is None:
+                        break
+                    # Only the lines up to the held back rows are consumed (blank lines do not count as rows)
+                    lines = data.splitlines(keepends=True)
+                    consumed = len(lines)
+                    while held > 0 and consumed > 0:
+                        consumed -= 1
+                        held -= 1 if lines[consumed].strip() else 0
+                    consumed_bytes = sum(len(line) for line in lines[:consumed])
+                    if consumed_bytes == 0:
+                        break
+                    offset += consumed_bytes
+                    header = first.decode('utf-8', errors='replace')
+                    db.record_tail(source, path, offset, header)
+                    tails[path] = (offset, header)
+                    loaded = True
+                    if offset >= stat.st_size:
+                        break
+
+            if loaded and on_loaded is not None:
+                on_loaded()
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+def deduplicate(data):
+    """
+    The function removes the duplicate epochs and incomplete records from a dataframe of P1 readings
+    with an 'epoch' column, and sorts it by epoch.
+    """
+    # We have to drop duplicates in the epoch column, since they result in integrity errors when inserting into the database.
+    # It is safe to do in this case, since we assume that per time stamp, there can only be one consumption record. 
+    data = data.drop_duplicates(subset=['epoch'], keep='last')
+    data = data.sort_values('epoch').reset_index(drop=True)
+
+    # Finally, we drop nan values from the consumption columns, since we need complete records for analysis:
+    data = data.dropna()
+    return data
+
+class P1Tool:
+    """
+    The class holds the steps of the ingest that the tools for the P1 exports (p1e.py and p1g.py) have in common:
+    reading and parsing the files, and inserting them in one go, in chunks (--chunksize) or as they grow (--watch).
+    What differs per tool is given: source is the name of the tool (in the manifest and in insert_<source>_data()), 
+    table is the table that is written to, source_columns(header) looks up the names of the required columns in the header
+    of a file (or returns None), names are the names they get (the first one is 'time'), and to_epoch(data, fmt) converts
+    the time of a dataframe with these columns to Unix time values (see local_to_epoch()).
+    """
+
+    def __init__(self, source, table, source_columns, names, to_epoch):
+        self.source = source
+        self.table = table
+        self.source_columns = source_columns
+        self.names = names
+        self.to_epoch = to_epoch
+
+    def insert(self, db, data):
+        """
+        The function inserts the cleaned readings into the table of the tool, and returns what the insert method returns.
+        """
+        return getattr(db, f'insert_{self.source}_data')(data, self.table)
+
+    def read_file(self, file, chunksize=None):
+        """
+        Generator that reads a (gzipped) file, or a text buffer. Only the header line is read first, to find the 
+        required columns; then only these columns are parsed (see read_columns()), so the other columns 
+        (export, production, power, ...) cost next to nothing. If a chunksize is given, the file is read in pieces of that 
+        many rows, otherwise the whole file is returned as one dataframe. If the required columns are not present, 
+        an empty dataframe with the columns of the header is returned.
+        """
+        header = read_header(file)
+        columns = self.source_columns(header)
+        if columns is None:
+            yield pd.DataFrame(columns=header)
+            return
+        yield from read_columns(file, columns, columns[0], chunksize)
+
+    def select_columns(self, df):
+        """
+        The function maps the columns of a raw dataframe to the names of the tool.
+        It returns None if the required columns are not present.
+        """
+        columns = self.source_columns(df.columns)
+        if columns is None:
+            return None
+
+        # Selecting required columns and renaming them 
+        df = df[columns]
+        df.columns = self.names
+        return df
+
+    def clean(self, data):
+        """
+        The function performs all cleaning steps on a dataframe with the columns of the tool,
+        and returns a dataframe with the 'epoch' column instead of 'time' that is ready for insertion.
+        """
+        return deduplicate(self.to_epoch(data))
+
+    def parse_file(self, file, metrics=None):
+        """
+        The function reads a single file, maps its columns and converts the time to Unix time values.
+        Only the last reading per epoch is kept, but incomplete records are not dropped yet, so that the result 
+        can still be combined with the other files. It returns the columns as numpy arrays (which are cheap to send 
+        back from a worker process) and the number of rows in the file, or None together with a message if the file could not be used.
+        The stages are timed with metrics (a Metrics object, see instrumentation.py), if it is given.
+        """
+        metrics = metrics if metrics is not None else Metrics()
+        try:
+            # Without a chunksize, read_file() returns the whole file at once
+            for df in metrics.iterate('read', self.read_file(file), file=file):
+                rows_read = df.shape[0]
+            with metrics.stage('normalize', rows_in=rows_read, file=file) as event:
+                df = self.select_columns(df)
+                event['rows_out'] = 0 if df is None else df.shape[0]
+            if df is None:
+                return None, rows_read, f"Skipping file: {file} — Missing required columns."
+            with metrics.stage('timezone', rows_in=df.shape[0], file=file) as event:
+                df = self.to_epoch(df)
+                event['rows_out'] = df.shape[0]
+            with metrics.stage('dedup', rows_in=df.shape[0], file=file) as event:
+                df = df.drop_duplicates(subset=['epoch'], keep='last')
+                event['rows_out'] = df.shape[0]
+
+        except Exception as e:
+            return None, 0, f"Error reading file: {file} — {e}"
+
+        return {col: df[col].to_numpy() for col in df.columns}, rows_read, None
+
+    def ingest_file(self, db, file, metrics=None):
+        """
+        The function parses and inserts a single complete file, and adds it to the manifest, for the --watch mode.
+        """
+        columns, rows_read, message = self.parse_file(file, metrics)
+        if message is not None:
+            click.echo(message)
+            return
+        data = deduplicate(pd.DataFrame(columns))
+        if self.insert(db, data) is not None:
+            db.record_files(self.source, [file_record(file, rows_read, data.shape[0], data['epoch'])])
+
+    def ingest_lines(self, db, buffer):
+        """
+        The function parses and inserts a batch of lines of a growing file (a text buffer that starts with the header line),
+        for the --watch mode (see follow_directory()). The readings at the end of the batch that fall in the hour 
+        that occurs twice are held back, since their offset can only be told from the readings after them. 
+        It returns the number of held back rows, or None if the batch could not be inserted.
+        """
+        df = self.select_columns(next(self.read_file(buffer)))
+        if df is None:
+            click.echo("Skipping lines — Missing required columns.")
+            return 0
+        held = trailing_count(ambiguous_times(df['time']))
+        data = self.clean(df.iloc[:df.shape[0] - held])
+        if data.shape[0] and self.insert(db, data) is None:
+            return None
+        return held
+
+    def run(self, files, d, household=None, chunksize=None, workers=1, force=False, metrics_file=None, count_rows=False,
+            load_mode=False, snapshot_dir=None, watch=None, pattern=None, interval=2.0):
+        """
+        The function implements the command line interface of the tool (see p1e.py for the options): it ingests the files
+        in one go, or in chunks (see stream()), or follows the directory watch (see follow_directory()).
+        """
+        metrics = Metrics(json_lines(metrics_file) if metrics_file else None, source=self.source)
+        if metrics_file:
+            # The summary is written when the command finishes, also if it returns early
+            click.get_current_context().call_on_close(metrics.summary)
+        # With --metrics -, the standard output only holds the lines of JSON
+        click.get_current_context().with_resource(progress_output(metrics_file))
+
+        if household is not None:
+            # Every household has its own database (and snapshots)
+            try:
+                d, snapshot_dir = household_url(d, household), household_dir(snapshot_dir, household)
+            except ValueError as e:
+                raise click.BadParameter(str(e), param_hint='--household')
+
+        if watch is not None:
+            if files:
+                raise click.UsageError("Give either files or --watch")
+            if load_mode:
+                # The indexes have to stay current while following the directory
+                raise click.UsageError("--load-mode cannot be combined with --watch")
+            db_instance = home_messages_db.HomeMessagesDB(d, metrics=metrics, count_rows=count_rows, snapshot_dir=snapshot_dir, household=household)
+            follow_directory(db_instance, self.source, watch, pattern, functools.partial(self.ingest_file, metrics=metrics), self.ingest_lines,
+                             interval, on_loaded=db_instance.export_snapshots if snapshot_dir else None)
+            return
+
+        if not files:
+            # Nothing to do, so the database is not opened
+            click.echo("No files to ingest.")
+            return
+
+        if chunksize is not None:
+            self.stream(files, d, chunksize, workers, force, metrics, count_rows, load_mode, snapshot_dir, household)
+            return
+
+        # Skip the files that were already ingested before
+        db_instance = self.open_db(d, metrics, count_rows, load_mode, snapshot_dir, household)
+        files = new_files(db_instance, self.source, files, force)
+        if not files:
+            click.echo("All files have already been ingested.")
+            return
+
+        frames = []  # Collecting the parsed dataframes here, in the order of the files
+        records = []  # Manifest entries of the parsed files
+
+        for file, (columns, rows_read, message) in zip(files, parallel_map(self.parse_file, files, workers, metrics)):
+            if message is not None:
+                click.echo(message)
+                continue
+            frames.append(pd.DataFrame(columns))
+            records.append(file_record(file, rows_read, frames[-1].shape[0], columns['epoch']))
+
+        # If nothing was loaded, we quit
+        if not frames:
+            click.echo(f"No valid {self.table} data loaded.")
+            return
+
+        # Merging all dataframes and removing the duplicates across files (the reading from the last file is kept)
+        data = pd.concat(frames)
+        with metrics.stage('dedup', rows_in=data.shape[0]) as event:
+            data = deduplicate(data)
+            event['rows_out'] = data.shape[0]
+
+        if self.insert(db_instance, data) is not None:
+            # Only after a successful insertion, the files are added to the manifest
+            db_instance.record_files(self.source, records)
+
+    def open_db(self, d, metrics, count_rows=False, load_mode=False, snapshot_dir=None, household=None):
+        """
+        The function opens the database for an ingest of files. With load_mode, the database is put in its bulk load mode
+        until the command finishes, and with snapshot_dir, the snapshots in that directory are refreshed when it finishes.
+        With household, the database is checked to belong to that household (see HomeMessagesDB.set_household()).
+        """
+        db_instance = home_messages_db.HomeMessagesDB(d, metrics=metrics, count_rows=count_rows, snapshot_dir=snapshot_dir, household=household)
+        if load_mode:
+            # The normal settings are restored when the command finishes
+            click.get_current_context().with_resource(db_instance.load_mode())
+        if snapshot_dir:
+            # The months that changed are written to the snapshots when the command finishes
+            click.get_current_context().call_on_close(db_instance.export_snapshots)
+        return db_instance
+
+    def stream(self, files, d, chunksize, workers=1, force=False, metrics=None, count_rows=False, load_mode=False, snapshot_dir=None, household=None):
+        """
+        The function handles the --chunksize mode of the command line interface: each chunk of every file 
+        is cleaned and inserted separately. Duplicate epochs are removed within a chunk (keeping the last one);
+        across chunks, the reading that was inserted first is kept, since compare_entires() skips epochs that are already stored.
+        With more than one worker, the files are parsed as a whole by the worker processes, and inserted in chunks, so that 
+        the memory use is bounded by the size of the files that are in flight. A file is added to the manifest 
+        once all of its chunks were inserted. The stages are timed with metrics (a Metrics object), if it is given.
+        The other arguments are passed to open_db().
+        """
+        metrics = metrics if metrics is not None else Metrics()
+        db_instance = self.open_db(d, metrics, count_rows, load_mode, snapshot_dir, household)
+        files = new_files(db_instance, self.source, files, force)
+        if not files:
+            click.echo("All files have already been ingested.")
+            return
+        loaded = False
+
+        if workers > 1:
+            for file, (columns, rows_read, message) in zip(files, parallel_map(self.parse_file, files, workers, metrics)):
+                if message is not None:
+                    click.echo(message)
+                    continue
+                with metrics.stage('dedup', rows_in=len(columns['epoch']), file=file) as event:
+                    data = deduplicate(pd.DataFrame(columns))
+                    event['rows_out'] = data.shape[0]
+                inserted = True
+                for start in range(0, data.shape[0], chunksize):
+                    inserted &= self.insert(db_instance, data.iloc[start:start + chunksize]) is not None
+                    loaded = True
+                if inserted:
+                    db_instance.record_files(self.source, [file_record(file, rows_read, data.shape[0], data['epoch'])])
+
+        else:
+            for file in files:
+                try:
+                    rows_read, rows_clean, epochs, inserted = 0, 0, [], True
+                    fmt = None  # The format of the timestamps is detected on the first chunk of the file
+                    for chunk in metrics.iterate('read', self.read_file(file, chunksize), file=file):
+                        rows_read += chunk.shape[0]
+                        with metrics.stage('normalize', rows_in=chunk.shape[0], file=file) as event:
+                            chunk = self.select_columns(chunk)
+                            event['rows_out'] = 0 if chunk is None else chunk.shape[0]
+                        if chunk is None:
+                            click.echo(f"Skipping file: {file} — Missing required columns.")
+                            break
+                        with metrics.stage('timezone', rows_in=chunk.shape[0], file=file) as event:
+                            fmt = fmt or detect_time_format(chunk['time'])
+                            chunk = self.to_epoch(chunk, fmt)
+                            event['rows_out'] = chunk.shape[0]
+                        with metrics.stage('dedup', rows_in=chunk.shape[0], file=file) as event:
+                            chunk = deduplicate(chunk)
+                            event['rows_out'] = chunk.shape[0]
+                        rows_clean += chunk.shape[0]
+                        epochs += [chunk['epoch'].min(), chunk['epoch'].max()] if chunk.shape[0] else []
+                        inserted &= self.insert(db_instance, chunk) is not None
+                        loaded = True
+                    else:
+                        # All chunks of the file were read, so it can be added to the manifest
+                        if inserted:
+                            db_instance.record_files(self.source, [file_record(file, rows_read, rows_clean, epochs)])
+
+                except Exception as e:
+                    click.echo(f"Error reading file: {file} — {e}")
+
+        if not loaded:
+            click.echo(f"No valid {self.table} data loaded.")
@@ -0,0 +1,107 @@
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+"""
+Instrumentation of the ingestion pipeline. The tools and HomeMessagesDB time the stages of an ingest
+(read, normalize, timezone, dedup, compare_entires, write, ...) with a Metrics object. Every finished stage
+is an event: a dictionary like {'event': 'stage', 'stage': 'read', 'seconds': 0.12, 'rows_in': None, 'rows_out': 1440, 'file': ...}.
+The events are logged as JSON on the 'energy_usage.ingest' logger (at the INFO level, so they are not shown unless
+logging is configured), and passed to an optional callback, e.g. to write them to a file or to collect them in a test.
+"""
+
+logger = logging.getLogger('energy_usage.ingest')
+
+class Metrics:
+    """
+    The class collects the timings and row counts of the stages of an ingest.
+    The context (e.g. source='p1e') is added to every event. Next to emitting the events, the totals per stage
+    are kept, see summary(). With keep_events=True, the events themselves are kept as well (in self.events).
+    """
+
+    def __init__(self, callback=None, keep_events=False, **context):
+        self.callback = callback
+        self.keep_events = keep_events
+        self.context = context
+        self.events = []
+        self.totals = {}
+
+    def new_event(self, name, rows_in=None, **fields):
+        """
+        The function returns a new (unfinished) event of the stage 'name'.
+        """
+        return {'event': 'stage', 'stage': name, **self.context, **fields, 'rows_in': rows_in, 'rows_out': None}
+
+    @contextmanager
+    def stage(self, name, rows_in=None, **fields):
+        """
+        Context manager that times the stage 'name'. It yields the event, so that the number of
+        output rows (and other fields) can be filled in within the block: event['rows_out'] = df.shape[0]
+        """
+        event = self.new_event(name, rows_in, **fields)
+        start = time.perf_counter()
+        try:
+            yield event
+        finally:
+            event['seconds'] = round(time.perf_counter() - start, 6)
+            self.emit(event)
+
+    def iterate(self, name, iterable, **fields):
+        """
+        Generator that yields the dataframes of iterable (e.g. the chunks of a file), and times
+        the production of every dataframe as the stage 'name'.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                df = next(iterator)
+            except StopIteration:
+                return
+            event = self.new_event(name, **fields)
+            event['rows_out'] = df.shape[0]
+            event['seconds'] = round(time.perf_counter() - start, 6)
+            self.emit(event)
+            yield df
+
+    def emit(self, event):
+        """
+        The function adds an event to the totals, logs it, and passes it to the callback.
+        """
+        if event['event'] == 'stage':
+            total = self.totals.setdefault(event['stage'], {'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0})
+            total['calls'] += 1
+            total['seconds'] += event['seconds']
+            total['rows_in'] += event['rows_in'] or 0
+            total['rows_out'] += event['rows_out'] or 0
+        if self.keep_events:
+            self.events.append(event)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(event, default=str))
+        if self.callback is not None:
+            self.callback(event)
+
+    def record(self, events):
+        """
+        The function emits events that were collected elsewhere, e.g. by a Metrics object in a worker process.
+        """
+        for event in events:
+            self.emit({**event, **self.context})
+
+    def summary(self):
+        """
+        The function returns the totals per stage, in the order in which the stages were first seen, and emits them as a 'summary' event.
+        """
+        totals = {stage: {**total, 'seconds': round(total['seconds'], 6)} for stage, total in self.totals.items()}
+        self.emit({'event': 'summary', **self.context, 'stages': totals})
+        return totals
+
+def json_lines(f):
+    """
+    The function returns a callback that writes every event as a line of JSON to the open file f.
+    """
+    def write(event):
+        f.write(json.dumps(event, default=str) + '\n')
+        f.flush()
+    return write
@@ -0,0 +1,26 @@
+import sys
+import importlib.util
+
+"""
+The tools are started often (by cron, or by the home_messages.py command for a single file), so the time to import
+pandas, numpy and SQLAlchemy (most of a second) can take longer than a small ingest, and --help should not pay for it.
+The modules therefore import these packages with lazy_import(): the module is only loaded at the first use of one of
+its attributes, e.g. pd.DataFrame, and not at all by a run that does not need it.
+"""
+
+def lazy_import(name):
+    """
+    The function returns the module with the given name, which is loaded at the first access of one of its attributes
+    (see importlib.util.LazyLoader). A module that was already imported is returned as it is.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
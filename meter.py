@@ -0,0 +1,138 @@
+from lazy_modules import lazy_import
+
+# pandas and numpy are loaded at their first use (see lazy_modules.py)
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+"""
+Functions to turn the cumulative meter readings of the 'gas' and 'electricity' tables (usage, T1 and T2)
+into the consumption per time bucket. Everything is computed on numpy arrays, without Python loops over the readings.
+
+The readings are treated as points on a cumulative consumption curve that is linear between two readings.
+The consumption of a bucket is the increase of that curve between the edges of the bucket, so readings that
+are not aligned with the buckets, and gaps between readings, are handled by linear interpolation. Buckets that
+overlap with a gap (two readings further apart than max_gap) are flagged as 'interpolated'.
+
+A decrease of the counter is handled as follows:
+- small decreases (up to the tolerance) are measurement noise, and count as no consumption;
+- if the counter has a known maximum (rollover), a drop from the upper half of the range to the lower half
+  is a wrap-around, and the consumption is the distance travelled over the maximum;
+- any other decrease is a reset (e.g. a replaced meter): the interval counts as no consumption, and the bucket is flagged as 'reset'.
+Increases that are faster than max_rate (units per second) are also treated as resets.
+"""
+
+def counter_increments(epochs, values, tolerance=1e-3, rollover=None, max_rate=None):
+    """
+    The function computes the consumption between consecutive readings of a cumulative counter.
+    The epochs must be sorted. It returns the corrected increments, and a boolean array that marks the resets.
+    """
+    increments = np.diff(values)
+    resets = np.zeros(increments.shape, dtype=bool)
+
+    if rollover is not None:
+        # A wrap-around lands in the lower half of the range, coming from the upper half
+        wrapped = (increments < -tolerance) & (increments + rollover < rollover / 2)
+        increments[wrapped] += rollover
+
+    # Drops that are not noise are resets
+    resets |= increments < -tolerance
+    if max_rate is not None:
+        resets |= increments > max_rate * np.diff(epochs)
+    increments[resets] = 0
+    # The remaining small decreases are noise
+    increments[increments < 0] = 0
+
+    return increments, resets
+
+def bucket_edges(epoch_min, epoch_max, freq='1h', tz='UTC'):
+    """
+    The function returns the edges (in Unix time) of the buckets of size freq (a pandas frequency string, e.g. '15min', '1h' or '1D')
+    that cover the range from epoch_min to epoch_max. The buckets are aligned to the local time of the time zone tz,
+    so daily buckets start at local midnight.
+    """
+    first = pd.Timestamp(int(epoch_min), unit='s', tz='UTC').tz_convert(tz).floor(freq, ambiguous=True, nonexistent='shift_backward')
+    last = pd.Timestamp(int(epoch_max), unit='s', tz='UTC').tz_convert(tz).ceil(freq, ambiguous=True, nonexistent='shift_forward')
+    return pd.date_range(first, last, freq=freq).as_unit('s').asi8
+
+def meter_consumption(epochs, values, freq='1h', tz='UTC', max_gap=3600, tolerance=1e-3, rollover=None, max_rate=None):
+    """
+    The function computes the consumption per bucket from the readings (epochs and values) of a single cumulative counter.
+    It returns the start of the buckets (in Unix time), the consumption per bucket, and two boolean arrays that flag
+    the buckets that overlap with a gap of more than max_gap seconds, and the buckets that contain a reset.
+    """
+    epochs = np.asarray(epochs, dtype='int64')
+    values = np.asarray(values, dtype='float64')
+
+    # Only complete readings, in the order of time
+    valid = ~np.isnan(values)
+    epochs, values = epochs[valid], values[valid]
+    order = np.argsort(epochs, kind='stable')
+    epochs, values = epochs[order], values[order]
+
+    if epochs.shape[0] == 0:
+        empty = np.zeros(0, dtype=bool)
+        return np.zeros(0, dtype='int64'), np.zeros(0), empty, empty
+
+    increments, resets = counter_increments(epochs, values, tolerance, rollover, max_rate)
+    cumulative = np.concatenate([[0.0], np.cumsum(increments)])
+
+    # The consumption of a bucket is the increase of the interpolated cumulative curve between its edges
+    edges = bucket_edges(epochs[0], epochs[-1], freq, tz)
+    consumption = np.diff(np.interp(edges, epochs, cumulative))
+    n_buckets = edges.shape[0] - 1
+
+    # Flag the buckets that overlap with a gap, using a difference array over the bucket indices
+    gaps = np.flatnonzero(np.diff(epochs) > max_gap)
+    first_bucket = np.searchsorted(edges, epochs[gaps], side='right') - 1
+    last_bucket = np.searchsorted(edges, epochs[gaps + 1], side='left') - 1
+    marks = np.zeros(n_buckets + 1, dtype='int64')
+    np.add.at(marks, first_bucket, 1)
+    np.add.at(marks, last_bucket + 1, -1)
+    interpolated = np.cumsum(marks)[:-1] > 0
+
+    # Flag the buckets that contain the reading right after a reset
+    reset_buckets = np.searchsorted(edges, epochs[1:][resets], side='right') - 1
+    # A reading on the last edge belongs to the last bucket, in which the counter was reset
+    reset_buckets = np.minimum(reset_buckets, n_buckets - 1)
+    reset = np.zeros(n_buckets, dtype=bool)
+    reset[reset_buckets] = True
+
+    return edges[:-1], consumption, interpolated, reset
+
+def consumption(df, columns, freq='1h', tz='UTC', max_gap=3600, tolerance=1e-3, rollover=None, max_rate=None):
+    """
+    The function computes the consumption per bucket for one or more counter columns of a dataframe with an 'epoch' column,
+    such as the output of HomeMessagesDB.query_gas() ('usage') or HomeMessagesDB.query_electricity() ('T1' and 'T2').
+    Each counter is handled separately, so a reset of one counter does not affect the other.
+    It returns a dataframe indexed by the (time zone aware) start of the bucket, with the bucket start in Unix time ('bucket'),
+    the consumption per column, and the 'interpolated' and 'reset' flags of any of the columns.
+    The other arguments are explained in meter_consumption() and at the top of this file.
+    """
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    if df.shape[0] == 0:
+        return pd.DataFrame(columns=['bucket', *columns, 'interpolated', 'reset'])
+
+    epochs = df['epoch'].to_numpy()
+    # All columns share the same buckets, so that they line up
+    edges = bucket_edges(epochs.min(), epochs.max(), freq, tz)
+    out = {'bucket': edges[:-1]}
+    interpolated = np.zeros(edges.shape[0] - 1, dtype=bool)
+    reset = np.zeros(edges.shape[0] - 1, dtype=bool)
+
+    for col in columns:
+        buckets, values, col_interpolated, col_reset = meter_consumption(
+            epochs, df[col].to_numpy(), freq, tz, max_gap, tolerance, rollover, max_rate
+        )
+        # The readings of this column might cover fewer buckets than all columns together
+        offset = np.searchsorted(edges, buckets[0]) if buckets.shape[0] else 0
+        out[col] = np.full(edges.shape[0] - 1, np.nan)
+        out[col][offset:offset + buckets.shape[0]] = values
+        interpolated[offset:offset + buckets.shape[0]] |= col_interpolated
+        reset[offset:offset + buckets.shape[0]] |= col_reset
+
+    out['interpolated'] = interpolated
+    out['reset'] = reset
+    out_df = pd.DataFrame(out, index=pd.to_datetime(edges[:-1], unit='s', utc=True).tz_convert(tz))
+    out_df.index.name = 'time'
+
+    return out_df
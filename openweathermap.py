@@ -1,72 +1,169 @@
 #Installing necessary packages via cmd
-#pip install openmeteo-requests
-#pip install requests-cache retry-requests numpy pandas
+#pip install numpy pandas
 #pip install click
 
 # Importing packages
-import openmeteo_requests
-import requests_cache
-import pandas as pd
-from retry_requests import retry
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import click
+from lazy_modules import lazy_import
+from households import household_url
 
+# pandas and the database are loaded at their first use (see lazy_modules.py)
+pd = lazy_import('pandas')
+home_messages_db = lazy_import('home_messages_db')
 
-def weather(start, end,Lat=52.23,Lon=4.45):
-    """
-    The function takes in the location as defined by latitude and longitude (default values set to Nordwijk location),
-    and arguments from the cli options, that are the start and end date defining the range 
-    for which weather should be retrieved. It returns the temperature and humidity values.
-    This function is modified from https://open-meteo.com/en/docs/historical-weather-api
-    """
+"""
+The weather is retrieved from the archive of Open-Meteo (https://open-meteo.com/en/docs/historical-weather-api).
+When a HomeMessagesDB is given, the hourly weather is stored in its 'weather' table, together with the time ranges that
+were retrieved ('weather_coverage'). Only the parts of a requested period that are not covered yet are downloaded, so
+repeating an analysis over the same period does not use the network at all. The missing parts are combined into as
+few requests as possible: parts that are close together are retrieved with one request (the hours in between are
+simply stored again). synthetic_data.weather_archive() runs a local stand-in for the archive, to try this out offline.
+"""
 
-    # Setup the API client with cache and retry
-    cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+ARCHIVE_URL = "https://archive-api.open-meteo.com/v1/archive"
+DAY = 86400
 
-    # Inform user
-    print(f"Retrieving weather data from {start} to {end} for Nordwijk (Lat: {Lat}, Lon: {Lon})...")
-
-	# The order of variables in hourly or daily is important to assign them correctly below
-    url = "https://archive-api.open-meteo.com/v1/archive"
+def fetch_hourly(start_date, end_date, Lat, Lon, url=ARCHIVE_URL, retries=5, backoff_factor=0.2):
+    """
+    The function retrieves the hourly temperature and humidity for the UTC days start_date up to and including end_date
+    ('YYYY-MM-DD') from the archive, and returns them as a dataframe with the columns epoch, temperature and humidity.
+    Failed requests (connection errors, rate limiting and server errors) are retried with an increasing delay.
+    """
     params = {
         "latitude": Lat,
         "longitude": Lon,
-        "start_date": start,
-        "end_date": end,
+        "start_date": start_date,
+        "end_date": end_date,
         "hourly": "temperature_2m,relative_humidity_2m",
-        "timezone": "auto"
+        "timezone": "GMT",
+        "timeformat": "unixtime"
     }
+    request_url = f"{url}?{urllib.parse.urlencode(params)}"
+
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(request_url, timeout=60) as response:
+                data = json.load(response)
+            break
+        except urllib.error.HTTPError as e:
+            # Other client errors (e.g. an invalid date range) do not go away by trying again
+            if (e.code != 429 and e.code < 500) or attempt == retries:
+                raise
+        except urllib.error.URLError:
+            if attempt == retries:
+                raise
+        time.sleep(backoff_factor * 2 ** attempt)
+
+    # The order of the variables is the same as requested
+    hourly = data["hourly"]
+    return pd.DataFrame({
+        "epoch": pd.Series(hourly["time"], dtype='int64'),
+        "temperature": pd.Series(hourly["temperature_2m"], dtype='float64'),
+        "humidity": pd.Series(hourly["relative_humidity_2m"], dtype='float64')
+    })
+
+def request_ranges(gaps, max_hole=7 * DAY, max_length=366 * DAY):
+    """
+    The function turns the missing time ranges (a list of (start, end) tuples in Unix time) into the ranges of
+    whole UTC days to request. Ranges that are at most max_hole seconds apart are requested together,
+    and no request spans more than max_length seconds.
+    """
+    ranges = []
+    for start, end in gaps:
+        day_start, day_end = start - start % DAY, end + (-end) % DAY
+        if ranges and day_start - ranges[-1][1] <= max_hole:
+            ranges[-1][1] = max(ranges[-1][1], day_end)
+        else:
+            ranges.append([day_start, day_end])
+
+    # Very long ranges are split up
+    out = []
+    for start, end in ranges:
+        for part_start in range(start, end, max_length):
+            out.append((part_start, min(part_start + max_length, end)))
+    return out
 
-    responses = openmeteo.weather_api(url, params=params)
-    response = responses[0]
+def utc_dates(range_start, range_end):
+    """
+    Helper function that returns the first and last UTC day ('YYYY-MM-DD') of a range of whole days (range_start <= epoch < range_end)
+    """
+    return (pd.Timestamp(range_start, unit='s').strftime('%Y-%m-%d'),
+            pd.Timestamp(range_end - DAY, unit='s').strftime('%Y-%m-%d'))
+
+def weather(start, end, Lat=52.23, Lon=4.45, db=None, url=ARCHIVE_URL, tz='Europe/Amsterdam'):
+    """
+    The function takes in the location as defined by latitude and longitude (default values set to Nordwijk location),
+    and the start and end date ('YYYY-MM-DD', in the time zone tz) defining the range
+    for which weather should be retrieved. It returns the hourly temperature and humidity values.
+    With db (a HomeMessagesDB), the weather is read from the database, and only the missing hours are retrieved
+    from the archive (at url) and stored (see the top of this file). Without it, the whole range is retrieved.
+    This function is modified from https://open-meteo.com/en/docs/historical-weather-api
+    """
+
+    # Inform user
+    print(f"Retrieving weather data from {start} to {end} for Nordwijk (Lat: {Lat}, Lon: {Lon})...")
 
-    # Process hourly data. The order of variables needs to be the same as requested.
-    hourly = response.Hourly()
-    temperature = hourly.Variables(0).ValuesAsNumpy()
-    humidity = hourly.Variables(1).ValuesAsNumpy()
+    # The hours from midnight of the start date up to midnight after the end date, in Unix time
+    first = int(pd.Timestamp(start).tz_localize(tz).timestamp())
+    last = int((pd.Timestamp(end) + pd.Timedelta(days=1)).tz_localize(tz).timestamp())
 
-    # Split the functions pd.to_datetime/timedelta and pd.date_range from the api for code clarity
-    start_time = pd.to_datetime(hourly.Time(), unit="s", utc=True)
-    end_time = pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True)
-    interval = pd.Timedelta(seconds=hourly.Interval())
-    
-    # Combine start end and frequency in one column
-    time_range = pd.date_range(start=start_time, end=end_time, freq=interval, inclusive="left")
+    if db is None:
+        frames = [fetch_hourly(*utc_dates(first - first % DAY, last + (-last) % DAY), Lat, Lon, url)]
+        n_requests = 1
+    else:
+        ranges = request_ranges(db.weather_gaps(Lat, Lon, first, last))
+        for range_start, range_end in ranges:
+            fetched = fetch_hourly(*utc_dates(range_start, range_end), Lat, Lon, url)
+            fetched = fetched[(fetched['epoch'] >= range_start) & (fetched['epoch'] < range_end)]
+            # The most recent days are not in the archive yet (their values are missing), so they are not marked as covered
+            available = fetched.dropna(subset=['temperature', 'humidity'], how='all')
+            covered_end = int(available['epoch'].max()) + 3600 if available.shape[0] else range_start
+            if covered_end > range_start:
+                db.insert_weather(Lat, Lon, fetched[fetched['epoch'] < covered_end], range_start, covered_end)
+        frames = [db.query_weather(Lat, Lon, first, last - 1)]
+        n_requests = len(ranges)
+
+    df = pd.concat(frames, ignore_index=True)
+    df = df[(df['epoch'] >= first) & (df['epoch'] < last)]
 
     # Creating pandas df with the extracted values
     df = pd.DataFrame({
-        "datetime": time_range,
-        "temperature_2m": temperature,
-        "humidity_2m": humidity
-    })
+        "datetime": pd.to_datetime(df['epoch'], unit="s", utc=True),
+        "temperature_2m": df['temperature'],
+        "humidity_2m": df['humidity']
+    }).reset_index(drop=True)
 
-    # Print the success message + df preview 
-    print("Weather data successfully retrieved:")
+    # Print the success message + df preview
+    print(f"Weather data successfully retrieved ({n_requests} request(s) to the archive):")
     print(df.head())
-
-    # Save to CSV
-    filename = f"weather_{start}_{end}.csv"
-    df.to_csv(filename, index=False)
-    print(f"Saved data to {filename}")
     return df
 
+@click.command()
+@click.option('-d', required=True, help='SQLAlchemy database URL, e.g. sqlite:///your_database.db')
+@click.option('--household', default=None,
+              help='Id of the household; -d is then a URL template with {household}, e.g. sqlite:///homes/{household}.db')
+@click.option('--start', required=True, help='First day (YYYY-MM-DD) of the weather to retrieve.')
+@click.option('--end', required=True, help='Last day (YYYY-MM-DD) of the weather to retrieve.')
+@click.option('--lat', type=float, default=52.23, show_default=True, help='Latitude of the location.')
+@click.option('--lon', type=float, default=4.45, show_default=True, help='Longitude of the location.')
+@click.option('--tz', default='Europe/Amsterdam', show_default=True, help='Time zone of the days.')
+@click.option('--url', default=ARCHIVE_URL, show_default=True, help='Address of the weather archive.')
+def store_weather(d, household, start, end, lat, lon, tz, url):
+    """
+    The function retrieves the hourly weather of the days from start to end at a location, and stores it in the database,
+    so that the reports and query_aligned() can use it. Only the hours that are not stored yet are retrieved (see weather()).
+    """
+    if household is not None:
+        try:
+            d = household_url(d, household)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--household')
+    weather(start, end, lat, lon, db=home_messages_db.HomeMessagesDB(d, household=household), url=url, tz=tz)
+
+if __name__ == '__main__':
+    store_weather()
@@ -1,10 +1,12 @@
 import os
-import gzip
 import click
-import pandas as pd
 from pathlib import Path
-from home_messages_db import HomeMessagesDB
+from ingest import P1Tool, local_to_epoch
 import re
+from lazy_modules import lazy_import
+
+# pandas is loaded at its first use (see lazy_modules.py), so that --help starts fast
+pd = lazy_import('pandas')
 
 
 def normalize(col):
@@ -25,80 +27,86 @@ ALIAS_MAP = {
     'usage': 'usage'
 }
 
+def source_columns(columns):
+    """
+    The function looks up the names of the time and usage columns among the given column names (e.g. the header of a file),
+    and returns them in that order. It returns None if the required columns are not present.
+    """
+    # Normalizing column names
+    norm_cols = {normalize(col): col for col in columns}
+    reverse_map = {}
+
+    # Map the column names to the aliases defined above
+    for alias, target in ALIAS_MAP.items():
+        if alias in norm_cols:
+            reverse_map[target] = norm_cols[alias]
+
+    if not {'time', 'usage'}.issubset(reverse_map):
+        return None
+    return [reverse_map['time'], reverse_map['usage']]
+
+def to_epoch(data, fmt=None):
+    """
+    The function converts the 'time' column of a dataframe with the 'time' and 'usage' columns
+    to Unix time values, and returns a dataframe with the 'epoch' and 'usage' columns.
+    The timestamps are parsed with the explicit format fmt, which is detected from the data if it is not given.
+    The readings in the hour that occurs twice when the clocks go back are assigned to the right offset
+    using the order of the cumulative counter (see local_to_epoch() in ingest.py), instead of being dropped.
+    """
+    epochs, valid = local_to_epoch(data['time'], pd.to_numeric(data['usage'], errors='coerce').to_numpy(), fmt=fmt)
+    # Drop the invalid (or non-existent) timestamps, and replace the time column by the Unix time values
+    return data.loc[valid, ['usage']].assign(epoch=epochs[valid])
+
+# The steps of the ingest are shared with the other P1 tool (see P1Tool in ingest.py)
+TOOL = P1Tool('p1g', 'gas', source_columns, ['time', 'usage'], to_epoch)
+
 """
 In the command line interface, supply the address of the database
 and the paths (or a single path) of the gas data to be inserted in the gas table of the database.
+With --chunksize, the files are streamed: every chunk is cleaned and inserted on its own, so the memory
+use does not grow with the number or size of the files. With --workers, the files are parsed in parallel 
+by a pool of processes, while the insertion is done by the main process. The result does not depend on the number of workers.
+Files that were ingested before are skipped, unless they changed or --force is given.
+With --metrics, the timings and row counts of the stages (read, normalize, timezone, dedup, compare_entires, write and rollups)
+are written as lines of JSON to the given file ('-' for the standard output, and the messages then go to the standard error),
+followed by a summary of the totals per stage.
+With --load-mode, a SQLite database is put in a faster mode for bulk loads during the run (see HomeMessagesDB.load_mode()).
+With --snapshots, the Parquet snapshots in the given directory are refreshed after the ingest (see HomeMessagesDB.export_snapshots()).
+With --watch DIR, the tool keeps following a directory instead (until it is stopped with Ctrl+C): the new compressed files
+whose name matches --pattern are ingested once they are complete, and of growing plain CSV files, the lines that are appended 
+are ingested every --interval seconds. Every batch is committed with its rollups, so it can be queried right away.
+With --household ID, the data goes to the database of that household: -d is then a URL template with {household}
+(e.g. sqlite:///homes/{household}.db), and the snapshots go to a subdirectory per household (see households.py).
 """
 @click.command()
 @click.argument('files', nargs=-1, type=click.Path(exists=True))  # Accepting multiple files
 @click.option('-d', required=True, help='SQLAlchemy database URL, e.g. sqlite:///your_database.db')
-
-def p1g(files, d):
+@click.option('--household', default=None,
+              help='Id of the household; -d is then a URL template with {household}, e.g. sqlite:///homes/{household}.db')
+@click.option('--chunksize', type=click.IntRange(min=1), default=None,
+              help='Stream the files, reading, cleaning and inserting this many rows at a time.')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of processes used to parse the files.')
+@click.option('--force', is_flag=True, help='Also ingest the files that were ingested before and did not change.')
+@click.option('--metrics', 'metrics_file', type=click.File('a'), default=None,
+              help='Append the timings and row counts of the stages as JSON lines to this file.')
+@click.option('--count-rows', is_flag=True, help='Print the number of rows in the table before and after every insertion.')
+@click.option('--load-mode', is_flag=True,
+              help='For SQLite: load with write-ahead logging and relaxed syncing, and build the secondary indexes at the end.')
+@click.option('--snapshots', 'snapshot_dir', type=click.Path(file_okay=False), default=None,
+              help='Directory of the Parquet snapshots of the database, that are brought up to date after the ingest.')
+@click.option('--watch', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Keep following this directory, ingesting new files and the lines appended to growing CSV files.')
+@click.option('--pattern', default='P1g*', show_default=True, help='The names of the files to follow with --watch.')
+@click.option('--interval', type=click.FloatRange(min=0.1), default=2.0, show_default=True,
+              help='Seconds between two looks at the directory with --watch.')
+
+def p1g(files, d, household, chunksize, workers, force, metrics_file, count_rows, load_mode, snapshot_dir, watch, pattern, interval):
     """
     The function aggregates and cleans the gas usage data, and 
     calls a method of the HomeMessagesDB class to handle insertion into the database.
     """
-    frames = []  # Collected DataFrames
-
-    for file in files:
-        try:
-            # Reading .csv or .csv.gz
-            opener = gzip.open if file.endswith('.gz') else open
-            with opener(file, 'rt', encoding='utf-8', errors='replace') as f:
-                df = pd.read_csv(f)
-
-            # Normalizing column names
-            norm_cols = {normalize(col): col for col in df.columns}
-            reverse_map = {}
-
-            # Map the column names to the aliases defined above
-            for alias, target in ALIAS_MAP.items():
-                if alias in norm_cols:
-                    reverse_map[target] = norm_cols[alias]
-
-            if not {'time', 'usage'}.issubset(reverse_map):
-                click.echo(f"Skipping file: {file} — Missing required columns.")
-                continue
-
-            # Selecting and renaming
-            df = df[[reverse_map['time'], reverse_map['usage']]].copy()
-            df.columns = ['time', 'usage']
-
-            frames.append(df)
-
-        except Exception as e:
-            click.echo(f"Error reading file: {file} — {e}")
-
-    if not frames:
-        click.echo("No valid gas data loaded.")
-        return
-
-    # Concatenating data
-    data = pd.concat(frames)
-    data['time'] = pd.to_datetime(data['time'], errors='coerce')
-
-    # Converting to epoch (UTC)
-    data['epoch'] = data['time'].dt.tz_localize('Europe/Amsterdam',ambiguous='NaT')
-    # Drop invalid timestamps
-    data = data.dropna(subset=['epoch'])  
-    data['epoch'] = data['epoch'].dt.tz_convert('UTC')
-    # Convert to Unix Time
-    data['epoch'] = data['epoch'].astype('int64') // 1_000_000_000
-
-    # Remove the time column
-    data = data.drop('time', axis=1) 
-
-    # Deduplicating
-    data = data.drop_duplicates(subset=['epoch'], keep='last')
-    data = data.sort_values('epoch').reset_index(drop=True)
-
-    # We drop all nan values, since we need all values to be present for analysis
-    data = data.dropna()
-
-    # Create an object of the main database handling class, and call a method to insert the cleaned data
-    # into the 'gas' table:
-    db_instance = HomeMessagesDB(d)
-    db_instance.insert_p1g_data(data, 'gas')
+    TOOL.run(files, d, household, chunksize, workers, force, metrics_file, count_rows, load_mode, snapshot_dir, watch, pattern, interval)
 
 # For calling from the command line interface
 if __name__ == '__main__':
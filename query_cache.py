@@ -0,0 +1,132 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from lazy_modules import lazy_import
+
+# pandas and numpy are loaded at their first use (see lazy_modules.py)
+pd = lazy_import('pandas')
+
+"""
+The cache of the results of the query methods of HomeMessagesDB (see HomeMessagesDB.cached()).
+A result is stored under a key made of the query method and its arguments, together with the versions of the months
+of the tables that the query reads (the 'data_versions' table, which every insertion updates in the same transaction as
+the readings). A result is only returned when these versions are still the same, so it is never stale after an ingest,
+also when the ingest ran in another process. An insertion only invalidates the results that cover the months it changed.
+The results are kept in memory (the least recently used ones are dropped when max_bytes is exceeded), and with a
+directory also on disk, as pickle files, so that they survive a restart of the notebook.
+"""
+
+class QueryCache:
+    """
+    The class holds the cached query results in memory, up to max_bytes (as counted by DataFrame.memory_usage()),
+    and optionally in a directory on disk. The hits and misses are counted in self.hits and self.misses.
+    One cache can be shared by several HomeMessagesDB objects and threads. A pickled copy (e.g. in a worker process)
+    starts with an empty memory, but shares the directory.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()  # key -> (versions, dataframe, size in bytes), the most recently used last
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        The function returns the state of the cache for pickling (e.g. to the worker processes of a Portfolio): 
+        the settings only. The results in memory and the lock are not sent along; the files on disk are shared.
+        """
+        return {'max_bytes': self.max_bytes, 'directory': self.directory}
+
+    def __setstate__(self, state):
+        """
+        The function recreates a pickled cache, empty in memory.
+        """
+        self.__init__(**state)
+
+    def get(self, key, versions):
+        """
+        The function returns a copy of the result stored under key if it was stored with the same versions, and else None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == versions:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # A copy, so that changes by the caller do not end up in the cache
+                return entry[1].copy()
+
+        df = self.read_file(key, versions)
+        with self.lock:
+            if df is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.keep(key, versions, df)
+        return df.copy()
+
+    def put(self, key, versions, df):
+        """
+        The function stores a result under key, together with the versions of the data it was computed from.
+        """
+        self.keep(key, versions, df.copy())
+        if self.directory is not None:
+            self.write_file(key, versions, df)
+
+    def keep(self, key, versions, df):
+        """
+        Helper function that keeps a result in memory, and drops the least recently used ones when the cache is too large
+        """
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[2]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (versions, df, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][2]
+
+    def clear(self):
+        """
+        The function empties the cache in memory (the files on disk are left alone; they are checked when they are read).
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def path(self, key):
+        """
+        Helper function that returns the path of the file of a key on disk
+        """
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + '.pkl')
+
+    def read_file(self, key, versions):
+        """
+        The function returns the result stored on disk under key with the same versions, or None.
+        """
+        if self.directory is None or not os.path.exists(self.path(key)):
+            return None
+        try:
+            stored_key, stored_versions, df = pd.read_pickle(self.path(key))
+        except Exception:
+            # A damaged file is treated as missing, and replaced by the next put()
+            return None
+        if stored_key != key or stored_versions != versions:
+            return None
+        return df
+
+    def write_file(self, key, versions, df):
+        """
+        The function stores a result on disk. The file is written next to its destination first and then moved in place,
+        so that a reader never sees a half-written file.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        pd.to_pickle((key, versions, df), tmp_path)
+        os.replace(tmp_path, path)
@@ -1,18 +1,214 @@
-import pandas as pd
+import json
+import functools
 import click 
-import home_messages_db 
-import numpy as np
+from ingest import parallel_map, progress_output, new_files, file_record, follow_directory
+from instrumentation import Metrics, json_lines
+from households import household_url, household_dir
+from lazy_modules import lazy_import
+
+# pandas, numpy and the database are loaded at their first use (see lazy_modules.py), so that --help starts fast
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+home_messages_db = lazy_import('home_messages_db')
+
+def read_file(file, chunksize=None):
+    """
+    Generator that reads a smartthings file (compressed or not, or a text buffer). If a chunksize is given, the file is read
+    in pieces of that many rows, otherwise the whole file is returned as one dataframe. 
+    """
+    # The value column is always read as text, since a chunk might happen to only contain numeric values.
+    # The columns that describe the sensor only have a few distinct values, so they are read as categories
+    dtype = {'value': str, **{col: 'category' for col in home_messages_db.SENSOR_COLUMNS}}
+    if chunksize is None:
+        yield pd.read_csv(file, sep = '\t', compression = 'infer', dtype = dtype) # Compressed files will be automatically opened
+    else:
+        with pd.read_csv(file, sep = '\t', compression = 'infer', dtype = dtype, chunksize = chunksize) as reader:
+            yield from reader
+
+# The plausibility rules of the readings. A rule applies to the readings of an attribute, optionally only to the devices 
+# with the given name and only in the given months (in local time), and rejects the numeric values below 'min' or above 'max'.
+PLAUSIBILITY_RULES = [
+    {'rule': 'temperature_range', 'attribute': 'temperature', 'min': -20, 'max': 50},
+    # Suspect low temperatures in the summer months (below 2°C)
+    {'rule': 'temperature_low_in_summer', 'attribute': 'temperature', 'months': [6, 7, 8, 9], 'min': 2},
+    # Suspect high temperatures in the cold months (above 25°C)
+    {'rule': 'temperature_high_in_winter', 'attribute': 'temperature', 'months': [11, 12, 1, 2], 'max': 25},
+    {'rule': 'humidity_range', 'attribute': 'humidity', 'min': 0, 'max': 100},
+]
+
+def load_rules(file):
+    """
+    The function reads a list of plausibility rules (in the format of PLAUSIBILITY_RULES) from an open JSON file,
+    and checks that every rule has a name, an attribute and a bound. It raises a ValueError otherwise.
+    """
+    rules = json.load(file)
+    if not isinstance(rules, list):
+        raise ValueError("The rules should be a list of objects")
+    for rule in rules:
+        if not {'rule', 'attribute'}.issubset(rule) or not {'min', 'max'} & set(rule):
+            raise ValueError(f"Every rule needs a 'rule', an 'attribute' and a 'min' and/or 'max': {rule}")
+        unknown = set(rule) - {'rule', 'attribute', 'name', 'months', 'min', 'max'}
+        if unknown:
+            raise ValueError(f"Unknown fields {sorted(unknown)} in rule {rule['rule']}")
+    return rules
+
+def validate(smartthings, rules=PLAUSIBILITY_RULES, tz='Europe/Amsterdam'):
+    """
+    The function checks the readings against the plausibility rules in a single pass over the numeric values, and returns
+    the readings that pass all rules, together with the number of rejected readings per rule (a reading that breaks
+    several rules is counted by the first one). The 'epoch' column must hold Unix time values. 
+    Values that are not numeric are not rejected.
+    """
+    value = pd.to_numeric(smartthings['value'], errors='coerce').to_numpy(dtype='float64')
+    # The attributes and device names are compared as integer codes
+    attribute_codes, attributes = pd.factorize(smartthings['attribute'])
+    name_codes, names = pd.factorize(smartthings['name'])
+    month = None
+    rejected = np.zeros(smartthings.shape[0], dtype=bool)
+    counts = {}
+
+    for rule in rules:
+        # A code of -1 means that the attribute (or name) is not in the batch; missing values also get -1, 
+        # so such a rule applies to no reading
+        attribute_code = attributes.get_indexer([rule['attribute']])[0]
+        name_code = names.get_indexer([rule['name']])[0] if 'name' in rule else None
+        if attribute_code == -1 or name_code == -1:
+            counts[rule['rule']] = 0
+            continue
+        applies = attribute_codes == attribute_code
+        if name_code is not None:
+            applies &= name_codes == name_code
+        if 'months' in rule:
+            if month is None:
+                month = pd.to_datetime(smartthings['epoch'].to_numpy(), unit='s', utc=True).tz_convert(tz).month.to_numpy()
+            applies &= np.isin(month, rule['months'])
+        broken = applies & ((value < rule.get('min', -np.inf)) | (value > rule.get('max', np.inf)))
+        counts[rule['rule']] = int((broken & ~rejected).sum())
+        rejected |= broken
+
+    return smartthings[~rejected], counts
+
+def clean(smartthings, rules=PLAUSIBILITY_RULES, metrics=None):
+    """
+    The function performs the cleaning steps on a dataframe read from the smartthings source,
+    so that the dataframe is ready for insertion: removing the duplicates, converting the time 
+    to Unix time values, and dropping the readings that break one of the plausibility rules (see validate()).
+    The stages are timed with metrics (a Metrics object, see instrumentation.py), if it is given.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+
+    with metrics.stage('dedup', rows_in=smartthings.shape[0]) as event:
+        # Remove duplicates 
+        smartthings=smartthings.drop_duplicates()
+        # Remove rows with missing values in the epoch column
+        smartthings = smartthings.dropna(subset=['epoch'])
+        event['rows_out'] = smartthings.shape[0]
+
+    with metrics.stage('timezone', rows_in=smartthings.shape[0]) as event:
+        # The timestamps carry their UTC offset. With utc=True, files that span a DST change (and so contain 
+        # two UTC offsets) are parsed as well. Timestamps that cannot be parsed are dropped.
+        epoch = pd.to_datetime(smartthings['epoch'], errors='coerce', utc=True)
+        smartthings = smartthings[epoch.notna().to_numpy()].assign(epoch=(epoch.dropna().astype('int64') // 1_000_000_000).to_numpy())
+        event['rows_out'] = smartthings.shape[0]
+
+    with metrics.stage('validate', rows_in=smartthings.shape[0]) as event:
+        smartthings, rejected = validate(smartthings, rules)
+        event['rows_out'] = smartthings.shape[0]
+        event['rejected'] = rejected
+
+    for rule, n in rejected.items():
+        if n:
+            print(f"Dropped {n} records that break the plausibility rule '{rule}'")
+
+    return smartthings
+
+def parse_file(file, metrics=None, rules=PLAUSIBILITY_RULES):
+    """
+    The function reads and cleans a single file, using the given plausibility rules. It returns the columns as numpy arrays,
+    which are cheap to send back from a worker process, and the number of rows in the file, or None together with a message
+    if the file could not be used (e.g. a truncated download), so that the other files are still ingested.
+    The stages are timed with metrics (a Metrics object, see instrumentation.py), if it is given.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    try:
+        df = pd.concat(metrics.iterate('read', read_file(file), file=file), ignore_index=True)
+        rows_read = df.shape[0]
+        df = clean(df, rules, metrics)
+    except Exception as e:
+        return None, 0, f"Error reading file: {file} — {e}"
+    # The categorical columns are returned as they are, since they are smaller than the strings they stand for
+    return {col: df[col].array if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].to_numpy() for col in df.columns}, rows_read, None
+
+def ingest_file(db, file, rules=PLAUSIBILITY_RULES, metrics=None):
+    """
+    The function reads, cleans and inserts a single complete file, and adds it to the manifest, for the --watch mode.
+    """
+    columns, rows_read, message = parse_file(file, metrics, rules)
+    if message is not None:
+        click.echo(message)
+        return
+    data = pd.DataFrame(columns).drop_duplicates()
+    if db.insert_smartthings(data) is not None:
+        db.record_files('smartthings', [file_record(file, rows_read, data.shape[0], data['epoch'])])
+
+def ingest_lines(db, buffer, rules=PLAUSIBILITY_RULES, metrics=None):
+    """
+    The function cleans and inserts a batch of lines of a growing smartthings file (a text buffer that starts with the header line),
+    for the --watch mode (see follow_directory() in ingest.py). The timestamps carry their UTC offset, so no rows 
+    have to be held back: it returns 0, or None if the batch could not be inserted.
+    """
+    data = clean(next(read_file(buffer)), rules, metrics)
+    if data.shape[0] and db.insert_smartthings(data) is None:
+        return None
+    return 0
 
 """
 In the command line interface, supply the address of the database
 and the paths (or a single path) of the smartthings data to be inserted in the smarthtings table of the database.
+With --chunksize, the files are streamed: every chunk is cleaned and inserted on its own, so the memory
+use does not grow with the number or size of the files. With --workers, the files are read and cleaned in parallel 
+by a pool of processes, while the insertion is done by the main process. The result does not depend on the number of workers.
+Files that were ingested before are skipped, unless they changed or --force is given.
+With --metrics, the timings and row counts of the stages (read, dedup, timezone, validate, sensor_ids, compare_entires, write and rollups)
+are written as lines of JSON to the given file ('-' for the standard output, and the messages then go to the standard error),
+followed by a summary of the totals per stage.
+With --load-mode, a SQLite database is put in a faster mode for bulk loads during the run (see HomeMessagesDB.load_mode()).
+The readings are checked against the plausibility rules in PLAUSIBILITY_RULES; with --rules, the rules are read from 
+a JSON file instead (a list of rules in the same format).
+With --watch DIR, the tool keeps following a directory instead (until it is stopped with Ctrl+C): the new compressed files
+whose name matches --pattern are ingested once they are complete, and of growing plain TSV files, the lines that are appended 
+are ingested every --interval seconds. Every batch is committed with its rollups, so it can be queried right away.
+With --household ID, the data goes to the database of that household: -d is then a URL template with {household}
+(e.g. sqlite:///homes/{household}.db), and the snapshots go to a subdirectory per household (see households.py).
+With --snapshots, the Parquet snapshots in the given directory are refreshed after the ingest (see HomeMessagesDB.export_snapshots()).
 """
 @click.command()
 @click.argument('files', nargs=-1)  
 @click.option('-d', required=True, help='SQLAlchemy database URL, e.g. sqlite:///your_database.db') 
+@click.option('--household', default=None,
+              help='Id of the household; -d is then a URL template with {household}, e.g. sqlite:///homes/{household}.db')
+@click.option('--chunksize', type=click.IntRange(min=1), default=None,
+              help='Stream the files, reading, cleaning and inserting this many rows at a time.')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of processes used to read and clean the files.')
+@click.option('--force', is_flag=True, help='Also ingest the files that were ingested before and did not change.')
+@click.option('--metrics', 'metrics_file', type=click.File('a'), default=None,
+              help='Append the timings and row counts of the stages as JSON lines to this file.')
+@click.option('--count-rows', is_flag=True, help='Print the number of rows in the table before and after every insertion.')
+@click.option('--load-mode', is_flag=True,
+              help='For SQLite: load with write-ahead logging and relaxed syncing, and build the secondary indexes at the end.')
+@click.option('--rules', 'rules_file', type=click.File('r'), default=None,
+              help='JSON file with the plausibility rules, replacing the default ones.')
+@click.option('--snapshots', 'snapshot_dir', type=click.Path(file_okay=False), default=None,
+              help='Directory of the Parquet snapshots of the database, that are brought up to date after the ingest.')
+@click.option('--watch', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Keep following this directory, ingesting new files and the lines appended to growing TSV files.')
+@click.option('--pattern', default='smartthings*', show_default=True, help='The names of the files to follow with --watch.')
+@click.option('--interval', type=click.FloatRange(min=0.1), default=2.0, show_default=True,
+              help='Seconds between two looks at the directory with --watch.')
 
 
-def smartthings(files,d): 
+def smartthings(files,d,household,chunksize,workers,force,metrics_file,count_rows,rules_file,load_mode,snapshot_dir,watch,pattern,interval): 
 
     """
     The function reads the data from the smartthings source, performs cleaning, and passes the cleaned dataframe to a 
@@ -23,92 +219,117 @@ def smartthings(files,d):
     if (len(files) or len(d))==0:
         click.UsageError("Plase provide the database address and the file path(s)")
 
-    # Read compressed data from all files in the directory (or from one file) into a dataframe
-    if len(files)==1:
-        smartthings=pd.read_csv(files[0], sep = '\t', compression = 'gzip') # Compressed files will be automatically opened
-    else: 
-        # Filter out files with the right extension (to remove unnecessary system files),
-        # and concatenate all records in one table
+    # Filter out files with the right extension (to remove unnecessary system files)
+    if len(files)>1:
         files=[i for i in files if i.endswith('.gz')]
-        smartthings = pd.concat((pd.read_csv(file, sep = '\t', compression = 'gzip') for file in files),
-                                 ignore_index=True) 
-
-    ####### Cleaning  #######
-
-    # Remove duplicates 
-    smartthings=smartthings.drop_duplicates()
-    # Remove rows with missing values in the epoch column
-    smartthings = smartthings.dropna(subset=['epoch'])
-    # Convert to datetime first, to make it possible to convert to UTC
-    smartthings['epoch'] = pd.to_datetime(smartthings['epoch'], errors='coerce')
-
-    # Take steps to make it possible to remove the implausible temperature values 
-    smarthtings_temp_check=smartthings.loc[smartthings['attribute']=='temperature'].copy()
-    smarthtings_temp_check["value"] = pd.to_numeric(smarthtings_temp_check["value"], errors="coerce")
-    smarthtings_temp_check["value"] = smarthtings_temp_check["value"].astype(int)
-
-    general_susp_temp = smarthtings_temp_check[
-        (smarthtings_temp_check["attribute"] == "temperature") &
-        (smarthtings_temp_check["value"] > 50) &
-        (smarthtings_temp_check["value"] < 20)
-    ]
-    # Check suspect low temperatures in months 7–10 (below 2°C)
-    low_temp_summer = smarthtings_temp_check[
-        (smarthtings_temp_check["attribute"] == "temperature") &
-        (smarthtings_temp_check["value"] < 2) &
-        (smarthtings_temp_check["epoch"].dt.month.isin([6, 7, 8, 9]))
-    ]
-
-    # Check suspect high temperatures in cold months (bigger than 25)
-    high_temp_winter = smarthtings_temp_check[
-        (smarthtings_temp_check["attribute"] == "temperature") &
-        (smarthtings_temp_check["value"] > 25) &  
-        (smarthtings_temp_check["epoch"].dt.month.isin([11, 12, 1, 2]))
-    ]
-    num_invalid_temp_records=len(general_susp_temp)+len(high_temp_winter)+len(low_temp_summer)
-
-    # Drop the invalid observations
-    smartthings = smartthings.drop(general_susp_temp.index)
-    smartthings = smartthings.drop(high_temp_winter.index)
-    smartthings = smartthings.drop(low_temp_summer.index)
-
-    print(f'Dropped {num_invalid_temp_records} records with invalid temperature values')
-
-    # Take steps to make it possible to remove the implausible humidity values 
-    smarthtings_hum_check=smartthings.loc[smartthings['attribute']=='humidity'].copy()
-    smarthtings_hum_check["value"] = pd.to_numeric(smarthtings_hum_check["value"], errors="coerce")
-    smarthtings_hum_check["value"] = smarthtings_hum_check["value"].astype(int)
-
-    general_susp_humid = smarthtings_hum_check[
-        (smarthtings_hum_check["value"] > 100) &
-        (smarthtings_hum_check["value"] < 0)
-    ]
-    num_invalid_hum_records=len(general_susp_humid)
-    # Drop the invalid humidity observations
-    smartthings = smartthings.drop(general_susp_humid.index)
-    print(f'Dropped {num_invalid_hum_records} records with invalid humidity values')
-
-    #smartthings["value"] = smartthings["value"].astype(str)
-
-    # Convert to Unix Time  
-    smartthings['epoch'] = smartthings['epoch'].dt.tz_convert('UTC')
-    smartthings['epoch'] = smartthings['epoch'].astype('int64') // 1_000_000_000
-
-    # In case of smartthings, the epoch can't be used as a unique id, since multiple devices can produce measurements
-    # at the same time. Thus, we create an id column, that is a composite of the existing columns:
-    loc_part=smartthings['loc'].str[0:2] + '_' # Take the first two letters of the 'location' column; similar for rest. 
-    lvl_part=smartthings['level'].str[0:2] + '_'
-    name_part=smartthings['name'].str[:]+ '_'
-    capability_part=smartthings['capability'].str[0:2]+ '_'
-    att_part=smartthings['attribute'].str[0:2]+ '_'
-    val_part=smartthings['value'].str[:]+ '_'
-    epoch_part=np.char.mod('%d', np.array(smartthings['epoch']))
-    smartthings['id']=loc_part+lvl_part+name_part+capability_part+att_part+val_part+epoch_part
-
-    # Initialize an instance of the class handling the insertion
-    db = home_messages_db.HomeMessagesDB(d)   
-    # Use the method of the class to insert the data into the database 
-    db.insert_smartthings(smartthings)
+
+    if household is not None:
+        # Every household has its own database (and snapshots)
+        try:
+            d, snapshot_dir = household_url(d, household), household_dir(snapshot_dir, household)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--household')
+
+    rules = PLAUSIBILITY_RULES
+    if rules_file is not None:
+        try:
+            rules = load_rules(rules_file)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--rules')
+    parse = functools.partial(parse_file, rules=rules)
+
+    # Initialize an instance of the class handling the insertion, and skip the files that were already ingested before
+    metrics = Metrics(json_lines(metrics_file) if metrics_file else None, source='smartthings')
+    if metrics_file:
+        # The summary is written when the command finishes, also if it returns early
+        click.get_current_context().call_on_close(metrics.summary)
+    # With --metrics -, the standard output only holds the lines of JSON
+    click.get_current_context().with_resource(progress_output(metrics_file))
+    if watch is not None and (files or load_mode):
+        # With --load-mode, the indexes would not be current while following the directory
+        raise click.UsageError("Give either files or --watch, and do not combine --watch with --load-mode")
+    if watch is None and not files:
+        # Nothing to do, so the database is not opened
+        click.echo("No files to ingest.")
+        return
+    db = home_messages_db.HomeMessagesDB(d, metrics=metrics, count_rows=count_rows, snapshot_dir=snapshot_dir, household=household)   
+    if load_mode:
+        # The normal settings are restored when the command finishes
+        click.get_current_context().with_resource(db.load_mode())
+    if snapshot_dir:
+        # The months that changed are written to the snapshots when the command finishes
+        click.get_current_context().call_on_close(db.export_snapshots)
+
+    if watch is not None:
+        follow_directory(db, 'smartthings', watch, pattern, functools.partial(ingest_file, rules=rules, metrics=metrics),
+                         functools.partial(ingest_lines, rules=rules, metrics=metrics), interval,
+                         on_loaded=db.export_snapshots if snapshot_dir else None)
+        return
+
+    files = new_files(db, 'smartthings', files, force)
+    if not files:
+        click.echo("All files have already been ingested.")
+        return
+
+    if chunksize is not None and workers > 1:
+        # Every file is cleaned by a worker process, and inserted in chunks
+        for file, (columns, rows_read, message) in zip(files, parallel_map(parse, files, workers, metrics)):
+            if message is not None:
+                click.echo(message)
+                continue
+            with metrics.stage('dedup', rows_in=len(columns['epoch']), file=file) as event:
+                data = pd.DataFrame(columns).drop_duplicates()
+                event['rows_out'] = data.shape[0]
+            inserted = True
+            for start in range(0, data.shape[0], chunksize):
+                inserted &= db.insert_smartthings(data.iloc[start:start + chunksize]) is not None
+            # A file is added to the manifest once all of its chunks were inserted
+            if inserted:
+                db.record_files('smartthings', [file_record(file, rows_read, data.shape[0], data['epoch'])])
+        return
+
+    if chunksize is not None:
+        # Clean and insert every chunk separately
+        for file in files:
+            try:
+                rows_read, rows_clean, epochs, inserted = 0, 0, [], True
+                for chunk in metrics.iterate('read', read_file(file, chunksize), file=file):
+                    rows_read += chunk.shape[0]
+                    chunk = clean(chunk, rules, metrics)
+                    rows_clean += chunk.shape[0]
+                    epochs += [chunk['epoch'].min(), chunk['epoch'].max()] if chunk.shape[0] else []
+                    inserted &= db.insert_smartthings(chunk) is not None
+                # Only a file that was read up to its end is added to the manifest (the chunks before an error stay inserted)
+                if inserted:
+                    db.record_files('smartthings', [file_record(file, rows_read, rows_clean, epochs)])
+            except Exception as e:
+                click.echo(f"Error reading file: {file} — {e}")
+        return
+
+    # Read and clean the compressed data from all files in the directory (or from one file), 
+    # and concatenate all records in one table, in the order of the files
+    frames = []
+    records = []  # Manifest entries of the files
+    for file, (columns, rows_read, message) in zip(files, parallel_map(parse, files, workers, metrics)):
+        if message is not None:
+            click.echo(message)
+            continue
+        frames.append(pd.DataFrame(columns))
+        records.append(file_record(file, rows_read, frames[-1].shape[0], columns['epoch']))
+    # If nothing was loaded, we quit
+    if not frames:
+        click.echo("No valid data loaded.")
+        return
+    smartthings = pd.concat(frames, ignore_index=True) 
+    # Remove the duplicates across files 
+    with metrics.stage('dedup', rows_in=smartthings.shape[0]) as event:
+        smartthings = smartthings.drop_duplicates()
+        event['rows_out'] = smartthings.shape[0]
+
+    # Use the method of the class to insert the cleaned data into the database, 
+    # and add the files to the manifest if that succeeded
+    if db.insert_smartthings(smartthings) is not None:
+        db.record_files('smartthings', records)
 
 # For running the file through the command line interface
 if __name__ == '__main__':
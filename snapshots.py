@@ -0,0 +1,101 @@
+import os
+import glob
+from lazy_modules import lazy_import
+
+# pandas and numpy are loaded at their first use (see lazy_modules.py)
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+"""
+Functions to write and read the Parquet snapshots of the tables of the database, see HomeMessagesDB.export_snapshots().
+The readings and rollups are partitioned by month (in UTC), one file per table and month: <directory>/<table>/<YYYY-MM>.parquet.
+The small 'sensors' table is written as a single file: <directory>/sensors.parquet.
+The files are read with memory mapping, and only the requested columns, and the months and row groups that can
+contain the requested time range, are read.
+pyarrow is only needed when snapshots are used, so it is imported in the functions.
+"""
+
+def month_keys(epochs):
+    """
+    The function returns the distinct months (as 'YYYY-MM' strings) of an array of Unix time values.
+    """
+    epochs = np.asarray(epochs, dtype='int64')
+    return np.unique(epochs.astype('datetime64[s]').astype('datetime64[M]')).astype(str).tolist()
+
+def month_counts(epochs):
+    """
+    The function returns the number of Unix time values per month, as a dictionary of 'YYYY-MM' strings and counts.
+    """
+    epochs = np.asarray(epochs, dtype='int64')
+    months, counts = np.unique(epochs.astype('datetime64[s]').astype('datetime64[M]'), return_counts=True)
+    return dict(zip(months.astype(str).tolist(), counts.tolist()))
+
+def month_range(epoch_min, epoch_max):
+    """
+    The function returns all months (as 'YYYY-MM' strings) from the month of epoch_min up to the month of epoch_max.
+    """
+    first, last = np.array([epoch_min, epoch_max], dtype='int64').astype('datetime64[s]').astype('datetime64[M]')
+    return np.arange(first, last + 1).astype(str).tolist()
+
+def month_bounds(month):
+    """
+    The function returns the first Unix time value of a month ('YYYY-MM') and the first one of the month after it.
+    """
+    start = np.datetime64(month, 'M')
+    return int(start.astype('datetime64[s]').astype('int64')), int((start + 1).astype('datetime64[s]').astype('int64'))
+
+def partition_path(directory, table_name, month=None):
+    """
+    The function returns the path of the snapshot of a table, or of one month of it.
+    """
+    if month is None:
+        return os.path.join(directory, f'{table_name}.parquet')
+    return os.path.join(directory, table_name, f'{month}.parquet')
+
+def write_partition(path, df):
+    """
+    The function writes a dataframe to a Parquet file. The file is written next to its destination first and
+    then moved in place, so that a reader never sees a half-written file. An empty dataframe removes the file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if df.shape[0] == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+
+def read_partitions(directory, table_name, columns=None, start=None, end=None, time_column='epoch', filters=None):
+    """
+    The function reads the snapshot of a table, with only the given columns, and only the rows with
+    start <= time_column <= end (either can be left out) that pass the extra filters (in the pyarrow format,
+    e.g. [('sensor_id', 'in', [1, 2])]). The files of the months outside the time range are not opened.
+    It returns a dataframe, or None if there are no files to read.
+    """
+    import pyarrow.parquet as pq
+
+    if not os.path.isdir(os.path.join(directory, table_name)):
+        files = [partition_path(directory, table_name)] if os.path.exists(partition_path(directory, table_name)) else []
+    else:
+        files = sorted(glob.glob(os.path.join(directory, table_name, '*.parquet')))
+        # Skip the months that are outside the time range
+        if start is not None or end is not None:
+            first = month_keys([start])[0] if start is not None else None
+            last = month_keys([end])[0] if end is not None else None
+            months = [os.path.basename(file)[:-len('.parquet')] for file in files]
+            files = [file for file, month in zip(files, months) if (first is None or month >= first) and (last is None or month <= last)]
+    if not files:
+        return None
+
+    filters = list(filters or [])
+    if start is not None:
+        filters.append((time_column, '>=', int(start)))
+    if end is not None:
+        filters.append((time_column, '<=', int(end)))
+    table = pq.read_table(files, columns=columns, filters=filters or None, memory_map=True)
+
+    return table.to_pandas()
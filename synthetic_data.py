@@ -0,0 +1,225 @@
+import os
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+
+"""
+Generators of synthetic export files that look like the data of the 'P1e', 'P1g' and 'Smartthings' sources.
+They are used by bench_ingest.py, and can be used to try out the tools without the real data.
+
+The files are written per day (like the real exports), gzipped, and cycle through the different header
+spellings that the tools have to recognize. Unless turned off, they contain the irregularities that the cleaning
+steps deal with: readings that appear in two files, duplicate rows, unparseable timestamps, missing values,
+and implausible temperature and humidity values. Whether a DST transition is included depends on the date range;
+the default start dates of bench_ingest.py make sure it is.
+weather_archive() runs a local stand-in for the Open-Meteo archive that openweathermap.py retrieves the weather from.
+"""
+
+# Header spellings of the electricity exports, all known to ALIAS_MAP in p1e.py. Extra columns are added, like in the real data.
+P1E_HEADERS = [
+    ['time', 'Import T1 kWh', 'Import T2 kWh', 'Export T1 kWh', 'Export T2 kWh'],
+    ['time', 'Electricity imported T1', 'Electricity imported T2', 'Electricity exported T1', 'Electricity exported T2', 'Power'],
+    ['Time', 'T1', 'T2'],
+    ['TIME', 'import_t1', 'import_t2', 'Production'],
+]
+# Header spellings of the gas exports, all known to ALIAS_MAP in p1g.py
+P1G_HEADERS = [
+    ['time', 'Total gas used'],
+    ['time', 'Gas usage'],
+    ['Time', 'T1 gas'],
+    ['time', 'gas'],
+    ['time', 'usage'],
+]
+# The devices of the smartthings exports: (loc, level, name, capability, attribute, unit)
+SMARTTHINGS_SENSORS = [
+    ('Home', 'Garden', 'Garden air (sensor)', 'temperatureMeasurement', 'temperature', 'C'),
+    ('Home', 'Garden', 'Garden air (sensor)', 'relativeHumidityMeasurement', 'humidity', '%'),
+    ('Home', 'Ground floor', 'Living room (sensor)', 'temperatureMeasurement', 'temperature', 'C'),
+    ('Home', 'Ground floor', 'Living room (sensor)', 'relativeHumidityMeasurement', 'humidity', '%'),
+    ('Home', 'Ground floor', 'Kitchen plug', 'powerMeter', 'power', 'W'),
+    ('Home', 'First floor', 'Washing machine plug', 'energyMeter', 'energy', 'kWh'),
+    ('Home', 'First floor', 'Bedroom lamp', 'switch', 'switch', None),
+]
+
+def local_times(start, days, interval):
+    """
+    The function returns the local wall clock times (as naive timestamps, like in the P1 exports) of the readings
+    every 'interval' seconds during the given number of days, in the Europe/Amsterdam time zone.
+    In the autumn, the hour that occurs twice is therefore present twice.
+    """
+    start = pd.Timestamp(start).tz_localize('Europe/Amsterdam')
+    times = pd.date_range(start, start + pd.Timedelta(days=days), freq=f'{interval}s', inclusive='left')
+    return times.tz_localize(None)
+
+def split_days(times):
+    """
+    The function yields the positions of the readings of every local day.
+    """
+    days = times.normalize()
+    boundaries = np.flatnonzero(np.diff(days.asi8)) + 1
+    yield from np.split(np.arange(times.shape[0]), boundaries)
+
+def add_irregularities(df, rng, time_column, value_columns):
+    """
+    The function adds duplicate rows, unparseable timestamps and missing values to about 0.1% of the rows each.
+    """
+    n = df.shape[0]
+    dirty = df.copy()
+    bad_time = rng.random(n) < 0.001
+    dirty.loc[bad_time, time_column] = 'not a time'
+    for col in value_columns:
+        dirty.loc[rng.random(n) < 0.001, col] = np.nan
+    duplicates = dirty[rng.random(n) < 0.001]
+    return pd.concat([dirty, duplicates]).sort_index(kind='stable')
+
+def write_p1e(directory, start='2022-10-25', days=7, interval=60, irregular=True, seed=0):
+    """
+    The function writes one gzipped electricity export per day into the directory, and returns the paths of the files.
+    Every file also repeats the last readings of the previous day, as overlapping exports do.
+    """
+    rng = np.random.default_rng(seed)
+    times = local_times(start, days, interval)
+    # Cumulative counters, with more use during the day (T1) than at night (T2)
+    t1 = 1000 + np.cumsum(rng.random(times.shape[0]) * 0.004)
+    t2 = 2000 + np.cumsum(rng.random(times.shape[0]) * 0.002)
+    files = []
+    for i, positions in enumerate(split_days(times)):
+        positions = np.arange(max(positions[0] - 10, 0), positions[-1] + 1)
+        header = P1E_HEADERS[i % len(P1E_HEADERS)]
+        df = pd.DataFrame({header[0]: times[positions].strftime('%Y-%m-%d %H:%M:%S'), header[1]: t1[positions], header[2]: t2[positions]})
+        for extra in header[3:]:
+            df[extra] = rng.random(positions.shape[0])
+        if irregular:
+            df = add_irregularities(df, rng, header[0], header[1:3])
+        path = os.path.join(directory, f"P1e-{times[positions[-1]].strftime('%Y-%m-%d')}.csv.gz")
+        df.to_csv(path, index=False, compression='gzip')
+        files.append(path)
+    return files
+
+def write_p1g(directory, start='2022-10-25', days=7, interval=300, irregular=True, seed=1):
+    """
+    The function writes one gzipped gas export per day into the directory, and returns the paths of the files.
+    """
+    rng = np.random.default_rng(seed)
+    times = local_times(start, days, interval)
+    usage = 500 + np.cumsum(rng.random(times.shape[0]) * 0.02)
+    files = []
+    for i, positions in enumerate(split_days(times)):
+        positions = np.arange(max(positions[0] - 2, 0), positions[-1] + 1)
+        header = P1G_HEADERS[i % len(P1G_HEADERS)]
+        df = pd.DataFrame({header[0]: times[positions].strftime('%Y-%m-%d %H:%M:%S'), header[1]: usage[positions]})
+        if irregular:
+            df = add_irregularities(df, rng, header[0], header[1:])
+        path = os.path.join(directory, f"P1g-{times[positions[-1]].strftime('%Y-%m-%d')}.csv.gz")
+        df.to_csv(path, index=False, compression='gzip')
+        files.append(path)
+    return files
+
+def sensor_values(attribute, n, rng):
+    """
+    The function returns plausible values (as text) for n readings of a sensor attribute.
+    """
+    if attribute == 'temperature':
+        return np.round(12 + 8 * rng.random(n), 1).astype(str)
+    if attribute == 'humidity':
+        return np.round(50 + 40 * rng.random(n)).astype(int).astype(str)
+    if attribute == 'power':
+        return np.round(2000 * rng.random(n) ** 4, 1).astype(str)
+    if attribute == 'energy':
+        return np.round(100 + np.cumsum(rng.random(n) * 0.01), 3).astype(str)
+    return np.where(rng.random(n) < 0.5, 'on', 'off')
+
+def write_smartthings(directory, start='2022-10-25', days=7, interval=300, irregular=True, seed=2):
+    """
+    The function writes one gzipped (tab separated) smartthings export per day into the directory, and returns the paths of the files.
+    The timestamps carry their UTC offset, like in the real exports. Implausible temperature and humidity values are
+    added to about 0.5% of those readings.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start).tz_localize('Europe/Amsterdam')
+    times = pd.date_range(start, start + pd.Timedelta(days=days), freq=f'{interval}s', inclusive='left')
+    files = []
+    for positions in split_days(times.tz_localize(None)):
+        frames = []
+        for loc, level, name, capability, attribute, unit in SMARTTHINGS_SENSORS:
+            values = sensor_values(attribute, positions.shape[0], rng)
+            if irregular and attribute in ('temperature', 'humidity'):
+                implausible = rng.random(positions.shape[0]) < 0.005
+                values[implausible] = '80.0' if attribute == 'temperature' else '120'
+            frames.append(pd.DataFrame({
+                'loc': loc, 'level': level, 'name': name,
+                'epoch': times[positions].strftime('%Y-%m-%d %H:%M:%S%z'),
+                'capability': capability, 'attribute': attribute, 'value': values, 'unit': unit
+            }))
+        df = pd.concat(frames, ignore_index=True)
+        if irregular:
+            df = pd.concat([df, df[rng.random(df.shape[0]) < 0.001]], ignore_index=True)
+        path = os.path.join(directory, f"smartthings-{times[positions[-1]].strftime('%Y-%m-%d')}.tsv.gz")
+        df.to_csv(path, sep='\t', index=False, compression='gzip')
+        files.append(path)
+    return files
+
+def synthetic_weather(epochs):
+    """
+    The function returns a plausible hourly temperature and relative humidity for an array of Unix times, with a daily and a yearly cycle.
+    """
+    epochs = np.asarray(epochs, dtype='int64')
+    day = 2 * np.pi * (epochs % 86400) / 86400
+    year = 2 * np.pi * (epochs % 31557600) / 31557600
+    temperature = np.round(10 - 7 * np.cos(year - 0.35) - 4 * np.cos(day - 0.9), 1)
+    humidity = np.round(80 - 12 * np.cos(day + 2.2)).astype(int)
+    return temperature, humidity
+
+class WeatherArchiveHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the requests to the stand-in archive: a GET with the same parameters as the Open-Meteo archive
+    (latitude, longitude, start_date, end_date, hourly=temperature_2m,relative_humidity_2m, in the GMT time zone, 
+    with timeformat=unixtime) returns the synthetic hourly weather of those days as JSON.
+    """
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        self.server.requests.append(params)
+        try:
+            start = pd.Timestamp(params['start_date'], tz='UTC')
+            end = pd.Timestamp(params['end_date'], tz='UTC') + pd.Timedelta(days=1)
+        except (KeyError, ValueError):
+            self.reply(400, {'error': True, 'reason': 'start_date and end_date are required, as YYYY-MM-DD'})
+            return
+        if end <= start:
+            self.reply(400, {'error': True, 'reason': 'end_date must not be before start_date'})
+            return
+        epochs = pd.date_range(start, end, freq='1h', inclusive='left').as_unit('s').asi8
+        temperature, humidity = synthetic_weather(epochs)
+        self.reply(200, {
+            'latitude': float(params.get('latitude', 0)), 'longitude': float(params.get('longitude', 0)),
+            'utc_offset_seconds': 0, 'timezone': 'GMT',
+            'hourly': {'time': epochs.tolist(), 'temperature_2m': temperature.tolist(), 'relative_humidity_2m': humidity.tolist()}
+        })
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The requests are kept in server.requests instead of being printed
+        pass
+
+def weather_archive(port=0):
+    """
+    The function starts the stand-in archive on localhost (on a free port by default) in a background thread, and returns the server.
+    Its url can be passed to openweathermap.weather(..., url=server.url), and the parameters of the requests it received
+    are kept in server.requests. Stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), WeatherArchiveHandler)
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1/archive"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
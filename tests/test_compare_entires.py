@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from home_messages_db import HomeMessagesDB
+
+def gas(epochs):
+    """
+    Helper function that returns gas readings at the given epochs, with the epoch as the counter value
+    """
+    epochs = np.asarray(epochs, dtype='int64')
+    return pd.DataFrame({'epoch': epochs, 'usage': epochs / 1000})
+
+def stored_epochs(db):
+    return sorted(db.query_gas()['epoch'].tolist())
+
+def test_duplicate_overlapping_and_out_of_order_batches(tmp_path):
+    db = HomeMessagesDB(f'sqlite:///{tmp_path}/dedup.db')
+    first = np.arange(1672531200, 1672531200 + 86400, 300)
+    assert db.insert_p1g_data(gas(first)) == first.shape[0]
+
+    # The same batch again
+    assert db.insert_p1g_data(gas(first)) == 0
+    # Partially overlapping, and out of order
+    overlap = np.arange(first[-1] - 3600, first[-1] + 3600 + 1, 300)
+    assert db.insert_p1g_data(gas(overlap[::-1])) == 12
+    # An old reading mixed with new ones, some of which are stored already
+    mixed = np.concatenate([[1640995200], overlap[-3:], [overlap[-1] + 300]])
+    assert db.insert_p1g_data(gas(mixed)) == 2
+
+    expected = sorted(set(first) | set(overlap) | set(mixed))
+    assert stored_epochs(db) == expected
+
+def test_epoch_ranges_split_at_long_gaps():
+    epochs = [5 * 86400, 0, 300, 600, 5 * 86400 + 300]
+    assert HomeMessagesDB.epoch_ranges(epochs) == [(0, 600), (5 * 86400, 5 * 86400 + 300)]
+    assert HomeMessagesDB.epoch_ranges(epochs, max_gap=5 * 86400) == [(0, 5 * 86400 + 300)]
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+from home_messages import cli
+from home_messages_db import HomeMessagesDB
+
+def epoch(day):
+    return int(pd.Timestamp(day, tz='UTC').timestamp())
+
+@pytest.fixture
+def gas_db(tmp_path):
+    """
+    A database with gas readings every 20 minutes from January up to the middle of March 2023
+    """
+    url = f'sqlite:///{tmp_path / "home.db"}'
+    epochs = np.arange(epoch('2023-01-01'), epoch('2023-03-15'), 1200)
+    HomeMessagesDB(url).insert_p1g_data(pd.DataFrame({'epoch': epochs, 'usage': np.arange(epochs.shape[0]) * 0.01}))
+    return url, epochs
+
+@pytest.mark.parametrize('start, end', [
+    (None, None), ('2023-01-10', None), (None, '2023-02-10'), ('2023-01-10', '2023-03-02'),
+    ('2023-02-01', '2023-03-01'), ('2023-02-03', '2023-02-04'), ('2023-04-01', None), (None, '2022-12-31'),
+])
+def test_count_rows_in_a_range(gas_db, start, end):
+    url, epochs = gas_db
+    first = epoch(start) if start else None
+    last = epoch(end) - 1 if end else None
+    expected = ((epochs >= (first if first is not None else epochs.min())) & (epochs <= (last if last is not None else epochs.max()))).sum()
+    assert HomeMessagesDB(url).count_rows('gas', first, last) == expected
+
+def test_query_count_with_a_range(gas_db):
+    url, _ = gas_db
+    options = ['query', 'gas', '-d', url, '--start', '2023-01-25', '--end', '2023-02-05']
+    readings = CliRunner().invoke(cli, options)
+    count = CliRunner().invoke(cli, [*options, '--count'])
+    assert count.exit_code == 0, count.output
+    assert int(count.output) == len(readings.output.splitlines()) - 1 > 0
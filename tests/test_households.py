@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+from home_messages_db import HomeMessagesDB
+from households import Portfolio
+from query_cache import QueryCache
+
+def test_process_pool_with_a_cache(tmp_path):
+    for household, start in [('h1', 0), ('h2', 3600)]:
+        db = HomeMessagesDB(f'sqlite:///{tmp_path}/{household}.db', household=household)
+        db.insert_p1g_data(pd.DataFrame({'epoch': np.arange(start, start + 86400, 300), 'usage': np.arange(288) * 0.01}))
+    cache = QueryCache(directory=str(tmp_path / 'cache'))
+    portfolio = Portfolio(f'sqlite:///{tmp_path}/{{household}}.db', processes=True, workers=2, cache=cache)
+    try:
+        gas = portfolio.query('query_gas')
+    finally:
+        portfolio.close()
+    assert gas.groupby('household').size().to_dict() == {'h1': 288, 'h2': 288}
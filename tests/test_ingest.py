@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pandas as pd
+import p1g
+from ingest import follow_directory
+from home_messages_db import HomeMessagesDB
+
+def gas_lines():
+    """
+    Helper function that returns the lines of a gas export every 15 minutes during the night when the clocks go back
+    (the wall clock shows 02:00 to 02:45 twice), and the readings they hold
+    """
+    epochs = pd.date_range('2022-10-29 22:00', '2022-10-30 04:00', freq='15min', tz='UTC')
+    times = epochs.tz_convert('Europe/Amsterdam').strftime('%Y-%m-%d %H:%M:%S')
+    usage = 500 + 0.125 * np.arange(epochs.shape[0])
+    lines = [f'{time},{value}\n' for time, value in zip(times, usage)]
+    return lines, pd.DataFrame({'epoch': (epochs.asi8 // 10**9).astype('int64'), 'usage': usage})
+
+def poll(db, directory):
+    follow_directory(db, 'p1g', directory, 'P1g*', p1g.TOOL.ingest_file, p1g.TOOL.ingest_lines, interval=0.1, polls=1)
+
+def test_follow_a_growing_file(tmp_path):
+    lines, expected = gas_lines()
+    url = f'sqlite:///{tmp_path / "home.db"}'
+    exports = tmp_path / 'exports'
+    exports.mkdir()
+    path = exports / 'P1g-2022-10-30.csv'
+    db = HomeMessagesDB(url)
+
+    # The first pass of the repeated hour starts at row 8; the last line is still being written
+    path.write_text('time,usage\n' + ''.join(lines[:10]) + lines[10][:12])
+    poll(db, str(exports))
+    # The readings from 02:00 on are held back, since their offset is only known from the readings after them
+    pd.testing.assert_frame_equal(db.query_gas(), expected.iloc[:8])
+    offset, _ = db.tail_entries('p1g')[os.path.abspath(path)]
+    assert offset == len('time,usage\n' + ''.join(lines[:8]))
+
+    # Nothing was appended, and then only lines within the repeated hour
+    poll(db, str(exports))
+    with open(path, 'a') as f:
+        f.write(lines[10][12:] + ''.join(lines[11:14]))
+    poll(db, str(exports))
+    pd.testing.assert_frame_equal(db.query_gas(), expected.iloc[:8])
+
+    # The rest of the night, picked up by a watcher that was restarted
+    with open(path, 'a') as f:
+        f.write(''.join(lines[14:]))
+    restarted = HomeMessagesDB(url)
+    poll(restarted, str(exports))
+    poll(restarted, str(exports))
+    pd.testing.assert_frame_equal(restarted.query_gas(), expected)
+    assert restarted.count_rows('gas') == expected.shape[0]
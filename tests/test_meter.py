@@ -0,0 +1,9 @@
+import numpy as np
+import pandas as pd
+from meter import consumption
+
+def test_reset_on_the_last_bucket_edge():
+    df = pd.DataFrame({'epoch': [0, 900, 1800, 2700, 3600], 'T1': [10, 11, 12, 13, 1]})
+    out = consumption(df, ['T1'], freq='1h')
+    assert out['reset'].tolist() == [True]
+    np.testing.assert_allclose(out['T1'], [3.0])
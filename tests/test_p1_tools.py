@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+import pytest
+import p1e
+import p1g
+import synthetic_data
+from home_messages_db import HomeMessagesDB
+
+@pytest.mark.parametrize('tool, write, query', [
+    (p1e.p1e, synthetic_data.write_p1e, 'query_electricity'),
+    (p1g.p1g, synthetic_data.write_p1g, 'query_gas'),
+])
+@pytest.mark.parametrize('options', [['--chunksize', '500'], ['--chunksize', '500', '--workers', '2']])
+def test_chunksize_gives_the_same_readings_as_reading_at_once(tmp_path, tool, write, query, options):
+    # The exports span the night when the clocks go back, and have duplicate rows, bad timestamps and missing values
+    files = write(str(tmp_path), start='2022-10-28', days=4)
+    results = {}
+    for name, extra in [('at_once', []), ('chunks', options)]:
+        url = f'sqlite:///{tmp_path / name}.db'
+        result = CliRunner().invoke(tool, ['-d', url, *extra, *files])
+        assert result.exit_code == 0, result.output
+        db = HomeMessagesDB(url)
+        results[name] = (getattr(db, query)(), db.query_meter_rollups(resolution='hour'))
+    assert results['at_once'][0].shape[0] > 0
+    pd.testing.assert_frame_equal(results['chunks'][0], results['at_once'][0])
+    pd.testing.assert_frame_equal(results['chunks'][1], results['at_once'][1])
+
+def meter_readings(tool, start, end):
+    """
+    Helper function that returns the raw readings of a tool every 15 minutes between two UTC times, with the time
+    as the wall clock time in Amsterdam (like in the exports), together with their epochs
+    """
+    epochs = pd.date_range(start, end, freq='15min', tz='UTC')
+    counter = 0.1 * np.arange(epochs.shape[0])
+    times = epochs.tz_convert('Europe/Amsterdam').strftime('%Y-%m-%d %H:%M:%S')
+    values = [1000 + counter, 2000 + counter / 2] if tool is p1e.TOOL else [500 + counter]
+    df = pd.DataFrame(dict(zip(tool.names, [times, *values])))
+    return df, (epochs.asi8 // 10**9).astype('int64')
+
+@pytest.mark.parametrize('tool', [p1e.TOOL, p1g.TOOL])
+def test_repeated_hour_in_october(tool):
+    # From 01:00 summer time up to 04:00 winter time: the wall clock shows 02:00 to 02:45 twice
+    df, epochs = meter_readings(tool, '2022-10-29 23:00', '2022-10-30 03:00')
+    assert df['time'].duplicated().sum() == 4
+    assert tool.clean(df)['epoch'].tolist() == epochs.tolist()
+    # The order of the readings in the file does not matter, since the counter tells it
+    shuffled = df.sample(frac=1, random_state=0)
+    pd.testing.assert_frame_equal(tool.clean(shuffled), tool.clean(df))
+
+    # A chunk that starts in the second pass of the hour, or ends in the first one
+    second = df['time'].duplicated(keep='first').to_numpy().nonzero()[0][1]
+    assert tool.clean(df.iloc[second:])['epoch'].tolist() == epochs[second:].tolist()
+    first = df['time'].duplicated(keep='last').to_numpy().nonzero()[0][1]
+    assert tool.clean(df.iloc[:first + 1])['epoch'].tolist() == epochs[:first + 1].tolist()
+
+@pytest.mark.parametrize('tool', [p1e.TOOL, p1g.TOOL])
+def test_skipped_hour_in_march(tool):
+    # From 01:00 winter time up to 04:00 summer time: the wall clock skips from 01:45 to 03:00
+    df, epochs = meter_readings(tool, '2023-03-26 00:00', '2023-03-26 02:00')
+    assert not df['time'].str.contains(' 02:').any()
+    assert tool.clean(df)['epoch'].tolist() == epochs.tolist()
+    # A reading at a time that does not exist is dropped
+    bogus = pd.concat([df, df.iloc[[4]].assign(time='2023-03-26 02:30:00')]).sort_index(kind='stable')
+    assert tool.clean(bogus)['epoch'].tolist() == epochs.tolist()
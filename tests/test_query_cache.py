@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+from home_messages_db import HomeMessagesDB
+from query_cache import QueryCache
+
+def epoch(day):
+    return int(pd.Timestamp(day, tz='UTC').timestamp())
+
+def gas_readings(start, end, offset=0):
+    """
+    Helper function that returns gas readings every hour from start up to end (UTC days)
+    """
+    epochs = np.arange(epoch(start), epoch(end), 3600) + offset
+    return pd.DataFrame({'epoch': epochs, 'usage': 100 + (epochs - epoch('2023-01-01')) / 36000})
+
+def test_cached_result_is_only_reused_while_its_months_are_unchanged(tmp_path):
+    cache = QueryCache()
+    db = HomeMessagesDB(f'sqlite:///{tmp_path / "home.db"}', cache=cache)
+    db.insert_p1g_data(gas_readings('2023-01-01', '2023-03-01'))
+    january = {'start': epoch('2023-01-01'), 'end': epoch('2023-02-01') - 1}
+    queries = [lambda: db.query_gas(**january), lambda: db.query_meter_rollups(series='gas', **january)]
+
+    results = [query() for query in queries]
+    assert (cache.hits, cache.misses) == (0, 2)
+    for query, result in zip(queries, results):
+        pd.testing.assert_frame_equal(query(), result)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Readings of March are not in the range of the queries, so the results stay cached
+    db.insert_p1g_data(gas_readings('2023-03-01', '2023-03-08'))
+    for query, result in zip(queries, results):
+        pd.testing.assert_frame_equal(query(), result)
+    assert (cache.hits, cache.misses) == (4, 2)
+    # A query over all months does see them
+    assert db.query_gas().shape[0] == (epoch('2023-03-08') - epoch('2023-01-01')) // 3600
+
+    # A reading in January makes the cached results stale
+    db.insert_p1g_data(gas_readings('2023-01-10', '2023-01-10 01:00', offset=1800))
+    misses = cache.misses
+    gas = queries[0]()
+    assert gas.shape[0] == results[0].shape[0] + 1 and epoch('2023-01-10') + 1800 in gas['epoch'].tolist()
+    queries[1]()
+    assert cache.misses == misses + 2
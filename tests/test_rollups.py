@@ -0,0 +1,69 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+from home_messages_db import HomeMessagesDB
+
+def gas_readings(start, days):
+    """
+    Helper function that returns increasing gas readings every hour for a number of days
+    """
+    epochs = np.arange(pd.Timestamp(start, tz='UTC').timestamp(), pd.Timestamp(start, tz='UTC').timestamp() + days * 86400, 3600)
+    return pd.DataFrame({'epoch': epochs.astype('int64'), 'usage': np.arange(epochs.shape[0]) * 0.1})
+
+def test_rebuild_rollups_with_a_gap_of_months(tmp_path):
+    path = tmp_path / 'gap.db'
+    db = HomeMessagesDB(f'sqlite:///{path}')
+    db.insert_p1g_data(pd.concat([gas_readings('2023-01-01', 5), gas_readings('2023-04-01', 5).assign(usage=lambda df: df['usage'] + 100)]))
+    expected = db.query_meter_rollups(series='gas', resolution='day')
+
+    db.rebuild_rollups()
+    pd.testing.assert_frame_equal(db.query_meter_rollups(series='gas', resolution='day'), expected)
+
+    # An older database without the rollup tables gets them when it is opened
+    db.engine.dispose()
+    with sqlite3.connect(path) as conn:
+        conn.execute('DROP TABLE meter_rollups')
+        conn.execute('DROP TABLE schema_version')
+    reopened = HomeMessagesDB(f'sqlite:///{path}')
+    pd.testing.assert_frame_equal(reopened.query_meter_rollups(series='gas', resolution='day'), expected)
+
+def all_rollups(db):
+    """
+    Helper function that returns the hourly and daily rollups of the meters and the sensors
+    """
+    return [db.query_meter_rollups(series=['gas', 'T1', 'T2', 'T1T2'], resolution=resolution) for resolution in ('hour', 'day')] \
+        + [db.query_sensor_rollups(resolution=resolution) for resolution in ('hour', 'day')]
+
+def test_apply_retention_keeps_the_rollups(tmp_path):
+    db = HomeMessagesDB(f'sqlite:///{tmp_path / "home.db"}')
+    gas = gas_readings('2023-01-01', 90)
+    db.insert_p1g_data(gas)
+    db.insert_p1e_data(gas.assign(T1=gas['usage'] * 2, T2=gas['usage'] * 3)[['epoch', 'T1', 'T2']], 'electricity')
+    db.insert_smartthings(pd.DataFrame({
+        'loc': 'Garden', 'level': 'Ground', 'name': 'Garden air (sensor)', 'capability': 'temperatureMeasurement',
+        'attribute': 'temperature', 'unit': 'C', 'epoch': gas['epoch'], 'value': (gas.index % 17).astype(str)
+    }))
+    tables = ['electricity', 'gas', 'smartthings']
+    expected = all_rollups(db)
+    assert all(df.shape[0] for df in expected)
+    versions_before = {(table, month): version for table, month, version in db.data_versions(tables)}
+    counts = {table: db.count_rows(table) for table in tables}
+
+    # In the middle of April, only the readings of March are kept
+    removed = db.apply_retention({table: 1 for table in tables}, now=pd.Timestamp('2023-04-15', tz='UTC').timestamp())
+    march = (gas['epoch'] >= pd.Timestamp('2023-03-01', tz='UTC').timestamp()).sum()
+    assert removed == {table: counts[table] - march for table in tables}
+
+    for before, after in zip(expected, all_rollups(db)):
+        pd.testing.assert_frame_equal(after, before)
+    for table in tables:
+        assert db.count_rows(table) == march
+        with db.engine.connect() as conn:
+            assert conn.exec_driver_sql(f'SELECT COUNT(*) FROM {table}').scalar() == march
+            months = conn.exec_driver_sql(f"SELECT month FROM table_months WHERE table_name = '{table}'").scalars().all()
+        assert months == ['2023-03']
+    # Only the versions of the removed months changed
+    versions_after = {(table, month): version for table, month, version in db.data_versions(tables)}
+    assert versions_after.keys() == versions_before.keys() and len(versions_after) == 9
+    for key, version in versions_after.items():
+        assert (version > versions_before[key]) == (key[1] < '2023-03')
@@ -0,0 +1,22 @@
+import sqlite3
+from home_messages_db import HomeMessagesDB
+
+def smartthings_indexes(path):
+    """
+    Helper function that returns the names of the secondary indexes of the 'smartthings' table
+    """
+    with sqlite3.connect(path) as conn:
+        return [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'smartthings' AND name NOT LIKE 'sqlite_%'")]
+
+def test_interrupted_load_mode_is_repaired(tmp_path):
+    path = tmp_path / 'load.db'
+    db = HomeMessagesDB(f'sqlite:///{path}')
+    indexes = smartthings_indexes(path)
+    # The block of load_mode() is entered but never left, as when the process is killed
+    # (the reference is kept, since closing the generator would rebuild the indexes)
+    interrupted = db.load_mode()
+    interrupted.__enter__()
+    assert smartthings_indexes(path) == []
+    HomeMessagesDB(f'sqlite:///{path}')
+    assert smartthings_indexes(path) == indexes
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+from home_messages_db import HomeMessagesDB, SENSOR_COLUMNS, Sensor
+
+def many_sensors(n=1600, repeats=2):
+    """
+    Helper function that returns readings of n sensors that differ in every column, so that the keys
+    of the columns do not fit in 64 bits and the sensors are grouped by a hash
+    """
+    sensors = pd.DataFrame({col: [f'{col} {i}' for i in range(n)] for col in SENSOR_COLUMNS})
+    readings = pd.concat([sensors.assign(epoch=1672531200 + 3600 * k, value=[str(i + k) for i in range(n)]) for k in range(repeats)],
+                         ignore_index=True)
+    return readings.sample(frac=1, random_state=0, ignore_index=True)
+
+def exact_groups(df):
+    """
+    Helper function that numbers the distinct sensors of the rows in the order they appear
+    """
+    return df.groupby(SENSOR_COLUMNS, sort=False, dropna=False).ngroup().to_numpy()
+
+@pytest.fixture
+def colliding_hash(monkeypatch):
+    """
+    Replaces the first hash of sensor_groups() by one with only a few values, so that different sensors collide
+    """
+    original = pd.util.hash_pandas_object
+    calls = []
+    def hash_pandas_object(obj, *args, **kwargs):
+        hashes = original(obj, *args, **kwargs)
+        calls.append(kwargs.get('hash_key'))
+        return hashes if 'hash_key' in kwargs else hashes % 7
+    monkeypatch.setattr(pd.util, 'hash_pandas_object', hash_pandas_object)
+    return calls
+
+def check_groups(df):
+    codes, first_rows = HomeMessagesDB.sensor_groups(df)
+    # The same groups as grouping on the values, numbered in the order they appear
+    assert (pd.factorize(codes)[0] == exact_groups(df)).all()
+    assert (codes[first_rows] == np.arange(len(first_rows))).all()
+    assert (first_rows == pd.Series(codes).drop_duplicates().sort_values().index.to_numpy()).all()
+
+def test_sensor_groups_by_hash():
+    check_groups(many_sensors())
+
+def test_sensor_groups_with_colliding_hashes(colliding_hash):
+    check_groups(many_sensors())
+    # The hashes were used, and the collision was found by the second one
+    assert colliding_hash == [None, 'energyusage-0001']
+
+def test_insert_with_colliding_hashes(tmp_path, colliding_hash):
+    db = HomeMessagesDB(f'sqlite:///{tmp_path / "home.db"}')
+    readings = many_sensors()
+    assert db.insert_smartthings(readings) == readings.shape[0]
+    assert colliding_hash
+    stored = db.query_smartthings(name=None, attribute=None, columns=['epoch', *SENSOR_COLUMNS, 'value'])
+    expected = readings[['epoch', *SENSOR_COLUMNS, 'value']]
+    pd.testing.assert_frame_equal(stored.sort_values(['name', 'epoch'], ignore_index=True),
+                                  expected.sort_values(['name', 'epoch'], ignore_index=True))
+    # Inserting them again finds the same sensors
+    assert db.insert_smartthings(readings) == 0
+    assert db.session.query(Sensor).count() == 1600
+
+def test_new_sensors_are_not_committed_on_their_own(tmp_path):
+    db = HomeMessagesDB(f'sqlite:///{tmp_path / "home.db"}')
+    readings = many_sensors(n=3)
+    ids = db.sensor_ids(readings)
+    assert len(set(ids)) == 3
+    # The sensors are part of the transaction of the insert, so they go if it is rolled back
+    db.session.rollback()
+    assert db.session.query(Sensor).count() == 0
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+import synthetic_data
+from smartthings import validate, smartthings
+from home_messages_db import HomeMessagesDB
+
+def test_rules_do_not_apply_to_missing_attributes():
+    readings = pd.DataFrame({
+        'epoch': [1672531200, 1672531200, 1672534800],
+        'name': ['Kitchen plug', np.nan, 'Garden air (sensor)'],
+        'attribute': [np.nan, 'power', 'humidity'],
+        'value': ['150', '150', '150'],
+    })
+    valid, counts = validate(readings)
+    # There are no temperature readings, so only the humidity of 150 % is rejected
+    assert valid.index.tolist() == [0, 1]
+    assert counts == {'temperature_range': 0, 'temperature_low_in_summer': 0, 'temperature_high_in_winter': 0, 'humidity_range': 1}
+
+def test_rule_for_a_missing_name():
+    readings = pd.DataFrame({'epoch': [1672531200], 'name': [np.nan], 'attribute': ['temperature'], 'value': ['80']})
+    rules = [{'rule': 'garden_temperature', 'attribute': 'temperature', 'name': 'Garden air (sensor)', 'max': 45}]
+    valid, counts = validate(readings, rules)
+    assert valid.shape[0] == 1 and counts == {'garden_temperature': 0}
+
+@pytest.mark.parametrize('options', [[], ['--workers', '2'], ['--chunksize', '1000']])
+def test_a_corrupt_file_is_skipped(tmp_path, options):
+    exports = tmp_path / 'exports'
+    exports.mkdir()
+    files = synthetic_data.write_smartthings(str(exports), start='2023-01-01', days=3)
+    # The download of the second file was cut off halfway
+    with open(files[1], 'rb') as f:
+        content = f.read()
+    with open(files[1], 'wb') as f:
+        f.write(content[:len(content) // 2])
+
+    url = f'sqlite:///{tmp_path / "home.db"}'
+    result = CliRunner().invoke(smartthings, ['-d', url, *options, *files])
+    assert result.exit_code == 0, result.output
+    assert f"Error reading file: {files[1]}" in result.output
+    db = HomeMessagesDB(url)
+    assert sorted(db.file_manifest('smartthings')) == [files[0], files[2]]
+
+    # The readings of the other files are all there
+    expected_url = f'sqlite:///{tmp_path / "expected.db"}'
+    CliRunner().invoke(smartthings, ['-d', expected_url, files[0], files[2]])
+    stored = db.query_smartthings()
+    expected = HomeMessagesDB(expected_url).query_smartthings()
+    assert expected.shape[0] > 0
+    assert expected.merge(stored, how='left', indicator=True)['_merge'].eq('both').all()
+    if '--chunksize' not in options:
+        assert stored.shape[0] == expected.shape[0]